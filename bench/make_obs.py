@@ -0,0 +1,117 @@
+"""
+Generates a synthetic NICER observation tree for the benchmarks.
+
+Every observation directory gets a source spectrum (spec1.pha) whose header names
+its response, ancillary response and background files, like the spectra made by
+nicerl3-spect, and the obslist.txt that the pipeline scripts read.
+command: `python make_obs.py OUTDIR --nobs 1000`
+"""
+
+import os
+import argparse
+import numpy as np
+
+CARD = 80
+BLOCK = 2880
+
+
+def fits_header(cards):
+	"""
+	Builds a FITS header from (keyword, value) pairs, padded to whole blocks.
+	"""
+	lines = []
+	for key, val in cards:
+		if isinstance(val, bool):
+			sval = "T" if val else "F"
+			lines.append(f"{key:<8s}= {sval:>20s}")
+		elif isinstance(val, str):
+			sval = f"'{val:<8s}'"
+			lines.append(f"{key:<8s}= {sval:<20s}")
+		else:
+			lines.append(f"{key:<8s}= {val:>20}")
+	lines.append("END")
+	text = "".join(f"{line:<{CARD}s}" for line in lines)
+	return (text + " " * (-len(text) % BLOCK)).encode("ascii")
+
+def write_pha(fname, nchan, rng, resp=None, arf=None, back=None):
+	"""
+	Writes a minimal OGIP spectrum: an empty primary HDU and a SPECTRUM table of
+	channels and counts.
+	"""
+	primary = fits_header([("SIMPLE", True), ("BITPIX", 8), ("NAXIS", 0), ("EXTEND", True)])
+	cards = [("XTENSION", "BINTABLE"), ("BITPIX", 8), ("NAXIS", 2), ("NAXIS1", 6), ("NAXIS2", nchan),
+		("PCOUNT", 0), ("GCOUNT", 1), ("TFIELDS", 2), ("TTYPE1", "CHANNEL"), ("TFORM1", "I"),
+		("TTYPE2", "COUNTS"), ("TFORM2", "J"), ("EXTNAME", "SPECTRUM"), ("TELESCOP", "NICER"),
+		("INSTRUME", "XTI"), ("DETCHANS", nchan), ("EXPOSURE", float(rng.uniform(500, 3000))),
+		("RESPFILE", resp or "none"), ("ANCRFILE", arf or "none"), ("BACKFILE", back or "none")]
+	data = np.empty(nchan, dtype=[("CHANNEL", ">i2"), ("COUNTS", ">i4")])
+	data["CHANNEL"] = np.arange(nchan)
+	data["COUNTS"] = rng.poisson(200 * np.exp(-np.arange(nchan) / (nchan / 4)))
+	raw = data.tobytes()
+	with open(fname, "wb") as file:
+		file.write(primary)
+		file.write(fits_header(cards))
+		file.write(raw + b"\0" * (-len(raw) % BLOCK))
+	return
+
+def write_blob(fname, nbytes, rng):
+	"""
+	Writes a response-like file of the given size.
+	"""
+	with open(fname, "wb") as file:
+		file.write(rng.bytes(nbytes))
+	return
+
+def make_obs(outdir, nobs, nchan=1501, rmf_kb=512, arf_kb=64, shared_response=False, seed=1):
+	"""
+	Creates nobs observation directories under outdir and writes obslist.txt.
+	Args:
+		outdir (str): Root directory of the tree.
+		nobs (int): Number of observations.
+		nchan (int): Number of spectral channels, and of plot bins in the stub.
+		rmf_kb (int): Size of each response file in kB.
+		arf_kb (int): Size of each ancillary response file in kB.
+		shared_response (bool): Link all observations to one response and arf to save disk space.
+	Returns:
+		str: Path of the obslist file.
+	"""
+	rng = np.random.default_rng(seed)
+	os.makedirs(outdir, exist_ok=True)
+	if shared_response:
+		write_blob(os.path.join(outdir, "shared.rmf"), rmf_kb * 1024, rng)
+		write_blob(os.path.join(outdir, "shared.arf"), arf_kb * 1024, rng)
+
+	paths = []
+	for i in range(nobs):
+		obsid = f"{6100110000 + i:010d}"
+		opath = os.path.join(outdir, obsid)
+		os.makedirs(opath, exist_ok=True)
+		rmf, arf = f"ni{obsid}mpu7.rmf", f"ni{obsid}mpu7.arf"
+		if shared_response:
+			for name, src in ((rmf, "shared.rmf"), (arf, "shared.arf")):
+				if not os.path.lexists(os.path.join(opath, name)):
+					os.symlink(os.path.join("..", src), os.path.join(opath, name))
+		else:
+			write_blob(os.path.join(opath, rmf), rmf_kb * 1024, rng)
+			write_blob(os.path.join(opath, arf), arf_kb * 1024, rng)
+		write_pha(os.path.join(opath, f"ni{obsid}mpu7_bg.pha"), nchan, rng)
+		write_pha(os.path.join(opath, "spec1.pha"), nchan, rng, resp=rmf, arf=arf, back=f"ni{obsid}mpu7_bg.pha")
+		paths.append(opath)
+
+	obslist = os.path.join(outdir, "obslist.txt")
+	with open(obslist, "w") as file:
+		file.write("\n".join(paths) + "\n")
+	return obslist
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Generate a synthetic NICER observation tree.")
+	parser.add_argument("outdir", type=str, help="Output directory")
+	parser.add_argument("--nobs", type=int, default=100, help="Number of observations (default: %(default)s)")
+	parser.add_argument("--nchan", type=int, default=1501, help="Channels per spectrum (default: %(default)s)")
+	parser.add_argument("--rmf-kb", type=int, default=512, help="Size of each response file in kB (default: %(default)s)")
+	parser.add_argument("--shared-response", action="store_true", help="Symlink one response and arf into every observation")
+	args = parser.parse_args()
+
+	obslist = make_obs(args.outdir, args.nobs, nchan=args.nchan, rmf_kb=args.rmf_kb, shared_response=args.shared_response)
+	print(f">>> Wrote {args.nobs} observations, list: {obslist}")
@@ -0,0 +1,129 @@
+"""
+Throughput benchmark of the pipeline stages on synthetic observations.
+
+The stages run as they do in production (one process per script, see src/README.md)
+against the stand-in xspec module of this directory. For every stage the wall
+time, CPU time, throughput and peak memory are reported. With --baseline the
+results are compared with an earlier --json output and the run fails when a
+stage got slower than the tolerance allows.
+command: `python run_bench.py --nobs 100 --workers 4`
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import subprocess
+from make_obs import make_obs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+STAGES = ["run_xspec", "read_log", "plot_spec"]
+
+
+def run_stage(stage, obslist, workdir, extra_args=(), speed=1.0):
+	"""
+	Runs one pipeline script on the obslist and measures it.
+	Returns:
+		Dict: wall and CPU seconds, peak RSS in MB and the exit code.
+	"""
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join([BENCH_DIR, SRC_DIR, env.get("PYTHONPATH", "")])
+	env["XSPEC_STUB_SPEED"] = str(speed)
+	env["MPLBACKEND"] = "Agg"
+	cmd = [sys.executable, os.path.join(SRC_DIR, f"{stage}.py"), obslist, "--no-cache", *extra_args]
+
+	t0 = time.perf_counter()
+	with open(os.path.join(workdir, f"{stage}.out"), "w") as out:
+		proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+		_, status, usage = os.wait4(proc.pid, 0)
+	wall = time.perf_counter() - t0
+
+	# ru_maxrss is in kB on Linux and covers the largest process of the stage
+	return {"wall": wall, "cpu": usage.ru_utime + usage.ru_stime, "rss_mb": usage.ru_maxrss / 1024,
+		"exit": os.waitstatus_to_exitcode(status)}
+
+def compare(results, baseline, tolerance):
+	"""
+	Compares the throughput with a baseline.
+	Returns:
+		list: Messages for the stages that regressed.
+	"""
+	regressions = []
+	for stage, res in results.items():
+		ref = baseline.get(stage)
+		if not ref:
+			continue
+		if res["obs_per_s"] < ref["obs_per_s"] * (1 - tolerance):
+			regressions.append(f"{stage}: {res['obs_per_s']:.2f} obs/s, baseline {ref['obs_per_s']:.2f} obs/s")
+		if res["rss_mb"] > ref["rss_mb"] * (1 + tolerance):
+			regressions.append(f"{stage}: {res['rss_mb']:.0f} MB peak RSS, baseline {ref['rss_mb']:.0f} MB")
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic observations.")
+	parser.add_argument("--nobs", type=int, default=100, help="Number of synthetic observations (default: %(default)s)")
+	parser.add_argument("--nchan", type=int, default=1501, help="Channels per spectrum (default: %(default)s)")
+	parser.add_argument("--workdir", type=str, default=os.path.join("/tmp", "nicer-xspec-bench"), help="Directory of the synthetic tree (default: %(default)s)")
+	parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to time (default: all)")
+	parser.add_argument("--speed", type=float, default=1.0, help="Scale of the simulated Xspec timings, 0 for none (default: %(default)s)")
+	parser.add_argument("--workers", type=int, default=1, help="Workers passed to run_xspec.py and plot_spec.py (default: %(default)s)")
+	parser.add_argument("--xspec-args", type=str, default="", help="Extra options for run_xspec.py")
+	parser.add_argument("--log-args", type=str, default="", help="Extra options for read_log.py")
+	parser.add_argument("--plot-args", type=str, default="", help="Extra options for plot_spec.py")
+	parser.add_argument("--shared-response", action="store_true", help="Symlink one response into all observations (large --nobs)")
+	parser.add_argument("--json", type=str, help="Write the results to this file")
+	parser.add_argument("--baseline", type=str, help="Earlier --json output to compare with")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (default: %(default)s)")
+	parser.add_argument("--keep", action="store_true", help="Keep the synthetic tree")
+	args = parser.parse_args()
+
+	shutil.rmtree(args.workdir, ignore_errors=True)
+	t0 = time.perf_counter()
+	obslist = make_obs(args.workdir, args.nobs, nchan=args.nchan, shared_response=args.shared_response)
+	print(f">>> Generated {args.nobs} observations in {time.perf_counter() - t0:.1f} s: {args.workdir}")
+
+	stage_args = {
+		"run_xspec": ["--workers", str(args.workers), *shlex.split(args.xspec_args)],
+		"read_log": shlex.split(args.log_args),
+		"plot_spec": ["--workers", str(args.workers), *shlex.split(args.plot_args)],
+	}
+
+	results = {}
+	failed = False
+	for stage in STAGES:
+		timed = stage in args.stages
+		if not timed and not any(STAGES.index(s) > STAGES.index(stage) for s in args.stages):
+			continue
+		# Untimed stages only prepare the inputs of the later ones, as fast as possible
+		res = run_stage(stage, obslist, args.workdir, stage_args[stage], speed=args.speed if timed else 0.0)
+		if res["exit"] != 0:
+			print(f"> Error: {stage} exited with {res['exit']}, see {os.path.join(args.workdir, stage + '.out')}")
+			failed = True
+		if timed:
+			res["nobs"] = args.nobs
+			res["obs_per_s"] = args.nobs / res["wall"]
+			results[stage] = res
+
+	print(f"\n{'Stage':<12s}{'Obs':>8s}{'Wall (s)':>12s}{'CPU (s)':>12s}{'Obs/s':>10s}{'Peak RSS (MB)':>16s}")
+	for stage, res in results.items():
+		print(f"{stage:<12s}{res['nobs']:>8d}{res['wall']:>12.2f}{res['cpu']:>12.2f}{res['obs_per_s']:>10.2f}{res['rss_mb']:>16.1f}")
+
+	if args.json:
+		with open(args.json, "w") as file:
+			json.dump(results, file, indent=2)
+
+	if not args.keep and not failed:
+		shutil.rmtree(args.workdir, ignore_errors=True)
+
+	if args.baseline:
+		with open(args.baseline, "r") as file:
+			regressions = compare(results, json.load(file), args.tolerance)
+		for msg in regressions:
+			print(f"> Regression: {msg}")
+		if regressions:
+			sys.exit(1)
@@ -0,0 +1,448 @@
+"""
+Stand-in for the PyXspec `xspec` module, used by the benchmarks.
+
+It implements the parts of the PyXspec API that the pipeline scripts use, with
+realistic array sizes and per-call timings, so that run_xspec.py, read_log.py
+and plot_spec.py can be run and timed without HEASoft.
+The fit converges geometrically towards "true" parameter values drawn from the
+spectrum file name, the log files follow the layout of real Xspec logs and the
+plot arrays have one bin per channel of the spectrum (DETCHANS keyword).
+
+Environment variables:
+	XSPEC_STUB_SPEED: scale factor of the simulated timings, 0 disables them (default: 1.0)
+"""
+
+import os
+import re
+import time
+import zlib
+import numpy as np
+
+SPEED = float(os.environ.get("XSPEC_STUB_SPEED", "1.0"))
+
+# Seconds per call, measured on NICER spectra of a few ks
+TIMINGS = {
+	"load": 0.030,
+	"model": 0.002,
+	"iteration": 0.004,
+	"flux": 0.005,
+	"flux_err": 0.120,
+	"plot": 0.004,
+	"plot_ps": 0.030,
+	"error": 0.150,
+}
+
+COMPONENTS = {
+	"TBabs": [("nH", "10^22", 1.0)],
+	"powerlaw": [("PhoIndex", "", 1.0), ("norm", "", 1.0)],
+	"logpar": [("alpha", "", 1.5), ("beta", "", 0.2), ("pivotE", "keV", 1.0), ("norm", "", 1.0)],
+	"bknpower": [("PhoIndx1", "", 1.0), ("BreakE", "keV", 5.0), ("PhoIndx2", "", 2.0), ("norm", "", 1.0)],
+}
+FROZEN = {"pivotE"}
+ERG_PER_KEV = 1.602176634e-9
+_trapz = getattr(np, "trapezoid", None) or np.trapz
+
+
+def _wait(stage, factor=1.0):
+	if SPEED > 0:
+		time.sleep(TIMINGS[stage] * SPEED * factor)
+
+def _log(text):
+	if Xset._logfile is not None and Xset.logChatter > 0:
+		Xset._logfile.write(text)
+
+def _truth(name, seed):
+	"""
+	True parameter values of a spectrum, drawn from its file name.
+	"""
+	rng = np.random.default_rng(seed)
+	index = rng.uniform(1.8, 2.8)
+	return {
+		"nH": 0.0131, "PhoIndex": index, "alpha": index - 0.2, "beta": rng.uniform(0.05, 0.4), "pivotE": 1.0,
+		"PhoIndx1": index - 0.1, "BreakE": rng.uniform(2.0, 5.0), "PhoIndx2": index + 0.3,
+		"norm": 10 ** rng.uniform(-3, -1),
+	}
+
+def _photon_spectrum(comp, pars, energy):
+	"""
+	Photon spectrum of a model component, photons/cm^2/s/keV.
+	"""
+	if comp == "powerlaw":
+		return pars["norm"] * energy ** -pars["PhoIndex"]
+	if comp == "logpar":
+		x = energy / pars["pivotE"]
+		return pars["norm"] * x ** -(pars["alpha"] + pars["beta"] * np.log10(x))
+	if comp == "bknpower":
+		eb = pars["BreakE"]
+		low = pars["norm"] * energy ** -pars["PhoIndx1"]
+		high = pars["norm"] * eb ** (pars["PhoIndx2"] - pars["PhoIndx1"]) * energy ** -pars["PhoIndx2"]
+		return np.where(energy <= eb, low, high)
+	raise ValueError(f"Model component {comp} is not available in the stub.")
+
+
+class Parameter:
+	def __init__(self, name, unit, value, index):
+		self.name = name
+		self.unit = unit
+		self.index = index
+		self.values = [value, 0.01, -1e22, -1e22, 1e22, 1e22]
+		self.frozen = name in FROZEN
+		self.link = ""
+		self.sigma = -1.0
+		self.error = (0.0, 0.0, "FFFFFFFFF")
+
+	def _set(self, val):
+		if isinstance(val, str):
+			fields = [float(v) for v in val.split(",") if v.strip()]
+		elif isinstance(val, (list, tuple)):
+			fields = [float(v) for v in val]
+		else:
+			fields = [float(val)]
+		self.values = fields + self.values[len(fields):]
+		if len(fields) > 1 and fields[1] < 0:
+			self.frozen = True
+
+
+class Component:
+	def __init__(self, name, start):
+		object.__setattr__(self, "name", name)
+		object.__setattr__(self, "parameterNames", [p[0] for p in COMPONENTS[name]])
+		for i, (pname, unit, value) in enumerate(COMPONENTS[name]):
+			object.__setattr__(self, pname, Parameter(pname, unit, value, start + i))
+
+	def __setattr__(self, key, val):
+		if key in self.parameterNames:
+			getattr(self, key)._set(val)
+		else:
+			object.__setattr__(self, key, val)
+
+
+class Model:
+	def __init__(self, expr, modName="", sourceNum=1, setPars=None):
+		_wait("model")
+		self.expression = expr
+		self.componentNames = []
+		self._pars = []
+		for cname in re.split(r"[*+()]", expr):
+			cname = cname.strip()
+			if not cname:
+				continue
+			cname = next((c for c in COMPONENTS if c.lower() == cname.lower()), None)
+			if cname is None:
+				raise Exception(f"Model command error: unknown component in {expr}")
+			comp = Component(cname, len(self._pars) + 1)
+			self.componentNames.append(cname)
+			setattr(self, cname, comp)
+			self._pars += [getattr(comp, p) for p in comp.parameterNames]
+		self.nParameters = len(self._pars)
+		self.startParIndex = 1
+		self.flux = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+		AllModels._models = [self] * max(1, AllData.nGroups)
+		if setPars is not None:
+			self.setPars(setPars)
+
+	def __call__(self, index):
+		return self._pars[index - 1]
+
+	def setPars(self, *args):
+		if len(args) == 1 and isinstance(args[0], dict):
+			for idx, val in args[0].items():
+				self._pars[int(idx) - 1]._set(val)
+		else:
+			for par, val in zip(self._pars, args):
+				par._set(val)
+
+	def untie(self):
+		for par in self._pars:
+			par.link = ""
+
+	def _values(self):
+		return {p.name: p.values[0] for p in self._pars}
+
+	def _photons(self, energy):
+		pars = self._values()
+		comp = self.componentNames[-1]
+		absorb = np.exp(-pars.get("nH", 0.0) * 2.0 * energy ** -2.6) if "TBabs" in self.componentNames else 1.0
+		return absorb * _photon_spectrum(comp, pars, energy)
+
+	def _show(self):
+		lines = ["=" * 72 + "\n", f"Model {self.expression} Source No.: 1   Active/On\n",
+			"Model Model Component  Parameter  Unit     Value\n", " par  comp\n"]
+		for i, cname in enumerate(self.componentNames):
+			comp = getattr(self, cname)
+			for pname in comp.parameterNames:
+				par = getattr(comp, pname)
+				err = "frozen" if par.frozen else f"+/-  {max(par.sigma, 0.0):.5E}"
+				lines.append(f"{par.index:4d}{i + 1:5d}   {cname:<10s} {pname:<10s} {par.unit:<8s} {par.values[0]:.5E}  {err}\n")
+		lines.append("_" * 72 + "\n")
+		return "".join(lines)
+
+
+class Spectrum:
+	def __init__(self, dataFile):
+		if not dataFile or not os.path.isfile(dataFile):
+			raise Exception(f"***XSPEC Error: Unable to open file {dataFile}")
+		_wait("load")
+		with open(dataFile, "rb") as file:
+			head = file.read(2880 * 4)
+		match = re.search(rb"DETCHANS= *(\d+)", head)
+		self.fileName = dataFile
+		self.nChannels = int(match.group(1)) if match else 1501
+		self.energies = np.geomspace(0.2, 12.0, self.nChannels)
+		self.noticed = np.ones(self.nChannels, dtype=bool)
+		self.response = Response()
+		self.background = None
+		self.flux = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+		name = os.path.basename(os.path.dirname(os.path.abspath(dataFile))) + os.path.basename(dataFile)
+		self._truth = _truth(name, zlib.crc32(name.encode()))
+		AllData._spectra.append(self)
+		self.index = len(AllData._spectra)
+
+	def ignore(self, ranges):
+		self._apply(ranges, False)
+
+	def notice(self, ranges):
+		self._apply(ranges, True)
+
+	def _apply(self, ranges, value):
+		if ranges in ("bad",):
+			return
+		if ranges in ("all", "**"):
+			self.noticed[:] = value
+			return
+		for part in ranges.split(","):
+			lo, hi = part.split("-")
+			lo = self.energies[0] if lo.strip("*") == "" else float(lo)
+			hi = self.energies[-1] if hi.strip("*") == "" else float(hi)
+			self.noticed[(self.energies >= lo) & (self.energies <= hi)] = value
+
+	def _data(self):
+		"""
+		Noticed energies, counts-like data and errors; the source is a log-parabola.
+		"""
+		energy = self.energies[self.noticed]
+		truth = self._truth
+		expected = np.exp(-truth["nH"] * 2.0 * energy ** -2.6) * _photon_spectrum("logpar", truth, energy)
+		rng = np.random.default_rng(self.nChannels)
+		rel = 0.05 * (energy / energy[0]) ** 0.5
+		return energy, expected * (1 + rel * rng.standard_normal(len(energy))), expected * rel
+
+
+class Response:
+	def __init__(self):
+		self.arf = None
+		self.rmf = None
+
+
+class _AllData:
+	def __init__(self):
+		self._spectra = []
+		self.nGroups = 1
+
+	def __call__(self, arg):
+		if isinstance(arg, int):
+			return self._spectra[arg - 1]
+		# Data string "1:1 a.pha 1:2 b.pha" or a single file name
+		self.clear()
+		groups = set()
+		for token in arg.split():
+			if ":" in token:
+				groups.add(token.split(":")[0])
+				continue
+			Spectrum(token)
+		self.nGroups = max(1, len(groups))
+
+	@property
+	def nSpectra(self):
+		return len(self._spectra)
+
+	def clear(self):
+		self._spectra = []
+		self.nGroups = 1
+
+	def ignore(self, ranges):
+		for spec in self._spectra:
+			spec.ignore(ranges)
+
+	def notice(self, ranges):
+		for spec in self._spectra:
+			spec.notice(ranges)
+
+	def show(self):
+		pass
+
+
+class _AllModels:
+	def __init__(self):
+		self._models = []
+
+	def __call__(self, group=1):
+		return self._models[group - 1]
+
+	def clear(self):
+		self._models = []
+
+	def calcFlux(self, arg):
+		args = arg.split()
+		emin, emax = float(args[0]), float(args[1])
+		_wait("flux_err" if "err" in args else "flux")
+		model = self._models[0]
+		energy = np.geomspace(emin, emax, 200)
+		photons = model._photons(energy)
+		pflux = _trapz(photons, energy)
+		eflux = _trapz(photons * energy, energy) * ERG_PER_KEV
+		flux = (eflux, eflux * 0.97, eflux * 1.03, pflux, pflux * 0.97, pflux * 1.03)
+		for spec in AllData._spectra:
+			spec.flux = flux
+		model.flux = flux
+		text = f" Model Flux {pflux:9.6g} photons ({eflux:.4e} ergs/cm^2/s) range ({emin:.5f} - {emax:.3f} keV)\n"
+		if "err" in args:
+			text += f"     Error range  {flux[4]:.5g} - {flux[5]:.5g}    ({flux[1]:.4e} - {flux[2]:.4e})  (90.00% confidence)\n"
+		_log(text)
+
+
+class _Fit:
+	def __init__(self):
+		self.nIterations = 10
+		self.statMethod = "chi"
+		self.query = "on"
+		self.criticalDelta = 0.01
+		self.statistic = 0.0
+		self.testStatistic = 0.0
+		self.dof = 0
+		self.covariance = []
+
+	def _stat(self, model):
+		truth = AllData._spectra[0]._truth
+		dev = sum(((p.values[0] - truth[p.name]) / (0.05 * max(abs(truth[p.name]), 1e-3))) ** 2
+			for p in model._pars if not p.frozen)
+		return self.dof * (1.0 + 0.02 * np.log1p(dev)) + dev
+
+	def perform(self):
+		model = AllModels._models[0]
+		spec = AllData._spectra[0]
+		free = [p for p in model._pars if not p.frozen]
+		self.dof = int(spec.noticed.sum()) - len(free)
+		truth = spec._truth
+		last = self._stat(model)
+		for it in range(self.nIterations):
+			_wait("iteration")
+			for p in free:
+				p.values[0] = truth[p.name] + (p.values[0] - truth[p.name]) * 0.35
+			self.statistic = self._stat(model)
+			_log(f" {self.statistic:12.4f}      {it + 1:3d}   " + "  ".join(f"{p.values[0]:.6g}" for p in free) + "\n")
+			if abs(last - self.statistic) < self.criticalDelta:
+				break
+			last = self.statistic
+		self.testStatistic = self.statistic
+		for p in free:
+			p.sigma = 0.02 * max(abs(p.values[0]), 1e-3)
+		n = len(free)
+		cov = np.diag([p.sigma ** 2 for p in free])
+		self.covariance = [cov[i][j] for i in range(n) for j in range(i + 1)]
+
+	def show(self):
+		model = AllModels._models[0]
+		nbins = int(AllData._spectra[0].noticed.sum())
+		_log(model._show() + "\n\n"
+			f"Fit statistic  : Chi-Squared              {self.statistic:10.2f}     using {nbins} bins.\n\n"
+			f"Test statistic : Chi-Squared              {self.statistic:10.2f}     using {nbins} bins.\n"
+			f" Null hypothesis probability of 3.2100e-01 with {self.dof} degrees of freedom\n")
+
+	def error(self, arg):
+		model = AllModels._models[0]
+		for token in arg.split():
+			if token.isdigit():
+				_wait("error")
+				par = model(int(token))
+				par.error = (par.values[0] - 1.645 * par.sigma, par.values[0] + 1.645 * par.sigma, "FFFFFFFFF")
+
+
+class _Plot:
+	def __init__(self):
+		self.device = "/null"
+		self.xAxis = "keV"
+		self.xLog = False
+		self.yLog = False
+		self._last = None
+
+	def __call__(self, *commands):
+		_wait("plot_ps" if self.device.endswith("ps") else "plot")
+		self._last = commands[-1]
+		if self.device.endswith("ps"):
+			name = self.device.split("/")[0] if self.device.endswith("/cps") else self.device
+			with open(name, "w") as file:
+				file.write("%!PS-Adobe-2.0\n" + "0 0 moveto\n" * 20000)
+
+	def _arrays(self):
+		spec = AllData._spectra[0]
+		energy, data, err = spec._data()
+		model = AllModels._models[0]._photons(energy)
+		if self._last == "ratio":
+			return energy, data / model, err / model, np.ones_like(energy)
+		e2 = energy ** 2
+		return energy, data * e2, err * e2, model * e2
+
+	def x(self):
+		return list(self._arrays()[0])
+
+	def y(self):
+		return list(self._arrays()[1])
+
+	def yErr(self):
+		return list(self._arrays()[2])
+
+	def model(self):
+		return list(self._arrays()[3])
+
+
+class _Xset:
+	def __init__(self):
+		self.chatter = 10
+		self.logChatter = 10
+		self.log = None
+		self.allowPrompting = True
+		self._logfile = None
+
+	def openLog(self, fileName):
+		self.closeLog()
+		self._logfile = open(fileName, "w")
+		self.log = self._logfile
+		return self._logfile
+
+	def closeLog(self):
+		if self._logfile is not None:
+			self._logfile.close()
+		self._logfile = None
+		self.log = None
+
+	def save(self, fileName, info="a"):
+		model = AllModels._models[0] if AllModels._models else None
+		with open(fileName, "w") as file:
+			if info in ("a", "f") and AllData._spectra:
+				file.write(f"data 1:1 {AllData._spectra[0].fileName}\n")
+			if model is not None:
+				file.write(f"model  {model.expression}\n")
+				for par in model._pars:
+					file.write(f"{par.values[0]:.8g} {-1 if par.frozen else par.values[1]}\n")
+
+	def restore(self, fileName):
+		with open(fileName, "r") as file:
+			lines = [line.strip() for line in file if line.strip()]
+		model, values = None, []
+		for line in lines:
+			if line.startswith("data"):
+				AllData(line.split()[-1])
+			elif line.startswith("model"):
+				model = line.split(None, 1)[1]
+			else:
+				values.append(line.replace(" ", ","))
+		if model is not None:
+			Model(model).setPars(*values)
+
+
+AllData = _AllData()
+AllModels = _AllModels()
+Fit = _Fit()
+Plot = _Plot()
+Xset = _Xset()
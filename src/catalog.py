@@ -0,0 +1,147 @@
+"""
+Campaign-wide catalog of the fit results.
+
+All observations share one SQLite database with one row per (ObsID, Model, Parameter).
+The table is clustered on that key, so lookups by ObsID and model read only the
+matching rows, and updating an observation replaces just its own rows.
+Test statistics and fluxes are stored as the parameters Chi2, DOF, RedChi2 and Flux,
+with the flux error range in the Lower and Upper columns. Parameters have their
+confidence interval (ErrLow and ErrHigh of model_pm.csv) in Lower and Upper, if computed.
+
+command: `python catalog.py catalog.db [--add obslist.txt] [--obsid ID] [--model NAME] [--export FILE]`
+"""
+
+import os
+import sqlite3
+import argparse
+import pandas as pd
+
+COLUMNS = ["ObsID", "Path", "Model", "Parameter", "Value", "Error", "Lower", "Upper"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+	ObsID TEXT NOT NULL,
+	Path TEXT,
+	Model TEXT NOT NULL,
+	Parameter TEXT NOT NULL,
+	Value REAL,
+	Error REAL,
+	Lower REAL,
+	Upper REAL,
+	PRIMARY KEY (ObsID, Model, Parameter)
+) WITHOUT ROWID
+"""
+
+
+def obs_id(fpath):
+	"""
+	Returns the ObsID of an observation directory (its name).
+	"""
+	return os.path.basename(os.path.normpath(fpath))
+
+def connect(db):
+	"""
+	Opens the catalog database, creating the table if needed.
+	"""
+	con = sqlite3.connect(db, timeout=60)
+	con.execute(SCHEMA)
+	return con
+
+def _num(val):
+	val = pd.to_numeric(val, errors="coerce")
+	return None if pd.isna(val) else float(val)
+
+def catalog_rows(fpath, mdf, tdf, fdf):
+	"""
+	Converts the parameter, test statistics and flux tables of read_log.py into catalog rows.
+	Returns:
+		list: Tuples in the order of COLUMNS.
+	"""
+	oid = obs_id(fpath)
+	rows = []
+	for _, r in mdf.iterrows():
+		rows.append((oid, fpath, str(r["Model"]), r["Parameter"], _num(r["Value"]), _num(r["Error"]),
+			_num(r.get("ErrLow")), _num(r.get("ErrHigh"))))
+	for _, r in tdf.iterrows():
+		for col in ["Chi2", "DOF", "RedChi2"]:
+			rows.append((oid, fpath, str(r["Model"]), col, _num(r[col]), None, None, None))
+	for _, r in fdf.iterrows():
+		rows.append((oid, fpath, str(r["Model"]), "Flux", _num(r["Flux"]), None, _num(r["Flux_Err_Min"]), _num(r["Flux_Err_Max"])))
+	return rows
+
+def update_catalog(db, fpath, mdf, tdf, fdf):
+	"""
+	Replaces the rows of one observation in the catalog in a single transaction.
+	"""
+	rows = catalog_rows(fpath, mdf, tdf, fdf)
+	con = connect(db)
+	try:
+		with con:
+			con.execute("DELETE FROM results WHERE ObsID = ?", (obs_id(fpath),))
+			con.executemany(f"INSERT INTO results VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+	finally:
+		con.close()
+	return
+
+def add_obs(db, fpath):
+	"""
+	Adds an observation to the catalog from the CSV tables written by read_log.py.
+	"""
+	mdf = pd.read_csv(os.path.join(fpath, "model_pm.csv"))
+	tdf = pd.read_csv(os.path.join(fpath, "model_ts.csv"))
+	fdf = pd.read_csv(os.path.join(fpath, "model_fx.csv"))
+	update_catalog(db, fpath, mdf, tdf, fdf)
+	return
+
+def load_catalog(db, obsid=None, model=None):
+	"""
+	Reads catalog rows, optionally restricted to one ObsID and/or model.
+	Returns:
+		pd.DataFrame: The selected rows.
+	"""
+	query = "SELECT * FROM results"
+	conds, params = [], []
+	if obsid is not None:
+		conds.append("ObsID = ?")
+		params.append(str(obsid))
+	if model is not None:
+		conds.append("Model = ?")
+		params.append(model)
+	if conds:
+		query += " WHERE " + " AND ".join(conds)
+
+	con = connect(db)
+	try:
+		df = pd.read_sql_query(query, con, params=params)
+	finally:
+		con.close()
+	return df
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Query or extend the campaign results catalog.")
+	parser.add_argument("db", type=str, help="Path to the catalog database")
+	parser.add_argument("--add", type=str, help="Text file with observation paths whose model_*.csv tables are added")
+	parser.add_argument("--obsid", type=str, help="Select one ObsID")
+	parser.add_argument("--model", type=str, help="Select one model")
+	parser.add_argument("--export", type=str, help="Write the selection to a .csv or .parquet file")
+	args = parser.parse_args()
+
+	if args.add:
+		with open(args.add, 'r') as file:
+			file_paths = [line.strip() for line in file if line.strip()]
+		for fpath in file_paths:
+			try:
+				add_obs(args.db, fpath)
+			except Exception as e:
+				print(f"> Error: {fpath}:: {e}")
+				continue
+
+	df = load_catalog(args.db, obsid=args.obsid, model=args.model)
+	if args.export:
+		if args.export.endswith(".parquet"):
+			df.to_parquet(args.export, index=False)
+		else:
+			df.to_csv(args.export, index=False)
+		print(f">>> Wrote {len(df)} rows to {args.export}")
+	else:
+		print(df)
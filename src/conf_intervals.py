@@ -0,0 +1,233 @@
+"""
+Confidence intervals of the free fit parameters with Fit.error, spread over worker processes.
+
+run_xspec.py --save-state saves the best-fit state of every model ({model}_model.xcm, data and model).
+Every model of every observation is one task: a worker restores the saved state once and
+runs the Xspec error command on each free parameter in turn, so the slow error searches of
+different fits run in parallel without restoring a fit for every parameter.
+The intervals are written to {model}_conf.json next to the fit record, which the result
+cache of run_xspec.py does not restore over, and to model_pm.csv as the ErrLow and ErrHigh
+columns. The file holds the hash of the fit record it was computed for; the intervals of a
+fit that was redone since are ignored.
+
+command: `python conf_intervals.py obslist.txt --workers 8 [--models powerlaw logpar] [--delta 2.706]`
+"""
+
+import os
+import json
+import argparse
+import functools
+import traceback
+import multiprocessing
+import pandas as pd
+from model_registry import load_registry
+from result_cache import hash_file
+
+REGISTRY = load_registry()
+MODELS = list(REGISTRY)
+CONF_DELTA = 2.706  # delta fit statistic of a 90% interval for one parameter
+ERROR_LOG = "failed_conf.txt"
+
+# Fit restored in this process, set by restore_fit()
+_state = {"key": None}
+
+
+def log_error(errmsg, cpath):
+	with open(f"{cpath}/{ERROR_LOG}", "a") as file:
+		file.write(errmsg)
+	return
+
+def read_intervals(path, mname):
+	"""
+	Returns the intervals of a model computed for its current fit record.
+	Returns:
+		Dict: {parameter: [lower, upper]}, empty if there are none or the model was fitted again since.
+	"""
+	try:
+		with open(os.path.join(path, f"{mname}_conf.json"), "r") as file:
+			conf = json.load(file)
+		if conf["fit"] != hash_file(os.path.join(path, f"{mname}_fit.json")):
+			return {}
+		return conf["parameters"]
+	except (OSError, ValueError, KeyError):
+		return {}
+
+def free_parameters(path, mname):
+	"""
+	Returns the free parameters of a model from its fit record (those with an error).
+	"""
+	if not os.path.exists(os.path.join(path, f"{mname}_model.xcm")):
+		raise FileNotFoundError(f"no saved {mname} fit state, run run_xspec.py with --save-state")
+	with open(os.path.join(path, f"{mname}_fit.json"), "r") as file:
+		rec = json.load(file)
+	return [pname for pname, val in rec["parameters"].items() if val.get("error") is not None]
+
+def init_worker():
+	"""
+	Pool initializer: imports PyXspec once per worker and silences its terminal output.
+	"""
+	from xspec import Xset
+	Xset.chatter = 0
+	Xset.allowPrompting = False
+	return
+
+def restore_fit(path, mname):
+	"""
+	Restores the saved best fit of a model unless it is already the current one.
+	"""
+	from xspec import AllData, AllModels, Xset, Fit
+	if _state["key"] == (path, mname):
+		return AllModels(1)
+	_state["key"] = None
+	# The saved data paths are relative to the observation directory
+	os.chdir(path)
+	AllData.clear()
+	AllModels.clear()
+	Xset.restore(f"{mname}_model.xcm")
+	Fit.query = "no"
+	# The error command needs a fit in this session; from the saved best fit it converges at once
+	Fit.perform()
+	_state["key"] = (path, mname)
+	return AllModels(1)
+
+def param_interval(task, delta=CONF_DELTA):
+	"""
+	Confidence interval of one parameter of a fitted model.
+	Args:
+		task (tuple): (observation path, model name, parameter name)
+	Returns:
+		Dict: The task with lower and upper bound and the Xspec status flags, or the error.
+	"""
+	from xspec import Fit
+	path, mname, pname = task
+	res = {"path": path, "model": mname, "parameter": pname}
+	try:
+		par = getattr(getattr(restore_fit(path, mname), REGISTRY[mname]["component"]), pname)
+		Fit.error(f"{delta} {par.index}")
+		low, high, flags = par.error
+		res.update(ok=True, low=low, high=high, flags=flags)
+		if flags[0] == "T":
+			# A new minimum was found, the other parameters need the saved state again
+			_state["key"] = None
+	except Exception as e:
+		_state["key"] = None
+		res.update(ok=False, error=str(e), traceback=traceback.format_exc())
+	return res
+
+def fit_intervals(task, delta=CONF_DELTA):
+	"""
+	Pool task: confidence intervals of the free parameters of one fitted model.
+	Args:
+		task (tuple): (observation path, model name, parameter names)
+	Returns:
+		list: The results of param_interval() for each parameter.
+	"""
+	path, mname, pnames = task
+	return [param_interval((path, mname, pname), delta) for pname in pnames]
+
+def merge_intervals(path, mname, results, delta=CONF_DELTA):
+	"""
+	Writes the intervals of one model to its {model}_conf.json.
+	"""
+	conf = {"fit": hash_file(os.path.join(path, f"{mname}_fit.json")), "delta": delta, "parameters": {}}
+	for res in results:
+		conf["parameters"][res["parameter"]] = [res["low"], res["high"]]
+		if res["flags"][0] == "T":
+			print(f"> Warning: {path} {mname}.{res['parameter']}: new minimum found during the error search.")
+	cfile = os.path.join(path, f"{mname}_conf.json")
+	tmp = f"{cfile}.tmp"
+	with open(tmp, "w") as file:
+		json.dump(conf, file)
+	os.replace(tmp, cfile)
+	return
+
+def merge_table(path):
+	"""
+	Adds the intervals of the models to model_pm.csv, if read_log.py already wrote it.
+	"""
+	tfile = os.path.join(path, "model_pm.csv")
+	if not os.path.exists(tfile):
+		return
+	mdf = pd.read_csv(tfile)
+	low, high = [], []
+	intervals = {}
+	for mname, pname in zip(mdf["Model"], mdf["Parameter"]):
+		if mname not in intervals:
+			intervals[mname] = read_intervals(path, mname)
+		conf = intervals[mname].get(pname) or [None, None]
+		low.append(conf[0])
+		high.append(conf[1])
+	if all(val is None for val in low + high):
+		return
+	mdf["ErrLow"] = low
+	mdf["ErrHigh"] = high
+	mdf.to_csv(tfile, index=False)
+	return
+
+def run_intervals(file_paths, cd_path, models=MODELS, workers=1, delta=CONF_DELTA):
+	"""
+	Computes the intervals of all free parameters of the models of all observations.
+	The results of a model are merged as soon as all its parameters are done.
+	Returns:
+		int: Number of failed parameters.
+	"""
+	tasks, remaining, counts = [], {}, {}
+	for fpath in file_paths:
+		for mname in models:
+			try:
+				pnames = free_parameters(fpath, mname)
+			except (OSError, ValueError, KeyError) as e:
+				log_error(f">>> {fpath}:: {mname}: {e}\n\n", cd_path)
+				print(f"> Error: {fpath}: {mname}: {e}")
+				continue
+			tasks.append((fpath, mname, pnames))
+			remaining[(fpath, mname)] = []
+			counts[(fpath, mname)] = len(pnames)
+
+	def collect(results):
+		nfailed = 0
+		for res in results:
+			key = (res["path"], res["model"])
+			if not res["ok"]:
+				nfailed += 1
+				log_error(f">>> {key[0]}:: {key[1]}.{res['parameter']}: {res['error']}\n{res['traceback']}\n\n", cd_path)
+				print(f"> Error: {key[0]} {key[1]}.{res['parameter']}: {res['error']}")
+				remaining.pop(key, None)
+				continue
+			if key not in remaining:
+				# Another parameter of this model failed, the record is left as it is
+				continue
+			remaining[key].append(res)
+			if len(remaining[key]) == counts[key]:
+				merge_intervals(key[0], key[1], remaining.pop(key), delta)
+				merge_table(key[0])
+				print(f">>> {key[0]}: {key[1]} intervals done")
+		return nfailed
+
+	task = functools.partial(fit_intervals, delta=delta)
+	if workers > 1:
+		ctx = multiprocessing.get_context("spawn")
+		with ctx.Pool(processes=workers, initializer=init_worker) as pool:
+			# All parameters of a fit go to the worker that restored it
+			nfailed = collect(res for results in pool.imap_unordered(task, tasks, chunksize=1) for res in results)
+	else:
+		init_worker()
+		nfailed = collect(res for results in map(task, tasks) for res in results)
+	os.chdir(cd_path)
+	return nfailed
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Confidence intervals of the fit parameters of the observations listed in a text file.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS, help="Models to use (default: %(default)s)")
+	parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own Xspec session (default: 1)")
+	parser.add_argument("--delta", type=float, default=CONF_DELTA, help="Delta fit statistic of the interval (default: %(default)s, 90%% for one parameter)")
+	args = parser.parse_args()
+
+	cd_path = os.getcwd()
+	with open(args.ip_path, 'r') as file:
+		file_paths = [os.path.abspath(line.strip()) for line in file if line.strip()]
+
+	nfailed = run_intervals(file_paths, cd_path, args.models, args.workers, args.delta)
+	print(f"\n>>> Finished {len(file_paths)} observations, {nfailed} parameters failed.")
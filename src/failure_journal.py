@@ -0,0 +1,217 @@
+"""
+Structured journal of the failed observations of the pipeline scripts.
+
+Every failure appends one JSON line to the journal (default failures.jsonl) with the
+ObsID, the stage (fit, slices, read or plot), the model when known, the exception class,
+whether the failure is worth retrying and the attempt number. An observation that later
+succeeds gets a "resolved" line. Worker processes append to the same file, every line is
+written with a single call as in metrics.py.
+
+Transient failures (I/O errors of shared filesystems, timeouts, crashed fit processes,
+locked databases) are retryable; missing files and fit or parsing errors are permanent.
+`--retry-failed` runs only the observations of the list with an open retryable failure
+of that stage and fewer than --max-attempts attempts.
+
+command: `python failure_journal.py failures.jsonl [--stage fit]` - open failures per stage and class
+"""
+
+import os
+import json
+import time
+import errno
+import sqlite3
+import argparse
+import pandas as pd
+
+JOURNAL_FILE = "failures.jsonl"
+MAX_ATTEMPTS = 3
+STAGES = ["fit", "slices", "read", "plot"]
+
+# Transient conditions of shared filesystems and busy nodes
+RETRYABLE_ERRNOS = {errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.ETIMEDOUT, errno.ESTALE,
+	errno.ENOSPC, errno.EMFILE, errno.ENFILE, errno.ENOLCK, errno.ENOMEM, errno.ECONNRESET}
+RETRYABLE_ERRORS = (TimeoutError, ConnectionError, InterruptedError, BlockingIOError, MemoryError)
+
+
+def is_retryable(exc):
+	"""
+	Returns True if an exception is a transient failure that another attempt may not hit.
+	"""
+	if isinstance(exc, RETRYABLE_ERRORS):
+		return True
+	if isinstance(exc, sqlite3.OperationalError):
+		return "locked" in str(exc) or "busy" in str(exc)
+	if isinstance(exc, OSError):
+		return exc.errno in RETRYABLE_ERRNOS
+	return False
+
+def load_journal(path):
+	"""
+	Reads the journal entries in file order, skipping incomplete lines.
+	"""
+	entries = []
+	if not os.path.exists(path):
+		return entries
+	with open(path, "r") as file:
+		for line in file:
+			try:
+				entries.append(json.loads(line))
+			except ValueError:
+				continue
+	return entries
+
+def open_failures(entries, stage=None):
+	"""
+	Returns the failures not resolved since, one per observation and stage.
+	Entries of the same attempt are merged: the observation is retryable only if all of them are.
+	Returns:
+		Dict: {(path, stage): latest entry}, with "models" listing the failed models of the attempt.
+	"""
+	failures = {}
+	for entry in entries:
+		if stage is not None and entry.get("stage") != stage:
+			continue
+		key = (entry.get("path"), entry.get("stage"))
+		if entry.get("resolved"):
+			failures.pop(key, None)
+			continue
+		prev = failures.get(key)
+		models = [entry["model"]] if entry.get("model") else []
+		if prev is not None and prev["attempt"] == entry.get("attempt"):
+			entry = {**entry, "retryable": prev["retryable"] and entry.get("retryable", False)}
+			models = prev["models"] + [m for m in models if m not in prev["models"]]
+		failures[key] = {**entry, "models": models}
+	return failures
+
+
+class FailureJournal:
+	"""
+	Journal writer of one stage. The open failures of the stage are read once when it is
+	created; they give the attempt number of new failures and the observations to resolve.
+	The journal file is only created by the first failure.
+	Args:
+		path (str): Journal file.
+		stage (str): Stage of the script, see STAGES.
+	"""
+	def __init__(self, path, stage):
+		self.path = os.path.abspath(path)
+		self.stage = stage
+		self.failures = {key[0]: entry for key, entry in open_failures(load_journal(self.path), stage).items()}
+
+	def write(self, entry):
+		"""
+		Appends one entry to the journal.
+		"""
+		line = json.dumps(entry) + "\n"
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, line.encode())
+		finally:
+			os.close(fd)
+		return
+
+	def record(self, fpath, exc=None, model=None, error=None, message=None, retryable=None):
+		"""
+		Appends a failure of an observation.
+		Args:
+			exc (Exception): The exception, giving the error class, message and classification.
+			error (str): Error class when there is no exception (e.g. "Timeout").
+			retryable (bool): Overrides the classification of the exception.
+		"""
+		fpath = os.path.abspath(fpath)
+		prev = self.failures.get(fpath)
+		self.write({"time": round(time.time(), 3), "obsid": os.path.basename(os.path.normpath(fpath)), "path": fpath,
+			"stage": self.stage, "model": model, "error": error or type(exc).__name__,
+			"message": message if message is not None else str(exc),
+			"retryable": retryable if retryable is not None else is_retryable(exc),
+			"attempt": prev["attempt"] + 1 if prev else 1})
+		return
+
+	def resolve(self, fpath):
+		"""
+		Marks the open failure of an observation as resolved after a successful run.
+		"""
+		fpath = os.path.abspath(fpath)
+		if self.failures.pop(fpath, None) is None:
+			return
+		self.write({"time": round(time.time(), 3), "obsid": os.path.basename(os.path.normpath(fpath)), "path": fpath,
+			"stage": self.stage, "resolved": True})
+		return
+
+	def retry_paths(self, file_paths, max_attempts=MAX_ATTEMPTS):
+		"""
+		Selects the observations of a list with an open retryable failure below max_attempts attempts.
+		Returns:
+			tuple: (paths to retry in list order, number of open failures held back)
+		"""
+		retry = [fpath for fpath in file_paths if self._retry(os.path.abspath(fpath), max_attempts)]
+		listed = {os.path.abspath(fpath) for fpath in file_paths}
+		held = sum(1 for fpath in self.failures if fpath in listed) - len(retry)
+		return retry, held
+
+	def _retry(self, fpath, max_attempts):
+		entry = self.failures.get(fpath)
+		return entry is not None and entry["retryable"] and entry["attempt"] < max_attempts
+
+
+def record_failure(journal, fpath, exc=None, **kwargs):
+	"""
+	Calls journal.record(), or does nothing when journal is None.
+	"""
+	if journal is not None:
+		journal.record(fpath, exc, **kwargs)
+	return
+
+def resolve_failure(journal, fpath):
+	"""
+	Calls journal.resolve(), or does nothing when journal is None.
+	"""
+	if journal is not None:
+		journal.resolve(fpath)
+	return
+
+def add_journal_args(parser):
+	"""
+	Adds the failure journal options shared by the pipeline scripts to an argument parser.
+	"""
+	parser.add_argument("--journal", type=str, default=JOURNAL_FILE, help="Failure journal, one JSON line per failure (default: %(default)s)")
+	parser.add_argument("--retry-failed", action="store_true", help="Run only the observations of the list with retryable failures in the journal")
+	parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="Attempts of an observation before it is no longer retried (default: %(default)s)")
+	return
+
+def journal_from_args(args, stage):
+	"""
+	Returns the FailureJournal of a stage selected by the command line options.
+	"""
+	return FailureJournal(args.journal, stage)
+
+def retry_from_args(args, journal, file_paths):
+	"""
+	Returns the observations to run: all of the list, or with --retry-failed the retryable ones.
+	"""
+	if not args.retry_failed:
+		return file_paths
+	retry, held = journal.retry_paths(file_paths, args.max_attempts)
+	print(f">>> Retrying {len(retry)} observations with {journal.stage} failures; {held} held back (permanent or {args.max_attempts} attempts)")
+	return retry
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Summarize the open failures of a failure journal.")
+	parser.add_argument("path", type=str, help="Failure journal (JSONL)")
+	parser.add_argument("--stage", choices=STAGES, default=None, help="Only this stage")
+	parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="Attempts counted as exhausted (default: %(default)s)")
+	args = parser.parse_args()
+
+	failures = open_failures(load_journal(args.path), args.stage)
+	if not failures:
+		print("No open failures.")
+		raise SystemExit(0)
+	df = pd.DataFrame(failures.values())
+	df["class"] = "permanent"
+	df.loc[df["retryable"], "class"] = "retryable"
+	df.loc[df["retryable"] & (df["attempt"] >= args.max_attempts), "class"] = "exhausted"
+	pd.set_option("display.width", 200)
+	print(df.groupby(["stage", "class", "error"]).size().rename("observations").to_string())
+	print()
+	print(df[["obsid", "stage", "models", "error", "attempt", "class", "message"]].to_string(index=False, max_colwidth=60))
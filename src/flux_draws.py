@@ -0,0 +1,190 @@
+"""
+Band fluxes and their confidence ranges from the fit covariance, without Xspec.
+
+run_xspec.py stores the covariance matrix of the free parameters in each fit record.
+Parameter sets are drawn from the multivariate normal of every observation (one
+batched factorization for all observations of a model) and the absorbed
+energy flux of each draw is integrated with model_eval.py in every requested band.
+The confidence range is the central interval of the drawn fluxes, like the "err"
+option of calcFlux. A new band therefore only needs the stored records, not a refit.
+
+command: `python flux_draws.py obslist.txt --model powerlaw --bands 0.4-10 2-10 --ndraw 1000 --out fluxes.csv`
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from model_eval import photon_spectrum, MODEL_PARAMS
+
+ERG_PER_KEV = 1.602176634e-9
+N_DRAWS = 1000
+CONF_LEVEL = 90.0
+N_ENERGIES = 200  # integration points per band
+MAX_VALUES = 2 * 10**7  # floats evaluated at once, caps the memory of a batch
+
+# np.trapz was renamed in NumPy 2.0
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+def parse_band(text):
+	"""
+	Converts "emin-emax" (keV) to a tuple of floats.
+	"""
+	emin, emax = (float(v) for v in text.split("-"))
+	if not 0 < emin < emax:
+		raise ValueError(f"Invalid energy band: {text}")
+	return emin, emax
+
+def record_params(rec, mname):
+	"""
+	Returns the best-fit parameters of a record and the covariance of its free parameters.
+	Returns:
+		tuple: ({parameter: value}, free parameter names, covariance matrix)
+	"""
+	params = {p: v["value"] for p, v in rec["parameters"].items()}
+	cov = rec.get("covariance")
+	if not cov:
+		raise ValueError(f"No covariance in the {mname} fit record.")
+	names = [name.split(".")[-1] for name in cov["parameters"]]
+	return params, names, np.array(cov["matrix"], dtype=float)
+
+def factor_covariances(covs):
+	"""
+	Factors covariance matrices as L L^T, all observations at once. Matrices that are not
+	positive definite (round-off, parameters pegged at a limit) get their negative
+	eigenvalues clipped to zero instead of failing the whole batch.
+	Args:
+		covs (np.ndarray): Covariance matrices, shape (N, k, k).
+	Returns:
+		tuple: (factors of shape (N, k, k), mask of shape (N,) of the usable matrices)
+	"""
+	covs = 0.5 * (covs + np.swapaxes(covs, -1, -2))
+	usable = np.isfinite(covs).all(axis=(-2, -1))
+	evals, evecs = np.linalg.eigh(np.where(usable[:, None, None], covs, 0.0))
+	return evecs * np.sqrt(np.clip(evals, 0.0, None))[:, None, :], usable
+
+def draw_params(means, covs, ndraw=N_DRAWS, rng=None):
+	"""
+	Draws parameter sets from multivariate normals, all observations at once.
+	Args:
+		means (np.ndarray): Best-fit values, shape (N, k).
+		covs (np.ndarray): Covariance matrices, shape (N, k, k).
+		ndraw (int): Number of draws per observation.
+	Returns:
+		np.ndarray: Draws of shape (N, ndraw, k), NaN for observations without a usable covariance.
+	"""
+	rng = rng or np.random.default_rng()
+	factors, usable = factor_covariances(covs)
+	z = rng.standard_normal((means.shape[0], ndraw, means.shape[1]))
+	draws = means[:, None, :] + np.einsum("nij,nsj->nsi", factors, z)
+	draws[~usable] = np.nan
+	return draws
+
+def band_flux(mname, params, band, nH=None, nenergy=N_ENERGIES):
+	"""
+	Absorbed energy flux in erg/cm^2/s of a model in one band, for parameter arrays of any shape.
+	"""
+	energy = np.geomspace(band[0], band[1], nenergy)
+	spectrum = photon_spectrum(mname, energy, params, nH) * energy
+	return _trapezoid(spectrum, energy, axis=-1) * ERG_PER_KEV
+
+def flux_ranges(mname, best, names, means, covs, bands, ndraw=N_DRAWS, conf=CONF_LEVEL, rng=None):
+	"""
+	Computes the flux and its confidence range in every band for a batch of observations.
+	Args:
+		mname (str): Model name.
+		best (dict): Best-fit value arrays of all parameters, shape (N,) each.
+		names (list): Free parameter names, the order of the covariance.
+		means (np.ndarray): Best-fit values of the free parameters, shape (N, k).
+		covs (np.ndarray): Covariances, shape (N, k, k).
+		bands (list): (emin, emax) tuples in keV.
+	Returns:
+		Dict: {band: (flux, lower, upper)} with arrays of shape (N,), NaN ranges for unusable covariances.
+	"""
+	rng = rng or np.random.default_rng()
+	out = {band: (np.empty(len(means)), np.empty(len(means)), np.empty(len(means))) for band in bands}
+	step = max(1, MAX_VALUES // (ndraw * N_ENERGIES))
+	tail = (100.0 - conf) / 2
+	for start in range(0, len(means), step):
+		sl = slice(start, start + step)
+		draws = draw_params(means[sl], covs[sl], ndraw, rng)
+		params = {p: np.broadcast_to(np.asarray(v[sl])[:, None], draws.shape[:2]) for p, v in best.items()}
+		params.update({p: draws[..., i] for i, p in enumerate(names)})
+		point = {p: np.asarray(v[sl]) for p, v in best.items()}
+		for band in bands:
+			fluxes = band_flux(mname, params, band)
+			out[band][0][sl] = band_flux(mname, point, band)
+			out[band][1][sl], out[band][2][sl] = np.percentile(fluxes, [tail, 100.0 - tail], axis=1)
+	return out
+
+def record_flux_range(rec, mname, band, ndraw=N_DRAWS, conf=CONF_LEVEL):
+	"""
+	Flux and confidence range of one fit record in one band.
+	Returns:
+		tuple: (flux, lower, upper) in erg/cm^2/s.
+	"""
+	params, names, cov = record_params(rec, mname)
+	best = {p: np.array([v]) for p, v in params.items() if p in MODEL_PARAMS[mname]}
+	means = np.array([[params[p] for p in names]])
+	res = flux_ranges(mname, best, names, means, cov[None], [band], ndraw, conf)[band]
+	return tuple(float(v[0]) for v in res)
+
+def load_records(paths, mname):
+	"""
+	Reads the fit records of a model that have a covariance, grouped by their free parameters.
+	Returns:
+		Dict: {free parameter names: [(path, record), ...]}
+	"""
+	groups = {}
+	for fpath in paths:
+		try:
+			with open(os.path.join(fpath, f"{mname}_fit.json"), "r") as file:
+				rec = json.load(file)
+			_, names, _ = record_params(rec, mname)
+		except (OSError, ValueError, KeyError) as e:
+			print(f"> Warning: {fpath}: {e}")
+			continue
+		groups.setdefault(tuple(names), []).append((fpath, rec))
+	return groups
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Band fluxes with confidence ranges from the stored fit covariances.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--model", choices=list(MODEL_PARAMS), required=True, help="Model to use")
+	parser.add_argument("--bands", nargs="+", default=["0.4-10"], help="Energy bands in keV as emin-emax (default: %(default)s)")
+	parser.add_argument("--ndraw", type=int, default=N_DRAWS, help="Draws per observation (default: %(default)s)")
+	parser.add_argument("--conf", type=float, default=CONF_LEVEL, help="Confidence level in percent (default: %(default)s)")
+	parser.add_argument("--seed", type=int, default=None, help="Seed of the random draws")
+	parser.add_argument("--out", type=str, default="fluxes.csv", help="Output CSV file (default: %(default)s)")
+	args = parser.parse_args()
+
+	with open(args.ip_path, 'r') as file:
+		file_paths = [line.strip() for line in file if line.strip()]
+	bands = [parse_band(b) for b in args.bands]
+	rng = np.random.default_rng(args.seed)
+
+	rows = []
+	for names, items in load_records(file_paths, args.model).items():
+		recs = [rec for _, rec in items]
+		try:
+			best = {p: np.array([rec["parameters"][p]["value"] for rec in recs], dtype=float)
+				for p in MODEL_PARAMS[args.model] if p in recs[0]["parameters"]}
+			means = np.array([[rec["parameters"][p]["value"] for p in names] for rec in recs], dtype=float)
+			covs = np.array([rec["covariance"]["matrix"] for rec in recs], dtype=float)
+			res = flux_ranges(args.model, best, list(names), means, covs, bands, args.ndraw, args.conf, rng)
+		except Exception as e:
+			print(f"> Error: {len(items)} observations with free parameters {', '.join(names)}: {e}")
+			continue
+		for i, (fpath, _) in enumerate(items):
+			if np.isnan(res[bands[0]][1][i]):
+				print(f"> Warning: {fpath}: covariance is not finite, the flux range is NaN.")
+			for band in bands:
+				flux, low, high = (v[i] for v in res[band])
+				rows.append([os.path.basename(os.path.normpath(fpath)), fpath, args.model, f"{band[0]:g}-{band[1]:g}", flux, low, high])
+
+	df = pd.DataFrame(rows, columns=["ObsID", "Path", "Model", "Band", "Flux", "Flux_Err_Min", "Flux_Err_Max"])
+	df.to_csv(args.out, index=False)
+	print(f">>> Wrote {len(df)} band fluxes of {df['ObsID'].nunique()} observations to {args.out}")
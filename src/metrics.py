@@ -0,0 +1,189 @@
+"""
+Opt-in timing and resource instrumentation of the pipeline scripts.
+
+Each measured stage appends one JSON line to the metrics file with its wall time,
+CPU time and the peak RSS of the process so far, labelled with the script, the
+observation and the model. Worker processes append to the same file, every record
+is written with a single call so lines from different processes do not mix.
+A summary of a metrics file gives the percentiles per stage and the slowest observations.
+
+command: `python metrics.py metrics.jsonl [--top N]`
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import resource
+import argparse
+import contextlib
+import pandas as pd
+
+PERCENTILES = [0.5, 0.9, 0.99]
+
+
+def obs_label(fpath):
+	"""
+	Returns the ObsID of an observation directory (its name).
+	"""
+	return os.path.basename(os.path.normpath(fpath)) if fpath else None
+
+def peak_rss_mb():
+	"""
+	Returns the peak resident set size of the current process in MB.
+	"""
+	# ru_maxrss is in kB on Linux and in bytes on macOS
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class Metrics:
+	"""
+	Writer of stage records to a JSONL file, with an optional cProfile hook for one observation.
+	Args:
+		path (str): Metrics file, or None to only profile.
+		script (str): Name of the script, stored in every record.
+		profile (str): ObsID of the observation to run under cProfile.
+		profile_dir (str): Directory of the profile files (default: next to the metrics file).
+	"""
+	def __init__(self, path, script, profile=None, profile_dir=None):
+		self.path = os.path.abspath(path) if path else None
+		self.script = script
+		self.profile = profile
+		self.profile_dir = os.path.abspath(profile_dir or (os.path.dirname(self.path) if self.path else os.getcwd()))
+
+	def write(self, record):
+		"""
+		Appends one record to the metrics file.
+		"""
+		if self.path is None:
+			return
+		line = json.dumps(record) + "\n"
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, line.encode())
+		finally:
+			os.close(fd)
+		return
+
+	@contextlib.contextmanager
+	def stage(self, name, obs=None, model=None):
+		"""
+		Measures the enclosed block and writes it as a record of stage name.
+		A block that raises is recorded with ok=false before the exception propagates.
+		"""
+		ok = False
+		t0, c0 = time.perf_counter(), time.process_time()
+		try:
+			yield
+			ok = True
+		finally:
+			self.write({"script": self.script, "stage": name, "obs": obs_label(obs), "model": model,
+				"wall": round(time.perf_counter() - t0, 6), "cpu": round(time.process_time() - c0, 6),
+				"rss_mb": round(peak_rss_mb(), 1), "ok": ok, "pid": os.getpid(), "host": socket.gethostname(),
+				"time": round(time.time(), 3)})
+
+	@contextlib.contextmanager
+	def profiling(self, fpath):
+		"""
+		Runs the enclosed block under cProfile when fpath is the profiled observation.
+		The statistics are saved as {ObsID}_{script}.prof, readable with pstats or snakeviz.
+		"""
+		if self.profile is None or obs_label(fpath) != self.profile:
+			yield
+			return
+		prof = cProfile.Profile()
+		prof.enable()
+		try:
+			yield
+		finally:
+			prof.disable()
+			pfile = os.path.join(self.profile_dir, f"{self.profile}_{self.script}.prof")
+			prof.dump_stats(pfile)
+			print(f"> Profile of {self.profile} written to {pfile}")
+
+
+def stage(metrics, name, obs=None, model=None):
+	"""
+	Returns metrics.stage(), or a context that does nothing when metrics is None.
+	"""
+	if metrics is None:
+		return contextlib.nullcontext()
+	return metrics.stage(name, obs, model)
+
+def profiling(metrics, fpath):
+	"""
+	Returns metrics.profiling(), or a context that does nothing when metrics is None.
+	"""
+	if metrics is None:
+		return contextlib.nullcontext()
+	return metrics.profiling(fpath)
+
+def add_metrics_args(parser):
+	"""
+	Adds the instrumentation options shared by the pipeline scripts to an argument parser.
+	"""
+	parser.add_argument("--metrics", type=str, default=None, help="Append per-stage timing and memory records to this JSONL file")
+	parser.add_argument("--profile", type=str, default=None, metavar="OBSID", help="Run this observation under cProfile")
+	return
+
+def metrics_from_args(args, script):
+	"""
+	Returns the Metrics selected by the command line options, or None when disabled.
+	"""
+	if args.metrics is None and args.profile is None:
+		return None
+	return Metrics(args.metrics, script, profile=args.profile)
+
+
+def load_metrics(path):
+	"""
+	Reads a metrics file into a DataFrame, skipping incomplete lines.
+	"""
+	records = []
+	with open(path, "r") as file:
+		for line in file:
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				continue
+	return pd.DataFrame(records)
+
+def summarize(df, top=10):
+	"""
+	Aggregates stage records.
+	Returns:
+		tuple: (percentiles of wall time, CPU time and peak RSS per script and stage,
+			slowest observations by their total wall time per script)
+	"""
+	grouped = df.groupby(["script", "stage"], sort=False)
+	stats = grouped["wall"].describe(percentiles=PERCENTILES)
+	stats = stats.drop(columns=["mean", "std", "min", "25%", "75%"], errors="ignore")
+	stats["total"] = grouped["wall"].sum()
+	stats["cpu"] = grouped["cpu"].sum()
+	stats["rss_mb"] = grouped["rss_mb"].max()
+	stats["failed"] = grouped["ok"].apply(lambda s: int((~s.astype(bool)).sum()))
+	stats["count"] = stats["count"].astype(int)
+
+	obs = df[df["stage"] == "observation"]
+	slowest = obs.sort_values("wall", ascending=False).head(top)[["script", "obs", "wall", "cpu", "rss_mb", "ok"]]
+	return stats.round(4), slowest.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Summarize a metrics file written with --metrics.")
+	parser.add_argument("path", type=str, help="Metrics JSONL file")
+	parser.add_argument("--top", type=int, default=10, help="Number of slowest observations to list (default: %(default)s)")
+	args = parser.parse_args()
+
+	df = load_metrics(args.path)
+	if df.empty:
+		print(f"> Error: No records in {args.path}")
+		sys.exit(1)
+
+	stats, slowest = summarize(df, args.top)
+	with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+		print(f"\nWall time per stage (s), {len(df)} records:\n{stats}\n")
+		print(f"Slowest observations:\n{slowest}\n")
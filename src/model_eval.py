@@ -0,0 +1,180 @@
+"""
+Vectorized NumPy evaluation of the fitted model curves, without Xspec.
+
+The three model families of run_xspec.py (tbabs*powerlaw, tbabs*bknpower and
+tbabs*logpar) are evaluated in E^2 F(E) form (keV^2 photons cm^-2 s^-1 keV^-1,
+as in the Xspec "eeufspec" plot) from stored parameters. Parameters may be arrays:
+they broadcast against each other and the energy grid is appended as the last axis,
+so N observations on an M-point grid give an (N, M) array in one call.
+
+A registry model (models.yaml) is evaluated with the function of its component, so
+models that only differ in name or initial values are covered as well. The tbabs
+absorption uses the frozen nH of the model and is approximated with the Morrison &
+McCammon (1983) cross sections (the Xspec wabs model). At the fixed Galactic nH of
+the pipeline the difference to tbabs is far below the statistical errors.
+
+command: `python model_eval.py catalog.db --model powerlaw --emin 0.4 --emax 10 --nbins 500 --out curves.npy`
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from catalog import load_catalog
+from model_registry import load_registry, frozen_nh
+
+# Morrison & McCammon (1983): sigma(E) = (c0 + c1 E + c2 E^2) E^-3 10^-24 cm^2 per H atom,
+# with the lower edge of each energy range (keV)
+MM83_EDGES = np.array([0.030, 0.100, 0.284, 0.400, 0.532, 0.707, 0.867, 1.303, 1.840, 2.471, 3.210, 4.038, 7.111, 8.331])
+MM83_COEFFS = np.array([
+	[17.3, 608.1, -2150.0],
+	[34.6, 267.9, -476.1],
+	[78.1, 18.8, 4.3],
+	[71.4, 66.8, -51.4],
+	[95.5, 145.8, -61.1],
+	[308.9, -380.6, 294.0],
+	[120.6, 169.3, -47.7],
+	[141.3, 146.8, -31.5],
+	[202.7, 104.7, -17.0],
+	[342.7, 18.7, 0.0],
+	[352.2, 18.7, 0.0],
+	[433.9, -2.4, 0.75],
+	[629.0, 30.9, 0.0],
+	[701.2, 25.2, 0.0]])
+
+DEFAULTS = {"pivotE": 1.0}
+
+
+def _par(val):
+	"""
+	Returns a parameter as an array with a trailing axis for the energies.
+	"""
+	return np.asarray(val, dtype=float)[..., np.newaxis]
+
+def tbabs(energy, nH):
+	"""
+	Photoelectric absorption exp(-nH sigma(E)) with nH in 10^22 cm^-2.
+	"""
+	energy = np.asarray(energy, dtype=float)
+	idx = np.clip(np.searchsorted(MM83_EDGES, energy, side="right") - 1, 0, len(MM83_EDGES) - 1)
+	c0, c1, c2 = MM83_COEFFS[idx].T
+	sigma = (c0 + c1 * energy + c2 * energy**2) * energy**-3.0 * 1e-24
+	return np.exp(-_par(nH) * 1e22 * sigma)
+
+def powerlaw(energy, PhoIndex, norm):
+	"""
+	Photon spectrum norm E^-PhoIndex.
+	"""
+	return _par(norm) * np.asarray(energy, dtype=float) ** -_par(PhoIndex)
+
+def bknpower(energy, PhoIndx1, BreakE, PhoIndx2, norm):
+	"""
+	Broken power law: norm E^-PhoIndx1 below BreakE, norm BreakE^(PhoIndx2-PhoIndx1) E^-PhoIndx2 above.
+	"""
+	energy = np.asarray(energy, dtype=float)
+	g1, eb, g2 = _par(PhoIndx1), _par(BreakE), _par(PhoIndx2)
+	low = energy ** -g1
+	high = eb ** (g2 - g1) * energy ** -g2
+	return _par(norm) * np.where(energy <= eb, low, high)
+
+def logpar(energy, alpha, beta, pivotE, norm):
+	"""
+	Log parabola norm (E/pivotE)^-(alpha + beta log10(E/pivotE)).
+	"""
+	x = np.asarray(energy, dtype=float) / _par(pivotE)
+	return _par(norm) * x ** -(_par(alpha) + _par(beta) * np.log10(x))
+
+# Evaluators by Xspec component
+FUNCTIONS = {"powerlaw": powerlaw, "bknpower": bknpower, "logpar": logpar}
+# Registry models that can be evaluated: their parameters, component and frozen nH
+EVALUATED = {mname: mdef for mname, mdef in load_registry().items() if mdef["component"] in FUNCTIONS}
+MODEL_PARAMS = {mname: list(mdef["parameters"]) for mname, mdef in EVALUATED.items()}
+COMPONENTS = {mname: mdef["component"] for mname, mdef in EVALUATED.items()}
+MODEL_NH = {mname: frozen_nh(mdef) for mname, mdef in EVALUATED.items()}
+
+
+def photon_spectrum(mname, energy, params, nH=None):
+	"""
+	Absorbed photon spectrum F(E) in photons cm^-2 s^-1 keV^-1.
+	Args:
+		mname (str): Registry model, see MODEL_PARAMS.
+		energy (array): Energies in keV.
+		params (dict): Parameter values or arrays by name, see MODEL_PARAMS.
+		nH (float or array): Absorbing column in 10^22 cm^-2, by default the one of the model.
+	Returns:
+		np.ndarray: Shape of the broadcast parameters plus the energy axis.
+	"""
+	pars = {p: params.get(p, DEFAULTS.get(p)) for p in MODEL_PARAMS[mname]}
+	missing = [p for p, v in pars.items() if v is None]
+	if missing:
+		raise ValueError(f"Missing {mname} parameters: {', '.join(missing)}")
+	return tbabs(energy, MODEL_NH[mname] if nH is None else nH) * FUNCTIONS[COMPONENTS[mname]](energy, **pars)
+
+def eeuf(mname, energy, params, nH=None):
+	"""
+	Absorbed model in E^2 F(E) form, the "modVals" column of the spectrum files.
+	"""
+	energy = np.asarray(energy, dtype=float)
+	return energy**2 * photon_spectrum(mname, energy, params, nH)
+
+def ratio(ydata, mname, energy, params, nH=None):
+	"""
+	Data to model ratio of an E^2 F(E) spectrum.
+	"""
+	return np.asarray(ydata, dtype=float) / eeuf(mname, energy, params, nH)
+
+def energy_grid(emin=0.4, emax=10.0, nbins=500):
+	"""
+	Returns a logarithmic energy grid in keV.
+	"""
+	return np.geomspace(emin, emax, nbins)
+
+
+def params_from_catalog(df, mname):
+	"""
+	Collects the parameters of a model from catalog rows into one array per parameter.
+	Returns:
+		tuple: (ObsIDs, {parameter: array})
+	"""
+	rows = df[df["Model"] == mname].pivot(index="ObsID", columns="Parameter", values="Value")
+	return rows.index.to_numpy(), {p: rows[p].to_numpy(dtype=float) for p in MODEL_PARAMS[mname] if p in rows}
+
+def params_from_records(paths, mname):
+	"""
+	Collects the parameters of a model from the fit records ({model}_fit.json) of observations.
+	Returns:
+		tuple: (paths with a record, {parameter: array})
+	"""
+	found, values = [], {p: [] for p in MODEL_PARAMS[mname]}
+	for fpath in paths:
+		try:
+			with open(os.path.join(fpath, f"{mname}_fit.json"), "r") as file:
+				rec = json.load(file)["parameters"]
+		except (OSError, ValueError, KeyError):
+			continue
+		found.append(fpath)
+		for p in values:
+			values[p].append(rec[p]["value"] if p in rec else DEFAULTS.get(p, np.nan))
+	return found, {p: np.array(v, dtype=float) for p, v in values.items()}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Evaluate the model curves of all observations in the catalog.")
+	parser.add_argument("db", type=str, help="Path to the catalog database")
+	parser.add_argument("--model", choices=list(MODEL_PARAMS), required=True, help="Model to evaluate")
+	parser.add_argument("--emin", type=float, default=0.4, help="Lowest energy in keV (default: %(default)s)")
+	parser.add_argument("--emax", type=float, default=10.0, help="Highest energy in keV (default: %(default)s)")
+	parser.add_argument("--nbins", type=int, default=500, help="Number of logarithmic energy points (default: %(default)s)")
+	parser.add_argument("--out", type=str, required=True, help="Output .npy file with the fields ObsID and curve")
+	args = parser.parse_args()
+
+	obsids, params = params_from_catalog(load_catalog(args.db, model=args.model), args.model)
+	energy = energy_grid(args.emin, args.emax, args.nbins)
+	curves = eeuf(args.model, energy, params)
+
+	out = np.empty(len(obsids), dtype=[("ObsID", "U32"), ("curve", "f8", (len(energy),))])
+	out["ObsID"] = obsids
+	out["curve"] = curves
+	np.save(args.out, out)
+	np.save(os.path.splitext(args.out)[0] + "_energy.npy", energy)
+	print(f">>> Evaluated {args.model} for {len(obsids)} observations on {len(energy)} energies: {args.out}")
@@ -0,0 +1,125 @@
+"""
+Registry of the fitted models, read from models.yaml.
+
+Every model has an Xspec expression, the initial (and frozen) values of its parameters
+and the names of the parameters reported in the tables. In a fitting process each model
+is compiled once: the parameter names are resolved to Xspec parameter indices and the
+values to setPars strings ("value,-1" freezes a parameter). Every observation then
+creates the model with a single bulk setPars call.
+"""
+
+import os
+import functools
+import yaml
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.yaml")
+
+# Compiled models of this process, filled by compile_model()
+_compiled = {}
+
+
+@functools.lru_cache(maxsize=None)
+def load_registry(path=REGISTRY_FILE):
+	"""
+	Reads and checks the model registry.
+	Returns:
+		Dict: {model name: {"expr": str, "component": str, "params": dict, "parameters": list}}, in file order.
+	"""
+	with open(path, "r") as file:
+		registry = yaml.safe_load(file)
+	if not isinstance(registry, dict) or not registry:
+		raise ValueError(f"No models in the registry: {path}")
+	for mname, mdef in registry.items():
+		missing = [key for key in ("expr", "parameters") if key not in mdef]
+		if missing:
+			raise ValueError(f"Model {mname} in {path} lacks: {', '.join(missing)}")
+		mdef.setdefault("params", {})
+		mdef.setdefault("component", mname)
+		source = mdef.get("warm_start", {}).get("from")
+		if source is not None and source not in registry:
+			raise ValueError(f"Model {mname} in {path} is warm started from an unknown model: {source}")
+	return registry
+
+def model_params(path=REGISTRY_FILE):
+	"""
+	Returns the reported parameter names of every model.
+	"""
+	return {mname: list(mdef["parameters"]) for mname, mdef in load_registry(path).items()}
+
+def model_components(path=REGISTRY_FILE):
+	"""
+	Returns the Xspec component of every model whose parameters are reported.
+	"""
+	return {mname: mdef["component"] for mname, mdef in load_registry(path).items()}
+
+def warm_starts(path=REGISTRY_FILE):
+	"""
+	Returns the warm start of every model that has one.
+	Returns:
+		Dict: {model: {"from": model, "params": {"component.parameter": parameter of the source fit}}}
+	"""
+	return {mname: mdef["warm_start"] for mname, mdef in load_registry(path).items() if "warm_start" in mdef}
+
+def frozen_nh(mdef):
+	"""
+	Returns the absorbing column (10^22 cm^-2) set in a model definition, 0 without absorption.
+	"""
+	for pname, pdef in mdef["params"].items():
+		if pname.split(".")[-1] == "nH":
+			return float(pdef["value"] if isinstance(pdef, dict) else pdef)
+	return 0.0
+
+def initial_values(mdef):
+	"""
+	Returns the initial values of a model definition as setPars values by "component.parameter".
+	"""
+	values = {}
+	for pname, pdef in mdef["params"].items():
+		if isinstance(pdef, dict):
+			values[pname] = f"{pdef['value']},-1" if pdef.get("frozen") else pdef["value"]
+		else:
+			values[pname] = pdef
+	return values
+
+def compile_model(mname, path=REGISTRY_FILE):
+	"""
+	Resolves the parameters of a model to Xspec parameter indices, once per process.
+	Returns:
+		Dict: {"expr": str, "index": {"component.parameter": index}, "values": {index: value}}
+	"""
+	if (path, mname) in _compiled:
+		return _compiled[(path, mname)]
+	from xspec import Model, AllModels
+	registry = load_registry(path)
+	if mname not in registry:
+		raise ValueError(f"Unknown model: {mname}")
+	mdef = registry[mname]
+
+	model = Model(mdef["expr"])
+	index = {}
+	for cname in model.componentNames:
+		comp = getattr(model, cname)
+		for pname in comp.parameterNames:
+			index[f"{cname}.{pname}"] = getattr(comp, pname).index
+	AllModels.clear()
+
+	unknown = [pname for pname in mdef["params"] if pname not in index]
+	if unknown:
+		raise ValueError(f"Parameters of {mname} not in {mdef['expr']}: {', '.join(unknown)}")
+	spec = {"expr": mdef["expr"], "index": index,
+		"values": {index[pname]: val for pname, val in initial_values(mdef).items()}}
+	_compiled[(path, mname)] = spec
+	return spec
+
+def new_model(mname, seeds=None, path=REGISTRY_FILE):
+	"""
+	Replaces the current model with a registry model, setting all initial values in one call.
+	Values in seeds ({"component.parameter": value}) override those of the registry.
+	"""
+	from xspec import Model, AllModels
+	spec = compile_model(mname, path)
+	values = dict(spec["values"])
+	for pname, val in (seeds or {}).items():
+		values[spec["index"][pname]] = val
+	AllModels.clear()
+	return Model(spec["expr"], setPars=values)
@@ -0,0 +1,208 @@
+"""
+One-pass index of the observation directories.
+
+Every directory is listed once with os.scandir and its files are classified by
+role (spectrum, response, fit record, plot data, ...). The index is saved as JSON
+with the modification time of each directory and the size and mtime of each file,
+so a later refresh only lists the directories that changed since. The pipeline
+scripts resolve their inputs from the index instead of globbing each directory
+for every pattern.
+
+command: `python obs_index.py obslist.txt index.json`
+"""
+
+import os
+import json
+import fnmatch
+import argparse
+
+INDEX_VERSION = 1
+
+# (role, pattern) pairs, the first matching pattern gives the role of a file
+ROLES = [
+	("spectrum", "spec1.pha"),
+	("source", "*sr.pha"),
+	("background", "*bg.pha"),
+	("bg_model", "*bg.xcm"),
+	("fit_state", "*_model.xcm"),
+	("response", "*.rmf"),
+	("arf", "*.arf"),
+	("fit_record", "*_fit.json"),
+	("fit_conf", "*_conf.json"),
+	("xspec_log", "*xspec.log"),
+	("spec_data", "*_spec.npy"),
+	("spec_data", "*_spec.csv"),
+	("ratio_data", "*_ratio.npy"),
+	("ratio_data", "*_ratio.csv"),
+	("plot", "*_plot.png"),
+	("plot", "*_plot.ps"),
+	("table", "model_*.csv"),
+]
+
+
+def classify(name):
+	"""
+	Returns the role of a file name, or None if it has none.
+	"""
+	for role, pattern in ROLES:
+		if fnmatch.fnmatchcase(name, pattern):
+			return role
+	return None
+
+def role_files(fpath, names, role):
+	"""
+	Returns the sorted paths of the files with the given role among the file names of a directory.
+	"""
+	return [os.path.join(fpath, name) for name in sorted(names) if classify(name) == role]
+
+def scan_dir(fpath):
+	"""
+	Lists an observation directory once.
+	Returns:
+		Dict: The directory mtime and {name: [size, mtime_ns]} of its files, None if it does not exist.
+	"""
+	try:
+		dir_mtime = os.stat(fpath).st_mtime_ns
+		files = {}
+		with os.scandir(fpath) as it:
+			for entry in it:
+				if entry.is_file():
+					st = entry.stat()
+					files[entry.name] = [st.st_size, st.st_mtime_ns]
+	except FileNotFoundError:
+		return None
+	return {"mtime": dir_mtime, "files": files}
+
+
+class ObsIndex:
+	"""
+	File listing of the observation directories, persisted as JSON.
+	Args:
+		path (str): Index file, loaded if it exists, or None to keep the index in memory.
+	"""
+	def __init__(self, path=None):
+		self.path = os.path.abspath(path) if path else None
+		self.dirs = {}
+		if self.path and os.path.exists(self.path):
+			try:
+				with open(self.path, "r") as file:
+					data = json.load(file)
+				if data.get("version") == INDEX_VERSION:
+					self.dirs = data["dirs"]
+			except (OSError, ValueError, KeyError):
+				print(f"> Warning: Index {self.path} could not be read, rebuilding it.")
+
+	def refresh(self, paths):
+		"""
+		Brings the entries of the given directories up to date. A directory is listed
+		again only when its mtime changed, which happens when files are added, removed or renamed.
+		Returns:
+			tuple: Number of directories listed and number reused.
+		"""
+		scanned = reused = 0
+		for fpath in paths:
+			fpath = os.path.abspath(fpath)
+			entry = self.dirs.get(fpath)
+			try:
+				mtime = os.stat(fpath).st_mtime_ns
+			except FileNotFoundError:
+				self.dirs.pop(fpath, None)
+				continue
+			if entry is not None and entry["mtime"] == mtime:
+				reused += 1
+				continue
+			self.update(fpath)
+			scanned += 1
+		return scanned, reused
+
+	def update(self, fpath):
+		"""
+		Lists one directory again, e.g. after a stage wrote its outputs there.
+		"""
+		fpath = os.path.abspath(fpath)
+		entry = scan_dir(fpath)
+		if entry is None:
+			self.dirs.pop(fpath, None)
+		else:
+			self.dirs[fpath] = entry
+		return
+
+	def save(self):
+		"""
+		Writes the index file atomically.
+		"""
+		if self.path is None:
+			return
+		tmp = f"{self.path}.{os.getpid()}.tmp"
+		with open(tmp, "w") as file:
+			json.dump({"version": INDEX_VERSION, "dirs": self.dirs}, file)
+		os.replace(tmp, self.path)
+		return
+
+	def names(self, fpath):
+		"""
+		Returns the file names of a directory, or None if it is not indexed.
+		"""
+		entry = self.dirs.get(os.path.abspath(fpath))
+		return None if entry is None else frozenset(entry["files"])
+
+	def files(self, fpath, role):
+		"""
+		Returns the sorted paths of the files with the given role in a directory.
+		"""
+		names = self.names(fpath)
+		return [] if names is None else role_files(os.path.abspath(fpath), names, role)
+
+	def find(self, fpath, role):
+		"""
+		Returns the first file with the given role in a directory, or None.
+		"""
+		matches = self.files(fpath, role)
+		return matches[0] if matches else None
+
+
+def add_index_args(parser):
+	"""
+	Adds the index option shared by the pipeline scripts to an argument parser.
+	"""
+	parser.add_argument("--index", type=str, default=None, help="Resolve the inputs from this observation index, refreshed and saved at start")
+	return
+
+def index_from_args(args, paths):
+	"""
+	Loads and refreshes the index selected by the command line options.
+	Returns:
+		ObsIndex: The refreshed index, or None when no index is used.
+	"""
+	if args.index is None:
+		return None
+	index = ObsIndex(args.index)
+	scanned, reused = index.refresh(paths)
+	index.save()
+	print(f">>> Index {args.index}: {scanned} directories listed, {reused} unchanged.")
+	return index
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Build or refresh the index of the observations listed in a text file.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("index", type=str, help="Index file to create or refresh")
+	args = parser.parse_args()
+
+	with open(args.ip_path, 'r') as file:
+		file_paths = [line.strip() for line in file if line.strip()]
+
+	index = ObsIndex(args.index)
+	scanned, reused = index.refresh(file_paths)
+	index.save()
+
+	counts = {}
+	for fpath in file_paths:
+		for name in index.names(fpath) or []:
+			role = classify(name)
+			counts[role] = counts.get(role, 0) + 1
+	missing = sum(1 for fpath in file_paths if index.names(fpath) is None)
+	print(f">>> {scanned} directories listed, {reused} unchanged, {missing} missing.")
+	for role in dict.fromkeys(r for r, _ in ROLES):
+		print(f"{role:<12s}{counts.get(role, 0):>10d}")
+	print(f"{'other':<12s}{counts.get(None, 0):>10d}")
@@ -0,0 +1,87 @@
+"""
+Background threads that overlap the file I/O of a batch with its fits.
+
+prefetch() prepares the next observations while the current one is processed, and
+BackgroundWriter flushes the outputs of the previous one. Both use bounded queues,
+so at most a fixed number of observations is held in memory ahead or behind.
+"""
+
+import queue
+import threading
+import traceback
+
+_DONE = object()
+
+
+def prefetch(items, work, depth=1):
+	"""
+	Runs work(item) in a background thread up to depth items ahead of the consumer.
+	Errors of work() are ignored; the consumer meets them again when it processes the item.
+	Args:
+		items (list): Items to prepare, in order.
+		work (callable): Called with each item.
+		depth (int): Number of items prepared ahead.
+	Yields:
+		The items, each after its work() has finished.
+	"""
+	ready = queue.Queue(maxsize=depth)
+
+	def run():
+		for item in items:
+			try:
+				work(item)
+			except Exception:
+				pass
+			ready.put(item)
+		ready.put(_DONE)
+
+	thread = threading.Thread(target=run, daemon=True)
+	thread.start()
+	while True:
+		item = ready.get()
+		if item is _DONE:
+			break
+		yield item
+	thread.join()
+
+
+class BackgroundWriter:
+	"""
+	Runs output writes in a background thread, in the order they were submitted.
+	submit() blocks while maxsize writes are waiting, which caps the memory held.
+	Args:
+		maxsize (int): Number of writes that may wait in the queue.
+		on_error (callable): Called with the key, the exception and the traceback of a failed write.
+	"""
+	def __init__(self, maxsize=8, on_error=None):
+		self.on_error = on_error
+		self._queue = queue.Queue(maxsize=maxsize)
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			job = self._queue.get()
+			if job is _DONE:
+				return
+			key, func, args, kwargs = job
+			try:
+				func(*args, **kwargs)
+			except Exception as e:
+				if self.on_error is not None:
+					self.on_error(key, e, traceback.format_exc())
+
+	def submit(self, key, func, *args, **kwargs):
+		"""
+		Queues func(*args, **kwargs); key identifies the write in error reports.
+		"""
+		self._queue.put((key, func, args, kwargs))
+		return
+
+	def close(self):
+		"""
+		Waits until all queued writes are done and stops the thread.
+		"""
+		self._queue.put(_DONE)
+		self._thread.join()
+		return
@@ -0,0 +1,172 @@
+"""
+Reading and writing of the spectrum and ratio plot arrays saved by run_xspec.py.
+
+The arrays are stored either as text ({model}_spec.csv, {model}_ratio.csv) or as
+binary NumPy structured arrays ({model}_spec.npy, {model}_ratio.npy) that can be
+memory mapped. Running this file converts existing CSV trees to the binary format:
+`python plot_data.py obslist.txt`
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from model_registry import load_registry
+
+COLUMNS = {
+	"spec": ["xVals", "yVals", "yErrs", "modVals"],
+	"ratio": ["xVals", "yVals", "yErrs"]}
+FORMATS = ["csv", "npy"]
+
+
+def data_file(fpath, mname, kind, fmt):
+	"""
+	Returns the path of a plot data file.
+	"""
+	return os.path.join(fpath, f"{mname}_{kind}.{fmt}")
+
+def write_plot_data(fpath, mname, kind, values, fmt="csv"):
+	"""
+	Saves plot arrays in the given format.
+	Args:
+		fpath (str): Observation directory.
+		mname (str): Model name.
+		kind (str): "spec" or "ratio".
+		values (list): One array per column of COLUMNS[kind].
+		fmt (str): "csv" or "npy".
+	Returns:
+		str: Path of the written file.
+	"""
+	columns = COLUMNS[kind]
+	oname = data_file(fpath, mname, kind, fmt)
+	if fmt == "npy":
+		data = np.empty(len(values[0]), dtype=[(c, "f8") for c in columns])
+		for col, vals in zip(columns, values):
+			data[col] = vals
+		np.save(oname, data)
+	elif fmt == "csv":
+		data = np.column_stack(values)
+		np.savetxt(oname, data, delimiter=",", header=",".join(columns), comments="")
+	else:
+		raise ValueError(f"Unknown plot data format: {fmt}")
+
+	# A stale file in the other format would shadow or contradict the new one
+	for other in FORMATS:
+		if other != fmt and os.path.exists(data_file(fpath, mname, kind, other)):
+			os.remove(data_file(fpath, mname, kind, other))
+	return oname
+
+def find_plot_data(fpath, mname, kind, names=None):
+	"""
+	Returns the path of the stored plot data, preferring the binary file, or None if there is none.
+	With names, the file names of the directory from the observation index, no file is checked on disk.
+	"""
+	for fmt in reversed(FORMATS):
+		fname = data_file(fpath, mname, kind, fmt)
+		if (os.path.basename(fname) in names) if names is not None else os.path.exists(fname):
+			return fname
+	return None
+
+def group_channels(yvals, yerrs, min_snr=None, max_bins=None):
+	"""
+	Groups adjacent channels for display, to a minimum signal-to-noise ratio per bin
+	and/or a maximum number of bins. The squared S/N of a group is the sum over its
+	channels; a last group below min_snr is merged into the previous one.
+	Returns:
+		np.ndarray: Index of the first channel of each group.
+	"""
+	yvals = np.asarray(yvals, dtype=float)
+	yerrs = np.asarray(yerrs, dtype=float)
+	n = len(yvals)
+	starts = np.arange(n)
+	if min_snr and n:
+		snr2 = np.divide(yvals, yerrs, out=np.zeros(n), where=yerrs > 0) ** 2
+		csum = np.cumsum(snr2)
+		target = min_snr ** 2
+		starts, start = [], 0
+		while start < n:
+			starts.append(start)
+			# First channel at which the group reaches the target
+			start = int(np.searchsorted(csum, (csum[start - 1] if start else 0.0) + target)) + 1
+		if len(starts) > 1 and csum[-1] - csum[starts[-1] - 1] < target:
+			starts.pop()
+		starts = np.array(starts)
+	if max_bins and len(starts) > max_bins:
+		starts = starts[np.linspace(0, len(starts), max_bins, endpoint=False).astype(int)]
+	return starts
+
+def rebin_plot_data(data, starts, columns):
+	"""
+	Combines the channels of each group: yVals is averaged with inverse-variance
+	weights (yErrs the error of that mean), the other columns are plain means.
+	Returns:
+		Dict: One array per column, indexed like the input data.
+	"""
+	yerrs = np.asarray(data["yErrs"], dtype=float)
+	weights = np.divide(1.0, yerrs ** 2, out=np.zeros(len(yerrs)), where=yerrs > 0)
+	counts = np.diff(np.append(starts, len(yerrs)))
+	wsum = np.add.reduceat(weights, starts)
+	out = {}
+	for col in columns:
+		vals = np.asarray(data[col], dtype=float)
+		mean = np.add.reduceat(vals, starts) / counts
+		if col == "yVals":
+			out[col] = np.divide(np.add.reduceat(weights * vals, starts), wsum, out=mean, where=wsum > 0)
+		elif col == "yErrs":
+			out[col] = np.divide(1.0, np.sqrt(wsum), out=np.zeros(len(starts)), where=wsum > 0)
+		else:
+			out[col] = mean
+	return out
+
+def read_plot_data(fpath, mname, kind, names=None):
+	"""
+	Loads plot arrays. Binary files are memory mapped, CSV files are read with pandas.
+	Both results are indexed by column name, e.g. data["xVals"].
+	"""
+	fname = find_plot_data(fpath, mname, kind, names)
+	if fname is None:
+		raise FileNotFoundError(f"No {kind} data for {mname} in: {fpath}")
+	if fname.endswith(".npy"):
+		return np.load(fname, mmap_mode="r")
+	return pd.read_csv(fname)
+
+def convert_csv(fpath, mname, kind, remove=False):
+	"""
+	Converts a CSV plot data file to the binary format.
+	Returns:
+		bool: True if a file was converted.
+	"""
+	csv = data_file(fpath, mname, kind, "csv")
+	if not os.path.exists(csv):
+		return False
+	df = pd.read_csv(csv)
+	data = np.empty(len(df), dtype=[(c, "f8") for c in COLUMNS[kind]])
+	for col in COLUMNS[kind]:
+		data[col] = df[col].to_numpy()
+	np.save(data_file(fpath, mname, kind, "npy"), data)
+	if remove:
+		os.remove(csv)
+	return True
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Convert the CSV spectrum and ratio files of the listed observations to .npy.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--models", nargs="+", default=list(load_registry()), help="Models to convert (default: %(default)s)")
+	parser.add_argument("--remove", action="store_true", help="Remove the CSV files after conversion")
+	args = parser.parse_args()
+
+	with open(args.ip_path, 'r') as file:
+		file_paths = [line.strip() for line in file if line.strip()]
+
+	nconv = 0
+	for fpath in file_paths:
+		try:
+			for m in args.models:
+				for kind in COLUMNS:
+					nconv += convert_csv(fpath, m, kind, remove=args.remove)
+		except Exception as e:
+			print(f"> Error: {fpath}:: {e}")
+			continue
+
+	print(f">>> Converted {nconv} files.")
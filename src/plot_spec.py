@@ -1,9 +1,33 @@
 import os
-import sys
-import pandas as pd
+import csv
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.ticker import ScalarFormatter, LogLocator
+import argparse
+import functools
+import multiprocessing
+import json
+import tempfile
 import traceback
+from result_cache import content_key, add_cache_args, cache_from_args
+from plot_data import find_plot_data, read_plot_data, group_channels, rebin_plot_data, COLUMNS
+from metrics import stage, profiling, add_metrics_args, metrics_from_args
+from obs_index import add_index_args, index_from_args
+from model_eval import eeuf, params_from_records, MODEL_PARAMS as EVAL_MODELS
+from model_registry import load_registry
+from failure_journal import record_failure, resolve_failure, add_journal_args, journal_from_args, retry_from_args
+
+# min_snr and max_bins: display rebinning of the channels, None or 0 disables either
+PLOT_SETTINGS = {"dpi": 300, "single_plot": False, "min_snr": None, "max_bins": 0}
+RASTER_MIN = 200  # error bars of more points are rasterized in vector outputs
+OVERLAY_COLORS = {"logpar": "darkorange", "powerlaw": "purple", "bknpower": "teal"}
+MODELS = list(load_registry())
+OUTPUTS = ["png", "pdf", "sheet"]
+PAGES_PER_FILE = 500  # observations per PDF file
+SHEET_ROWS = 8  # observations per contact sheet
+SHEET_DPI = 100
 
 def plot_axsetup(ax, xlabel=None, ylabel=None):
 	"""
@@ -24,39 +48,175 @@ def plot_axsetup(ax, xlabel=None, ylabel=None):
 		ax.set_ylabel(ylabel, fontsize=10)
 	return
 
-def plot_spectrum(df_spect, fpath, mname, df_ratio=None, single_plot=False):
+def plot_spectrum(df_spect, fpath, mname, df_ratio=None, single_plot=False, overlays=None, out_dir=None, dpi=None):
 	"""
 	Plot a spectrum with optional ratio data in either a single or dual plot layout.
+	The figure is closed after saving, so repeated calls keep the memory use flat.
+	The image is saved in out_dir, by default the observation directory.
 	"""
-	iname = os.path.join(fpath, f"{mname}_plot.png")
+	iname = os.path.join(out_dir or fpath, f"{mname}_plot.png")
 
+	if single_plot:
+		fig, ax = plt.subplots(figsize=(8, 6))
+	else:
+		fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 8), gridspec_kw={'height_ratios': [7, 3]}, sharex=True)
+
+	try:
+		draw_spectrum(fig, df_spect, mname, df_ratio=df_ratio, single_plot=single_plot, overlays=overlays)
+		fig.savefig(iname, dpi=dpi or PLOT_SETTINGS["dpi"], bbox_inches="tight")
+	finally:
+		plt.close(fig)
+	# plt.show()
+
+def draw_spectrum(fig, df_spect, mname, df_ratio=None, single_plot=False, overlays=None, axes=None, raster_min=RASTER_MIN):
+	"""
+	Draws the spectrum, and the ratio in the dual layout, on the axes of an existing figure.
+	overlays ({model: values}) are the curves of other models on the energies of the spectrum.
+	axes selects the axes of one panel of a page with several plots; the model is then the
+	title of the panel and the figure layout is left to the caller.
+	"""
 	x1, y1, y1e, mdl = df_spect["xVals"], df_spect["yVals"], df_spect["yErrs"], df_spect["modVals"]
+	raster = raster_min is not None and len(x1) > raster_min
+	panel = axes is not None
+	axes = axes if panel else fig.axes
 
 	if single_plot:
-		fig, ax = plt.subplots(figsize=(8, 6))
-		ax.errorbar(x1, y1, yerr=y1e, fmt="o", markersize=4, label="Data", color="royalblue", ecolor="lightblue", elinewidth=1, capsize=1)
+		ax = axes[0]
+		ax.errorbar(x1, y1, yerr=y1e, fmt="o", markersize=4, label="Data", color="royalblue", ecolor="lightblue", elinewidth=1, capsize=1, rasterized=raster)
 		ax.plot(x1, mdl, label="Model", color="crimson", linestyle="-", linewidth=1)
+		for oname, ovals in (overlays or {}).items():
+			ax.plot(x1, ovals, label=oname, color=OVERLAY_COLORS.get(oname, "gray"), linestyle="--", linewidth=1)
 		plot_axsetup(ax, xlabel="Energy (keV)", ylabel=r"keV$^2$ (Photons cm$^{-2}$ s$^{-1}$ keV$^{-1}$)")
 		ax.legend()
 	else:
 		x2, y2, y2e = df_ratio["xVals"], df_ratio["yVals"], df_ratio["yErrs"]
-		fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 8), gridspec_kw={'height_ratios': [7, 3]}, sharex=True)
-		
-		ax1.errorbar(x1, y1, yerr=y1e, fmt="o", markersize=2, label="Data", color="royalblue", ecolor="lightblue", elinewidth=1, capsize=1)
+		ax1, ax2 = axes[:2]
+
+		ax1.errorbar(x1, y1, yerr=y1e, fmt="o", markersize=2, label="Data", color="royalblue", ecolor="lightblue", elinewidth=1, capsize=1, rasterized=raster)
 		ax1.plot(x1, mdl, label="Model", color="crimson", linestyle="-", linewidth=1)
+		for oname, ovals in (overlays or {}).items():
+			ax1.plot(x1, ovals, label=oname, color=OVERLAY_COLORS.get(oname, "gray"), linestyle="--", linewidth=1)
 		plot_axsetup(ax1, ylabel=r"keV$^2$ (Photons cm$^{-2}$ s$^{-1}$ keV$^{-1}$)")
 		ax1.legend()
 
-		ax2.errorbar(x2, y2, yerr=y2e, fmt="o", markersize=2, color="seagreen", ecolor="lightgreen", elinewidth=1, capsize=1)
+		ax2.errorbar(x2, y2, yerr=y2e, fmt="o", markersize=2, color="seagreen", ecolor="lightgreen", elinewidth=1, capsize=1, rasterized=raster_min is not None and len(x2) > raster_min)
 		ax2.axhline(1.0, color="crimson", linestyle="-", linewidth=1)
 		plot_axsetup(ax2, xlabel="Energy (keV)", ylabel="Ratio")
 
-		plt.subplots_adjust(hspace=0.1)
+		if not panel:
+			fig.subplots_adjust(hspace=0.1)
 
+	if panel:
+		axes[0].set_title(f"{mname} Model", fontsize=10)
+		if not single_plot:
+			axes[0].tick_params(axis="x", which="both", labelbottom=False)
+		return
 	fig.suptitle(f"Spectrum: {mname} Model", fontsize=12)
-	plt.tight_layout()
-	plt.savefig(iname, dpi=300, bbox_inches="tight")
-	# plt.show()
+	fig.tight_layout()
+	return
+
+class PlotBook:
+	"""
+	Streams the plots of a run into a few files instead of one PNG per model and observation.
+	Every observation is one row of panels, one panel (spectrum over ratio) per model.
+	"pdf": one page per observation in multi-page PDFs, a new file every pages_per_file pages.
+	"sheet": PNG contact sheets of rows observations each.
+	Pages are written when they are added and their figures closed, so the memory stays
+	bounded over any run. {prefix}_index.csv lists the file and page of every ObsID.
+	"""
+	def __init__(self, prefix, mode="pdf", pages_per_file=PAGES_PER_FILE, rows=SHEET_ROWS, models=None):
+		self.prefix = prefix
+		self.mode = mode
+		self.limit = pages_per_file if mode == "pdf" else rows
+		self.models = models or MODELS
+		self._nfile = 0
+		self._npage = 0
+		self._pdf = None
+		self._sheet = None
+		self._index = open(f"{prefix}_index.csv", "w", newline="")
+		self._writer = csv.writer(self._index)
+		self._writer.writerow(["ObsID", "Path", "File", "Page"])
+
+	def _fname(self):
+		return f"{self.prefix}_{self._nfile:04d}.{'pdf' if self.mode == 'pdf' else 'png'}"
+
+	def _new_file(self):
+		self._close_file()
+		self._nfile += 1
+		self._npage = 0
+		ncols = len(self.models)
+		if self.mode == "pdf":
+			self._pdf = PdfPages(self._fname())
+		else:
+			self._sheet = plt.figure(figsize=(4.5 * ncols, 5 * self.limit), layout="constrained")
+			self._grid = self._sheet.add_gridspec(2 * self.limit, ncols, height_ratios=[7, 3] * self.limit)
+
+	def _close_file(self):
+		if self._pdf is not None:
+			self._pdf.close()
+			self._pdf = None
+		if self._sheet is not None:
+			try:
+				self._sheet.savefig(self._fname(), dpi=SHEET_DPI, bbox_inches="tight")
+			finally:
+				plt.close(self._sheet)
+				self._sheet = None
+
+	def add(self, fpath, panels):
+		"""
+		Adds the page (or contact sheet row) of one observation.
+		Args:
+			fpath (str): Path to the observation directory.
+			panels (dict): {model: (spectrum, ratio, overlays)} as returned by display_data().
+		"""
+		if self._npage >= self.limit or (self._pdf is None and self._sheet is None):
+			self._new_file()
+		oid = os.path.basename(os.path.normpath(fpath))
+		ncols = len(self.models)
+
+		if self.mode == "pdf":
+			fig = plt.figure(figsize=(4.5 * ncols, 5.5), layout="constrained")
+			grid, row = fig.add_gridspec(2, ncols, height_ratios=[7, 3]), 0
+		else:
+			fig, grid, row = self._sheet, self._grid, 2 * self._npage
+		axes = []
+		try:
+			for col, mname in enumerate(self.models):
+				if mname not in panels:
+					continue
+				df_spect, df_ratio, overlays = panels[mname]
+				ax1 = fig.add_subplot(grid[row, col])
+				ax2 = fig.add_subplot(grid[row + 1, col], sharex=ax1)
+				axes += [ax1, ax2]
+				# PdfPages keeps rasterized images in memory until the file is closed, the panels stay vector
+				draw_spectrum(fig, df_spect, mname, df_ratio=df_ratio, overlays=overlays, axes=[ax1, ax2], raster_min=None)
+				if self.mode == "sheet":
+					ax1.set_title(f"{oid}: {mname} Model", fontsize=10)
+			if self.mode == "pdf":
+				fig.suptitle(f"ObsID {oid}", fontsize=12)
+				self._pdf.savefig(fig, dpi=PLOT_SETTINGS["dpi"])
+		except Exception:
+			# The row of a failed observation is left empty on the contact sheet
+			if self.mode == "sheet":
+				for ax in axes:
+					ax.remove()
+			raise
+		finally:
+			if self.mode == "pdf":
+				plt.close(fig)
+
+		self._npage += 1
+		self._writer.writerow([oid, fpath, os.path.basename(self._fname()), self._npage])
+		self._index.flush()
+		return
+
+	def close(self):
+		"""
+		Writes the last contact sheet and closes the files.
+		"""
+		self._close_file()
+		self._index.close()
+		return
 
 def log_error(errmsg):
 	"""
@@ -67,28 +227,256 @@ def log_error(errmsg):
 	return
 
 
+def model_overlays(fpath, mname, energy):
+	"""
+	Evaluates the other fitted models of an observation from their fit records.
+	Returns:
+		Dict: E^2 F(E) values on the given energies for each model with a record.
+	"""
+	overlays = {}
+	for oname in MODELS:
+		if oname == mname or oname not in EVAL_MODELS:
+			# Models without a NumPy evaluator are not overlaid
+			continue
+		found, params = params_from_records([fpath], oname)
+		if found:
+			overlays[oname] = eeuf(oname, energy, params)[0]
+	return overlays
+
+def display_data(fpath, mname, names=None, overlay=False, rebin=None):
+	"""
+	Reads the plot arrays of a model and rebins them for display.
+	Args:
+		rebin (dict): min_snr and max_bins overriding those of PLOT_SETTINGS.
+	Returns:
+		tuple: (spectrum, ratio, overlays) as used by plot_spectrum().
+	"""
+	settings = {**PLOT_SETTINGS, **(rebin or {})}
+	df_spect = read_plot_data(fpath, mname, "spec", names)
+	df_ratio = read_plot_data(fpath, mname, "ratio", names)
+	nchan = len(df_spect["xVals"])
+	starts = group_channels(df_spect["yVals"], df_spect["yErrs"], settings["min_snr"], settings["max_bins"])
+	if len(starts) < nchan:
+		df_spect = rebin_plot_data(df_spect, starts, COLUMNS["spec"])
+		if len(df_ratio["xVals"]) != nchan:
+			starts = group_channels(df_ratio["yVals"], df_ratio["yErrs"], settings["min_snr"], settings["max_bins"])
+		df_ratio = rebin_plot_data(df_ratio, starts, COLUMNS["ratio"])
+	overlays = model_overlays(fpath, mname, df_spect["xVals"]) if overlay else None
+	return df_spect, df_ratio, overlays
+
+def plot_key(cache, fpath, mname, names=None, overlay=False, dpi=None, rebin=None):
+	"""
+	Returns the cache key of a plot, built from its spectrum and ratio arrays (and the
+	fit records of the overlaid models), so it changes whenever they do. Without a cache
+	the key is built from the file hashes alone.
+	"""
+	inputs = [find_plot_data(fpath, mname, "spec", names), find_plot_data(fpath, mname, "ratio", names)]
+	if None in inputs:
+		raise FileNotFoundError(f"Spectrum or ratio data of {mname} not found in: {fpath}")
+	if overlay:
+		inputs += [os.path.join(fpath, f"{o}_fit.json") for o in MODELS if o != mname and os.path.exists(os.path.join(fpath, f"{o}_fit.json"))]
+	settings = {"model": mname, **PLOT_SETTINGS, **(rebin or {}), **({"dpi": dpi} if dpi else {}), **({"overlay": True} if overlay else {})}
+	if cache is None:
+		return content_key("plot_spec", inputs, settings)
+	return cache.make_key("plot_spec", inputs, settings)
+
+def render_plot(fpath, mname, cache=None, overlay=False, dpi=None, names=None, rebin=None):
+	"""
+	Renders the plot of one model on demand, again only when the plot arrays change.
+	With a cache the image is kept in the cache entry. Without one it is written to
+	{mname}_plot.png with its key in {mname}_plot.key, which also holds the mtime of the
+	image, so an image written since by plot_spec.py is not taken for the rendered one.
+	Returns:
+		str: Path of the image.
+	"""
+	ckey = plot_key(cache, fpath, mname, names, overlay, dpi, rebin)
+	if cache is not None:
+		image = cache.lookup(ckey, f"{mname}_plot.png")
+		if image is not None:
+			return image
+	else:
+		image = os.path.join(fpath, f"{mname}_plot.png")
+		kfile = os.path.join(fpath, f"{mname}_plot.key")
+		try:
+			with open(kfile, "r") as file:
+				prev = json.load(file)
+			if prev["key"] == ckey and prev["mtime"] == os.stat(image).st_mtime_ns:
+				return image
+		except (OSError, ValueError, KeyError):
+			pass
+	df_spect, df_ratio, overlays = display_data(fpath, mname, names, overlay, rebin)
+	if cache is None:
+		plot_spectrum(df_spect, fpath, mname, df_ratio, single_plot=PLOT_SETTINGS["single_plot"], overlays=overlays, dpi=dpi)
+		with open(kfile, "w") as file:
+			json.dump({"key": ckey, "mtime": os.stat(image).st_mtime_ns}, file)
+		return image
+	with tempfile.TemporaryDirectory() as tmp:
+		plot_spectrum(df_spect, fpath, mname, df_ratio, single_plot=PLOT_SETTINGS["single_plot"], overlays=overlays, out_dir=tmp, dpi=dpi)
+		cache.store(ckey, [os.path.join(tmp, f"{mname}_plot.png")], replace=True)
+	return cache.lookup(ckey, f"{mname}_plot.png")
+
+def plot_obs(fpath, cache=None, force=False, metrics=None, names=None, overlay=False, rebin=None, journal=None):
+	"""
+	Makes the spectrum plots of all models for one observation.
+	Args:
+		fpath (str): Path to the observation directory.
+		cache (ResultCache): Result cache, or None to always plot.
+		force (bool): Plot even on a cache hit.
+		metrics (Metrics): Records the time of each stage, or None.
+		names (frozenset): File names of the directory from the observation index, None to check on disk.
+		overlay (bool): Overlay the other models, evaluated from their fit records.
+		rebin (dict): Display rebinning overriding PLOT_SETTINGS, see display_data().
+		journal (FailureJournal): Records the failure, or None.
+	Returns:
+		str: The error message if the observation failed, None otherwise.
+	"""
+	print(f"\n>>> Making spectrum plot for Obs: {fpath}")
+	m = None
+	try:
+		with stage(metrics, "observation", fpath), profiling(metrics, fpath):
+			for m in MODELS:
+				if cache is not None:
+					ckey = plot_key(cache, fpath, m, names, overlay, rebin=rebin)
+					with stage(metrics, "cache", fpath, m):
+						restored = not force and cache.restore(ckey, fpath)
+					if restored:
+						print(f"> Restored {m} plot from cache.")
+						continue
+
+				with stage(metrics, "read", fpath, m):
+					df_spect, df_ratio, overlays = display_data(fpath, m, names, overlay, rebin)
+				with stage(metrics, "render", fpath, m):
+					plot_spectrum(df_spect=df_spect, fpath=fpath, mname=m, df_ratio=df_ratio, single_plot=PLOT_SETTINGS["single_plot"], overlays=overlays)
+				if cache is not None:
+					with stage(metrics, "cache", fpath, m):
+						cache.store(ckey, [os.path.join(fpath, f"{m}_plot.png")], replace=force)
+	except Exception as e:
+		tb = traceback.format_exc()
+		record_failure(journal, fpath, e, model=m)
+		print(f"> Error: {tb}")
+		print(f"> Error logged for {fpath}. Moving to next path.")
+		return f"- {fpath}:: {str(tb)}\n"
+
+	resolve_failure(journal, fpath)
+	return None
+
+def book_item(item, overlay=False, rebin=None, journal=None):
+	"""
+	Pool task: reads the plot arrays of all models of an observation for a PlotBook.
+	Returns:
+		tuple: (path, {model: display data}, error message or None)
+	"""
+	fpath, names = item
+	panels = {}
+	try:
+		for m in MODELS:
+			panels[m] = display_data(fpath, m, names, overlay, rebin)
+		return fpath, panels, None
+	except Exception as e:
+		record_failure(journal, fpath, e, model=m)
+		return fpath, None, f"- {fpath}:: {traceback.format_exc()}\n"
+
+def plot_book(items, book, workers=1, overlay=False, rebin=None, metrics=None, journal=None):
+	"""
+	Adds the observations to a PlotBook in list order. With workers > 1 the plot arrays
+	are read and rebinned in worker processes while this process draws the pages.
+	"""
+	task = functools.partial(book_item, overlay=overlay, rebin=rebin, journal=journal)
+	pool = multiprocessing.Pool(processes=workers) if workers > 1 else None
+	try:
+		results = pool.imap(task, items, chunksize=4) if pool else map(task, items)
+		for fpath, panels, error_msg in results:
+			print(f"\n>>> Adding spectrum plots of Obs: {fpath}")
+			if error_msg:
+				print(f"> Error: {error_msg}")
+				print(f"> Error logged for {fpath}. Moving to next path.")
+				log_error(error_msg)
+				continue
+			try:
+				with stage(metrics, "render", fpath):
+					book.add(fpath, panels)
+			except Exception as e:
+				# A page that fails to draw is skipped, the file goes on with the next one
+				record_failure(journal, fpath, e)
+				error_msg = f"- {fpath}:: {traceback.format_exc()}\n"
+				print(f"> Error: {error_msg}")
+				print(f"> Error logged for {fpath}. Moving to next path.")
+				log_error(error_msg)
+				continue
+			resolve_failure(journal, fpath)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return
+
+def add_rebin_args(parser):
+	"""
+	Adds the display rebinning options to an argument parser.
+	"""
+	parser.add_argument("--min-snr", type=float, default=PLOT_SETTINGS["min_snr"], help="Group channels to this signal-to-noise ratio per plotted bin")
+	parser.add_argument("--max-bins", type=int, default=PLOT_SETTINGS["max_bins"], help="Most plotted bins per spectrum, 0 for all (default: %(default)s)")
+	return
+
+def rebin_from_args(args):
+	"""
+	Returns the rebin settings selected by the command line options.
+	"""
+	return {"min_snr": args.min_snr, "max_bins": args.max_bins}
+
+def plot_item(item, **kwargs):
+	"""
+	Pool task: runs plot_obs() for an (observation, indexed file names) pair.
+	"""
+	return plot_obs(item[0], names=item[1], **kwargs)
+
+
 if __name__ == "__main__":
-	ip_path = sys.argv[1]
+	parser = argparse.ArgumentParser(description="Plot the spectra of the observations listed in a text file.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--workers", type=int, default=1, help="Number of plotting processes (default: 1)")
+	parser.add_argument("--max-tasks", type=int, default=200, help="Observations a worker plots before it is replaced (default: %(default)s)")
+	parser.add_argument("--overlay", action="store_true", help="Overlay the other models, evaluated from their fit records")
+	parser.add_argument("--output", choices=OUTPUTS, default="png", help="png: one image per model and observation, pdf: multi-page PDFs with a page per observation, sheet: PNG contact sheets (default: %(default)s)")
+	parser.add_argument("--out-prefix", type=str, default="spectra", help="File name prefix of the pdf and sheet outputs (default: %(default)s)")
+	parser.add_argument("--pages-per-file", type=int, default=PAGES_PER_FILE, help="Observations per PDF file (default: %(default)s)")
+	parser.add_argument("--sheet-rows", type=int, default=SHEET_ROWS, help="Observations per contact sheet (default: %(default)s)")
+	add_rebin_args(parser)
+	add_cache_args(parser)
+	add_metrics_args(parser)
+	add_index_args(parser)
+	add_journal_args(parser)
+	args = parser.parse_args()
+	cache = cache_from_args(args)
+	metrics = metrics_from_args(args, "plot_spec")
+	journal = journal_from_args(args, "plot")
+
+	ip_path = args.ip_path
 	with open(ip_path, 'r') as file:
 		file_paths = [line.strip() for line in file if line.strip()]
+	file_paths = retry_from_args(args, journal, file_paths)
+	index = index_from_args(args, file_paths)
+	items = [(fpath, index.names(fpath) if index else None) for fpath in file_paths]
 
-	for fpath in file_paths:
-		print(f"\n>>> Making spectrum plot for Obs: {fpath}")
+	task = functools.partial(plot_item, cache=cache, force=args.force, metrics=metrics, overlay=args.overlay, rebin=rebin_from_args(args), journal=journal)
+	if args.output != "png":
+		# The pages are drawn in this process, the per-image cache does not apply
+		book = PlotBook(args.out_prefix, args.output, args.pages_per_file, args.sheet_rows)
 		try:
-			morder = ["logpar", "powerlaw", "bknpower"]
-			for m in morder:
-				scsv = os.path.join(fpath, f"{m}_spec.csv")
-				rcsv = os.path.join(fpath, f"{m}_ratio.csv")
-
-				df_spect = pd.read_csv(scsv)
-				df_ratio = pd.read_csv(rcsv)
-
-				plot_spectrum(df_spect=df_spect, fpath=fpath, mname=m, df_ratio=df_ratio)
-		except Exception as e:
-			tb = traceback.format_exc()
-			error_msg = f"- {fpath}:: {str(tb)}\n"
-			log_error(error_msg)
-			print(f"> Error: {tb}")
-			print(f"> Error logged for {fpath}. Moving to next path.")
-			continue
+			plot_book(items, book, args.workers, args.overlay, rebin_from_args(args), metrics, journal)
+		finally:
+			book.close()
+	elif args.workers > 1:
+		# Recycling the workers keeps their memory flat over large batches
+		with multiprocessing.Pool(processes=args.workers, maxtasksperchild=args.max_tasks) as pool:
+			for error_msg in pool.imap(task, items, chunksize=1):
+				if error_msg:
+					log_error(error_msg)
+	else:
+		for item in items:
+			error_msg = task(item)
+			if error_msg:
+				log_error(error_msg)
 
+	if cache is not None:
+		cache.evict()
@@ -0,0 +1,126 @@
+"""
+On-demand spectrum plots, for runs with `run_xspec.py --lazy-plots` that only store the plot arrays.
+
+A plot is rendered when it is requested and kept, keyed on the hashes of its spectrum and
+ratio arrays: a later request is served without rendering until the arrays change. The
+image is kept next to the arrays ({model}_plot.png with its key in {model}_plot.key), or
+in the result cache with --cache. Plots are requested on the command line or through a small
+local web viewer that lists the observations of an obslist.
+
+command: `python plot_view.py render /data/6100110000 logpar [--out plot.png]`
+         `python plot_view.py serve obslist.txt --port 8000`
+"""
+
+import os
+import html
+import shutil
+import argparse
+import threading
+import traceback
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from result_cache import add_cache_args, cache_from_args
+from plot_spec import render_plot, add_rebin_args, rebin_from_args, MODELS
+
+VIEW_DPI = 100  # screen resolution, the images of plot_spec.py use PLOT_SETTINGS
+
+
+class ViewHandler(BaseHTTPRequestHandler):
+	"""
+	Serves the index page (/) and the plots (/plot/<observation number>/<model>.png).
+	"""
+	def do_GET(self):
+		parts = urllib.parse.urlparse(self.path).path.strip("/").split("/")
+		if parts == [""]:
+			self._send(200, "text/html; charset=utf-8", self.server.index_page().encode())
+			return
+		if len(parts) != 3 or parts[0] != "plot" or not parts[1].isdigit() or not parts[2].endswith(".png"):
+			self._send(404, "text/plain", b"Not found")
+			return
+		num, mname = int(parts[1]), parts[2][:-len(".png")]
+		if num >= len(self.server.file_paths) or mname not in MODELS:
+			self._send(404, "text/plain", b"Not found")
+			return
+		try:
+			image = self.server.render(self.server.file_paths[num], mname)
+			with open(image, "rb") as file:
+				self._send(200, "image/png", file.read())
+		except Exception as e:
+			traceback.print_exc()
+			self._send(500, "text/plain", f"Error: {e}".encode())
+
+	def _send(self, code, ctype, body):
+		self.send_response(code)
+		self.send_header("Content-Type", ctype)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, fmt, *args):
+		return
+
+
+class PlotViewer(ThreadingHTTPServer):
+	"""
+	Local web viewer of the plots of the observations in a list.
+	"""
+	daemon_threads = True
+
+	def __init__(self, address, file_paths, cache=None, overlay=False, dpi=VIEW_DPI, rebin=None):
+		self.file_paths = file_paths
+		self.cache = cache
+		self.overlay = overlay
+		self.dpi = dpi
+		self.rebin = rebin
+		# pyplot is not thread safe, plots are rendered one at a time
+		self._lock = threading.Lock()
+		super().__init__(address, ViewHandler)
+
+	def render(self, fpath, mname):
+		with self._lock:
+			return render_plot(fpath, mname, self.cache, self.overlay, self.dpi, rebin=self.rebin)
+
+	def index_page(self):
+		rows = []
+		for num, fpath in enumerate(self.file_paths):
+			links = " ".join(f'<a href="/plot/{num}/{m}.png">{m}</a>' for m in MODELS)
+			rows.append(f"<tr><td>{html.escape(os.path.basename(os.path.normpath(fpath)))}</td><td>{links}</td></tr>")
+		return ("<html><head><title>nicer-xspec plots</title></head><body>"
+			f"<table>{''.join(rows)}</table></body></html>")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Render spectrum plots on demand, on the command line or in a local web viewer.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p_render = sub.add_parser("render", help="Render the plot of one model of an observation")
+	p_render.add_argument("path", type=str, help="Observation directory")
+	p_render.add_argument("model", choices=MODELS, help="Model to plot")
+	p_render.add_argument("--out", type=str, default=None, help="Copy the image to this file (default: print its path)")
+	p_serve = sub.add_parser("serve", help="Serve the plots of the observations listed in a text file")
+	p_serve.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	p_serve.add_argument("--port", type=int, default=8000, help="Port on localhost (default: %(default)s)")
+	for sub_parser in (p_render, p_serve):
+		sub_parser.add_argument("--overlay", action="store_true", help="Overlay the other models, evaluated from their fit records")
+		sub_parser.add_argument("--dpi", type=int, default=VIEW_DPI, help="Resolution of the rendered images (default: %(default)s)")
+		add_rebin_args(sub_parser)
+		add_cache_args(sub_parser)
+	args = parser.parse_args()
+	cache = cache_from_args(args)
+
+	if args.command == "render":
+		image = render_plot(os.path.abspath(args.path), args.model, cache, args.overlay, args.dpi, rebin=rebin_from_args(args))
+		if args.out:
+			shutil.copyfile(image, args.out)
+			image = args.out
+		print(image)
+	else:
+		with open(args.ip_path, 'r') as file:
+			file_paths = [os.path.abspath(line.strip()) for line in file if line.strip()]
+		server = PlotViewer(("127.0.0.1", args.port), file_paths, cache, args.overlay, args.dpi, rebin_from_args(args))
+		print(f">>> Plot viewer on http://127.0.0.1:{args.port}/ for {len(file_paths)} observations")
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
@@ -1,49 +1,91 @@
 import re
 import os
-import sys
 import glob
+import json
 import yaml
 import numpy as np
 import pandas as pd
-
-
-def get_mparameters(lines, pnames):
+import argparse
+from result_cache import add_cache_args, cache_from_args
+from catalog import update_catalog, add_obs
+from metrics import stage, profiling, add_metrics_args, metrics_from_args
+from obs_index import role_files, add_index_args, index_from_args
+from model_registry import model_params
+from conf_intervals import read_intervals
+from failure_journal import record_failure, resolve_failure, add_journal_args, journal_from_args, retry_from_args
+
+MODEL_PARAMS = model_params()
+OUTPUTS = ["model_pm.csv", "model_ts.csv", "model_fx.csv"]
+
+SECTION_PATTERN = re.compile(r"={10,}")
+PARAM_PATTERN = re.compile(r"\b\d+\.\d+(?:[eE][+-]?\d{2})?\b")
+CHI_PATTERN = re.compile(r"\d+\.\d+")
+DOF_PATTERN = re.compile(r"\b\d+\b")
+FLUX_PATTERN = re.compile(r"\b\d+\.\d+[eE][+-]\d+\b")
+STAT_KEYS = ["Test statistic", "Null hypothesis", "Model Flux", "Error range"]
+
+
+def scan_xspec_log(lfile, keys):
 	"""
-	Extracts parameter values and errors from the lines.
+	Reads an Xspec log once, line by line, and keeps only the last section (the final fit block).
 	Args:
-		lines (list): Lines of text to search for parameters.
+		lfile (str): Path to the Xspec log file.
+		keys (list): Strings to look for.
+	Returns:
+		Dict: The first line of the last section containing each key that was found.
+	"""
+	found = {}
+	pending = list(keys)
+
+	with open(lfile, "r") as file:
+		for line in file:
+			if "==========" in line and SECTION_PATTERN.search(line):
+				# A new section starts, only the text after the separator belongs to it
+				line = SECTION_PATTERN.split(line)[-1]
+				found = {}
+				pending = list(keys)
+			if not pending:
+				continue
+			for key in [k for k in pending if k in line]:
+				found[key] = line
+				pending.remove(key)
+
+	return found
+
+def get_mparameters(plines, pnames):
+	"""
+	Extracts parameter values and errors from the parameter lines.
+	Args:
+		plines (dict): Line of the log for each parameter name.
 		pnames (list): List of parameter names to extract.
 	Returns:
 		OrderedDict: Extracted parameter data with value and error.
 	"""
-	num_pattern = r"\b\d+\.\d+(?:[eE][+-]?\d{2})?\b"
 	para_data = {}
 
 	for param in pnames:
-		line = next((line for line in lines if param in line), None)
+		line = plines.get(param)
 		if line:
-			values = re.findall(num_pattern, line)
+			values = PARAM_PATTERN.findall(line)
 			para_data[param] = {"value": values[0], "error": values[1] if len(values) > 1 else None}
 		else:
 			print(f"> Warning: Parameter '{param}' not found in the lines.")
 
 	return para_data
 
-def get_test_statistics(lines):
+def get_test_statistics(chi_line, dof_line):
 	"""
-	Extracts test statistics (Chi-Squared and DOF) from the lines.
-	Args:
-		lines (list): Lines of text to search for parameters.
+	Extracts test statistics (Chi-Squared and DOF) from the fit statistic lines.
 	Returns:
-		Dict: Extracted parameter data with value and error.
+		Dict: Extracted Chi-Squared and DOF.
 	"""
 	ts_data = {}
 
-	chi_line = next((line for line in lines if re.search(r"Test statistic", line)), None)
-	dof_line = next((line for line in lines if re.search(r"Null hypothesis", line)), None)
+	if chi_line is None or dof_line is None:
+		raise ValueError("Test statistic lines not found in the log.")
 
-	chi_val = re.findall(r"\d+\.\d+", chi_line)
-	dof_val = re.findall(r"\b\d+\b", dof_line)
+	chi_val = CHI_PATTERN.findall(chi_line)
+	dof_val = DOF_PATTERN.findall(dof_line)
 
 	if chi_val and dof_val:
 		ts_data["Chi-Squared"] = chi_val[0]
@@ -53,16 +95,17 @@ def get_test_statistics(lines):
 
 	return ts_data
 
-def get_flux_value(lines):
+def get_flux_value(flux_line, errr_line):
+	"""
+	Extracts the model flux and its error range from the flux lines.
+	"""
 	flux_data = {}
 
-	flux_line = next((line for line in lines if re.search(r"Model Flux", line)), None)
-	errr_line = next((line for line in lines if re.search(r"Error range", line)), None)
+	if flux_line is None or errr_line is None:
+		raise ValueError("Model flux lines not found in the log.")
 
-	num_pattern = r"\b\d+\.\d+[eE][+-]\d+\b"
-
-	flux_val = re.findall(num_pattern, flux_line)
-	errr_val = re.findall(num_pattern, errr_line)
+	flux_val = FLUX_PATTERN.findall(flux_line)
+	errr_val = FLUX_PATTERN.findall(errr_line)
 
 	if flux_val and errr_val:
 		flux_data["Flux"] = flux_val[0]
@@ -76,6 +119,7 @@ def get_flux_value(lines):
 def read_xspec_log(loglist, opath):
 	"""
 	Reads XSPEC log files, extracts model parameters, and writes them to a YAML file.
+	Each log is parsed in a single streaming pass over its lines.
 	Args:
 		loglist (list): List of paths to XSPEC log files.
 		opath (str): Path to save the output YAML file.
@@ -83,22 +127,17 @@ def read_xspec_log(loglist, opath):
 		Dict: model parameters and test statistics.
 	"""
 	model_data = {}
-	models = {
-		"logpar": ["alpha", "beta", "pivotE", "norm"],
-		"powerlaw": ["PhoIndex", "norm"],
-		"bknpower": ["PhoIndx1", "BreakE", "PhoIndx2", "norm"]}
+	models = MODEL_PARAMS
+	keys = list(models) + sorted({p for pnames in models.values() for p in pnames}) + STAT_KEYS
 
 	for lfile in loglist:
-		with open(lfile, 'r') as file:
-			lcontent = file.read()
-
-		sections = re.split(r"={10,}", lcontent)
-		mcontent = sections[-1]
+		found = scan_xspec_log(lfile, keys)
 
 		for model, param in models.items():
-			if model in mcontent:
-				lines = mcontent.strip().split('\n')
-				model_data[model] = {"parameters": get_mparameters(lines, param), "test_statistics": get_test_statistics(lines), "flux": get_flux_value(lines)}
+			if model in found:
+				model_data[model] = {"parameters": get_mparameters(found, param),
+					"test_statistics": get_test_statistics(found.get("Test statistic"), found.get("Null hypothesis")),
+					"flux": get_flux_value(found.get("Model Flux"), found.get("Error range"))}
 				break
 
 	# with open(f"{opath}/model_pms.yaml", 'w') as file:
@@ -106,6 +145,26 @@ def read_xspec_log(loglist, opath):
 
 	return model_data
 
+def read_fit_records(reclist):
+	"""
+	Reads the fit records ({model}_fit.json) written by run_xspec.py.
+	Args:
+		reclist (list): List of paths to the fit record files.
+	Returns:
+		Dict: model parameters, test statistics and flux, in the layout of read_xspec_log().
+	"""
+	model_data = {}
+	for rfile in reclist:
+		mname = os.path.basename(rfile)[:-len("_fit.json")]
+		with open(rfile, "r") as file:
+			model_data[mname] = json.load(file)
+		# Confidence intervals of conf_intervals.py, kept apart from the cached fit record
+		for param, conf in read_intervals(os.path.dirname(rfile), mname).items():
+			if param in model_data[mname]["parameters"]:
+				model_data[mname]["parameters"][param]["conf"] = conf
+
+	return model_data
+
 def extract_pm(data):
 	"""
 	Extracts model parameters from the given data and returns a DataFrame.
@@ -117,8 +176,13 @@ def extract_pm(data):
 	pm_data = []
 	for mname, minfo in data.items():
 		for param, values in minfo["parameters"].items():
-			pm_data.append([mname, param, values["value"], values["error"]])
-	pmdf = pd.DataFrame(pm_data, columns=["Model", "Parameter", "Value", "Error"])
+			# Confidence intervals of conf_intervals.py, only with fit records
+			conf = values.get("conf") or [None, None]
+			pm_data.append([mname, param, values["value"], values["error"], conf[0], conf[1]])
+	pmdf = pd.DataFrame(pm_data, columns=["Model", "Parameter", "Value", "Error", "ErrLow", "ErrHigh"])
+	if pmdf[["ErrLow", "ErrHigh"]].isna().all().all():
+		# No intervals were computed
+		pmdf = pmdf.drop(columns=["ErrLow", "ErrHigh"])
 
 	return pmdf
 
@@ -162,6 +226,77 @@ def process_df(df, morder):
 
 	return df
 
+def read_obs(fpath, cache=None, force=False, from_logs=False, catalog=None, metrics=None, names=None):
+	"""
+	Collects the fit results of one observation and writes the model_*.csv tables.
+	Args:
+		fpath (str): Path to the observation directory.
+		cache (ResultCache): Result cache, or None to always read.
+		force (bool): Read even on a cache hit and refresh the cache entry.
+		from_logs (bool): Parse the Xspec logs even when fit records are available.
+		catalog (str): Campaign catalog database to update, or None.
+		metrics (Metrics): Records the time of each stage, or None.
+		names (frozenset): File names of the directory from the observation index, None to glob.
+	"""
+	# Fit records written by run_xspec.py make parsing the logs unnecessary
+	if names is not None:
+		rec_files = role_files(fpath, names, "fit_record")
+	else:
+		rec_files = glob.glob(os.path.join(fpath, "*_fit.json"))
+	use_records = len(rec_files) == len(MODEL_PARAMS) and not from_logs
+	if use_records:
+		in_files = rec_files
+	else:
+		# Reading Xspec log files
+		in_files = role_files(fpath, names, "xspec_log") if names is not None else glob.glob(os.path.join(fpath, "*xspec.log"))
+		if len(in_files) != len(MODEL_PARAMS):
+			raise ValueError(f"Expected {len(MODEL_PARAMS)} Xspec log files, but found {len(in_files)}.")
+	if cache is not None:
+		# The intervals of conf_intervals.py change the tables without changing the fit records
+		key_files = in_files
+		if use_records:
+			key_files = in_files + (role_files(fpath, names, "fit_conf") if names is not None else glob.glob(os.path.join(fpath, "*_conf.json")))
+		ckey = cache.make_key("read_log", key_files, {"models": MODEL_PARAMS})
+		with stage(metrics, "cache", fpath):
+			restored = not force and cache.restore(ckey, fpath)
+		if restored:
+			print("> Restored from cache.")
+			if catalog:
+				with stage(metrics, "catalog", fpath):
+					add_obs(catalog, fpath)
+			return
+	with stage(metrics, "read", fpath):
+		mdata = read_fit_records(in_files) if use_records else read_xspec_log(in_files, fpath)
+	if not mdata:
+		raise ValueError("Model parameters were not collected successfully.")
+
+	# print(mdata)
+
+	# Get model parameter and test statistics as tables
+	mdf = extract_pm(mdata)
+	tdf = extract_ts(mdata)
+	fdf = extract_fx(mdata)
+	# Models in the order of the registry
+	morder = list(MODEL_PARAMS)
+	mdf = process_df(mdf, morder)
+	tdf = process_df(tdf, morder)
+	fdf = process_df(fdf, morder)
+	# Print and save the tables
+	print(f"\nThe model parameter table:\n{mdf}\n")
+	print(f"The model test statistics table:\n{tdf}\n")
+	print(f"The model flux table (ergs/cm^2/s):\n{fdf}\n")
+	with stage(metrics, "write", fpath):
+		mdf.to_csv(os.path.join(fpath, "model_pm.csv"), index=False)
+		tdf.to_csv(os.path.join(fpath, "model_ts.csv"), index=False)
+		fdf.to_csv(os.path.join(fpath, "model_fx.csv"), index=False)
+	if catalog:
+		with stage(metrics, "catalog", fpath):
+			update_catalog(catalog, fpath, mdf, tdf, fdf)
+	if cache is not None:
+		with stage(metrics, "cache", fpath):
+			cache.store(ckey, [os.path.join(fpath, f) for f in OUTPUTS], replace=force)
+	return
+
 def log_error(errmsg):
 	"""
 	Helper function for logging errors
@@ -171,43 +306,40 @@ def log_error(errmsg):
 	return
 
 if __name__ == "__main__":
-	ip_path = sys.argv[1]
+	parser = argparse.ArgumentParser(description="Read the Xspec log files of the observations listed in a text file.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--catalog", type=str, help="Campaign catalog database updated with the results of each observation")
+	parser.add_argument("--from-logs", action="store_true", help="Parse the Xspec logs even when fit records are available")
+	add_cache_args(parser)
+	add_metrics_args(parser)
+	add_index_args(parser)
+	add_journal_args(parser)
+	args = parser.parse_args()
+	cache = cache_from_args(args)
+	metrics = metrics_from_args(args, "read_log")
+	journal = journal_from_args(args, "read")
+
+	ip_path = args.ip_path
 	with open(ip_path, 'r') as file:
 		file_paths = [line.strip() for line in file if line.strip()]
+	file_paths = retry_from_args(args, journal, file_paths)
+	index = index_from_args(args, file_paths)
 
 	for fpath in file_paths:
 		print(f"\n>>> Running Xspec analysis for Obs: {fpath}")
 
 		try:
-			# Reading Xspec log files
-			log_files = glob.glob(os.path.join(fpath, "*xspec.log"))
-			if len(log_files) != 3:
-				raise ValueError(f"Expected 3 Xspec log files, but found {len(log_files)}.")
-			mdata = read_xspec_log(log_files, fpath)
-			if not mdata:
-				raise ValueError("Model parameters were not collected successfully.")
-
-			# print(mdata)
-
-			# Get model parameter and test statistics as tables
-			mdf = extract_pm(mdata)
-			tdf = extract_ts(mdata)
-			fdf = extract_fx(mdata)
-			# Define model order and process DataFrames (Not really needed)
-			morder = ["powerlaw", "bknpower", "logpar"]
-			mdf = process_df(mdf, morder)
-			tdf = process_df(tdf, morder)
-			fdf = process_df(fdf, morder)
-			# Print and save the tables
-			print(f"\nThe model parameter table:\n{mdf}\n")
-			print(f"The model test statistics table:\n{tdf}\n")
-			print(f"The model flux table (ergs/cm^2/s):\n{fdf}\n")
-			mdf.to_csv(os.path.join(fpath, "model_pm.csv"), index=False)
-			tdf.to_csv(os.path.join(fpath, "model_ts.csv"), index=False)
-			fdf.to_csv(os.path.join(fpath, "model_fx.csv"), index=False)
+			with stage(metrics, "observation", fpath), profiling(metrics, fpath):
+				read_obs(fpath, cache=cache, force=args.force, from_logs=args.from_logs, catalog=args.catalog, metrics=metrics,
+					names=index.names(fpath) if index else None)
 		except Exception as e:
 			error_msg = f"- {fpath}:: {str(e)}\n"
 			log_error(error_msg)
+			record_failure(journal, fpath, e)
 			print(f"> Error: {e}")
 			print(f"> Error logged for {fpath}. Moving to next path.")
-			continue
\ No newline at end of file
+			continue
+		resolve_failure(journal, fpath)
+
+	if cache is not None:
+		cache.evict()
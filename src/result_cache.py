@@ -0,0 +1,242 @@
+"""
+Content-addressed cache for the outputs of run_xspec.py, read_log.py and plot_spec.py.
+
+An entry is keyed on the hashes of the input files of a stage and on its settings.
+Every entry is a directory holding copies of the output files, so unchanged
+observations can be restored instead of being processed again. The scripts use the
+cache only when asked to (--cache or --cache-dir).
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nicer-xspec")
+DEFAULT_SIZE = 10.0  # GB
+TMP_MAX_AGE = 3600  # seconds, older temporary entries are left by killed writers
+
+
+def hash_file(fpath, bsize=1 << 20):
+	"""
+	Returns the SHA-256 hex digest of a file.
+	"""
+	digest = hashlib.sha256()
+	with open(fpath, "rb") as file:
+		for block in iter(lambda: file.read(bsize), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+def content_key(stage, inputs, settings, hasher=hash_file):
+	"""
+	Builds the key of a stage from the hashes of its input files and its settings.
+	Args:
+		stage (str): Name of the pipeline stage.
+		inputs (list): Paths of the input files.
+		settings (dict): JSON serializable settings that change the outputs.
+		hasher (callable): Returns the hex digest of a file.
+	Returns:
+		str: The key.
+	"""
+	digest = hashlib.sha256(stage.encode())
+	digest.update(json.dumps(settings, sort_keys=True).encode())
+	for fpath in sorted(inputs, key=os.path.basename):
+		digest.update(os.path.basename(fpath).encode())
+		digest.update(hasher(fpath).encode())
+	return digest.hexdigest()
+
+def pha_inputs(pha):
+	"""
+	Returns the spectrum together with the response, arf and background files named in its header.
+	Args:
+		pha (str): Path to the PHA file.
+	Returns:
+		list: Paths of the files that make up the spectrum.
+	"""
+	with open(pha, "rb") as file:
+		head = file.read(2880 * 20)
+
+	files = [pha]
+	for match in re.finditer(rb"(?:RESPFILE|ANCRFILE|BACKFILE)= *'([^']*)'", head):
+		name = match.group(1).decode("ascii", "ignore").strip()
+		if name and name.lower() != "none":
+			fpath = os.path.join(os.path.dirname(pha), name)
+			if os.path.isfile(fpath):
+				files.append(fpath)
+
+	return files
+
+
+class ResultCache:
+	"""
+	Output cache with a size limit and least-recently-used eviction.
+	Entries are written to a temporary directory and renamed into place, so
+	several processes can share one cache directory without locking.
+	"""
+	def __init__(self, cache_dir=DEFAULT_DIR, max_gb=DEFAULT_SIZE):
+		self.cache_dir = cache_dir
+		self.max_bytes = int(max_gb * 1024**3)
+		self.objects = os.path.join(cache_dir, "objects")
+		self._hashes = {}
+		os.makedirs(self.objects, exist_ok=True)
+
+	def _hash(self, fpath):
+		"""
+		Hashes a file, reusing the digest while its size and mtime are unchanged.
+		"""
+		st = os.stat(fpath)
+		mkey = (os.path.abspath(fpath), st.st_size, st.st_mtime_ns)
+		if mkey not in self._hashes:
+			self._hashes[mkey] = hash_file(fpath)
+		return self._hashes[mkey]
+
+	def warm(self, inputs):
+		"""
+		Hashes input files ahead of make_key(), e.g. while another observation is being fitted.
+		"""
+		for fpath in inputs:
+			self._hash(fpath)
+		return
+
+	def make_key(self, stage, inputs, settings):
+		"""
+		Builds the cache key of a stage from its input files and settings.
+		Args:
+			stage (str): Name of the pipeline stage.
+			inputs (list): Paths of the input files.
+			settings (dict): JSON serializable settings that change the outputs.
+		Returns:
+			str: The cache key.
+		"""
+		return content_key(stage, inputs, settings, self._hash)
+
+	def restore(self, key, dest):
+		"""
+		Copies the outputs of a cache entry into the destination directory.
+		Returns:
+			bool: True on a cache hit, False otherwise.
+		"""
+		edir = os.path.join(self.objects, key)
+		meta = os.path.join(edir, "meta.json")
+		try:
+			with open(meta, "r") as file:
+				files = json.load(file)["files"]
+			for name in files:
+				shutil.copy2(os.path.join(edir, name), os.path.join(dest, name))
+			os.utime(meta)
+		except (OSError, ValueError, KeyError):
+			return False
+		return True
+
+	def lookup(self, key, name):
+		"""
+		Returns the path of an output file inside a cache entry, without copying it.
+		Returns:
+			str: Path of the file, or None on a cache miss.
+		"""
+		edir = os.path.join(self.objects, key)
+		fpath = os.path.join(edir, name)
+		if not os.path.exists(fpath):
+			return None
+		try:
+			os.utime(os.path.join(edir, "meta.json"))
+		except OSError:
+			return None
+		return fpath
+
+	def store(self, key, files, replace=False):
+		"""
+		Stores the output files under the given key.
+		Args:
+			key (str): The cache key.
+			files (list): Paths of the output files.
+			replace (bool): Replace an existing entry with the same key.
+		"""
+		edir = os.path.join(self.objects, key)
+		if os.path.exists(edir):
+			if not replace:
+				return
+			shutil.rmtree(edir, ignore_errors=True)
+		tmp = os.path.join(self.cache_dir, f"tmp.{os.getpid()}.{key}")
+		shutil.rmtree(tmp, ignore_errors=True)
+		os.makedirs(tmp)
+		for fpath in files:
+			shutil.copy2(fpath, os.path.join(tmp, os.path.basename(fpath)))
+		with open(os.path.join(tmp, "meta.json"), "w") as file:
+			json.dump({"files": [os.path.basename(f) for f in files], "created": time.time()}, file)
+		try:
+			os.rename(tmp, edir)
+		except OSError:
+			# Another process stored the same entry first
+			shutil.rmtree(tmp, ignore_errors=True)
+		return
+
+	def evict(self):
+		"""
+		Removes the least recently used entries until the cache fits its size limit, and the
+		temporary entries of writers that were killed before renaming them into place.
+		Other processes may store or evict entries at the same time.
+		Returns:
+			int: Number of removed entries.
+		"""
+		now = time.time()
+		with os.scandir(self.cache_dir) as it:
+			for entry in it:
+				try:
+					if entry.name.startswith("tmp.") and now - entry.stat().st_mtime > TMP_MAX_AGE:
+						shutil.rmtree(entry.path, ignore_errors=True)
+				except OSError:
+					continue
+
+		entries = []
+		total = 0
+		with os.scandir(self.objects) as it:
+			for entry in it:
+				try:
+					if not entry.is_dir():
+						continue
+					with os.scandir(entry.path) as files:
+						size = sum(f.stat().st_size for f in files)
+				except OSError:
+					# Removed or replaced by another process meanwhile
+					continue
+				try:
+					atime = os.stat(os.path.join(entry.path, "meta.json")).st_mtime
+				except OSError:
+					atime = 0.0
+				entries.append((atime, size, entry.path))
+				total += size
+
+		removed = 0
+		for atime, size, epath in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			shutil.rmtree(epath, ignore_errors=True)
+			total -= size
+			removed += 1
+
+		return removed
+
+
+def add_cache_args(parser):
+	"""
+	Adds the cache options shared by the pipeline scripts to an argument parser.
+	"""
+	parser.add_argument("--cache", action="store_true", help="Use the result cache")
+	parser.add_argument("--cache-dir", type=str, default=None, help=f"Result cache directory, implies --cache (default: {DEFAULT_DIR})")
+	parser.add_argument("--cache-size", type=float, default=DEFAULT_SIZE, help="Cache size limit in GB (default: %(default)s)")
+	parser.add_argument("--no-cache", action="store_true", help="Do not use the result cache (the default, overrides --cache)")
+	parser.add_argument("--force", action="store_true", help="Recompute everything and refresh the cache")
+	return
+
+def cache_from_args(args):
+	"""
+	Returns the ResultCache selected by the command line options, or None when disabled.
+	"""
+	if args.no_cache or not (args.cache or args.cache_dir):
+		return None
+	cache = ResultCache(args.cache_dir or DEFAULT_DIR, args.cache_size)
+	print(f">>> Result cache: {os.path.abspath(cache.cache_dir)} (limit {args.cache_size:g} GB)")
+	return cache
@@ -1,118 +1,871 @@
 import os
-import re
+import csv
 import sys
 import glob
+import json
+import time
+import signal
+import argparse
+import functools
+import multiprocessing
 import numpy as np
-from xspec import AllData, Xset, Spectrum, Model, Fit, AllModels, Plot
+from xspec import AllData, Xset, Spectrum, Fit, AllModels, Plot
 import traceback
+from result_cache import pha_inputs, add_cache_args, cache_from_args
+from plot_data import write_plot_data, FORMATS
+from metrics import stage, profiling, add_metrics_args, metrics_from_args
+from obs_index import role_files, add_index_args, index_from_args
+from work_queue import WorkQueue, STALE_AFTER
+from pipeline import prefetch, BackgroundWriter
+from flux_draws import record_flux_range
+from model_registry import load_registry, new_model, warm_starts
+from failure_journal import record_failure, resolve_failure, add_journal_args, journal_from_args, retry_from_args
+
+ERROR_LOG = "failed_obs.txt"
+
+# Model expressions and initial values, see models.yaml
+MODEL_DEFS = load_registry()
+MODELS = list(MODEL_DEFS)
+IGNORE_BAND = "**-0.4,10.0-**"
+FLUX_BAND = "0.4 10.0"
+N_ITERATIONS = 100
+STAT_METHOD = "chi"
+LOG_CHATTER = 20
+FLUX_ERRORS = ["xspec", "covariance"]
+SLICE_PATTERN = "*.pha"
+SLICE_TABLE = "slice_fits.csv"
+SLICE_COLUMNS = ["Slice", "Model", "Parameter", "Value", "Error", "Lower", "Upper"]
+PIPELINE_DEPTH = 2  # observations prefetched ahead in --pipeline mode
+
+# Warm start: parameters seeded from the converged fit of another model of the same observation, see models.yaml
+WARM_START = warm_starts()
+WARM_START_MODES = ["none", "model", "epoch"]
 
 def check_file(filepath, pattern):
 	file_match = glob.glob(os.path.join(filepath, pattern))
 	return file_match[0] if file_match else None
 
 def log_error(errmsg, cpath):
-	with open(f"{cpath}/failed_obs.txt", "a") as file:
+	with open(f"{cpath}/{ERROR_LOG}", "a") as file:
 		file.write(errmsg)
 	return
 
-def run_xspec(pha, path, mname):
+def merge_error_logs(cpath, run_id):
+	"""
+	Appends the per-worker failure logs of a run to failed_obs.txt and removes them.
+	failed_obs.txt is only created when a worker logged a failure.
+	"""
+	for part in sorted(glob.glob(os.path.join(cpath, f"failed_obs.{run_id}.*.txt"))):
+		with open(part, "r") as pfile:
+			errmsg = pfile.read()
+		if errmsg:
+			with open(f"{cpath}/failed_obs.txt", "a") as file:
+				file.write(errmsg)
+		os.remove(part)
+	return
+
+def load_spectrum(pha):
+	"""
+	Loads the spectrum with its response and background and applies the ignore ranges.
+	"""
 	AllData.clear()
+	s1 = Spectrum(pha)
+	AllData.ignore("bad")
+	s1.ignore(IGNORE_BAND)
+	return s1
 
-	ch = Xset.chatter
-	Xset.chatter = 0
-	lch = Xset.logChatter
-	Xset.logChatter = 20
+def set_model(mname, seeds=None):
+	"""
+	Replaces the current model with the given one and sets its initial parameter values.
+	Values in seeds ({"component.parameter": value}) override the defaults of MODEL_DEFS.
+	"""
+	if mname not in MODEL_DEFS:
+		raise ValueError("Unknown model. Check.")
+	return new_model(mname, seeds)
+
+def perform_fit(max_iter=N_ITERATIONS, count=False):
+	"""
+	Runs the fit. With count, it runs one iteration at a time so the number of iterations
+	is known (for the warm start reports); the fit then stops when the statistic changes
+	by less than Fit.criticalDelta, the convergence test Xspec applies itself, or after
+	max_iter iterations.
+	Returns:
+		int: Number of iterations used, or None without count.
+	"""
+	Fit.query = "no"
+	if not count:
+		Fit.perform()
+		return None
+	Fit.nIterations = 1
+	last = None
+	niter = 0
+	while niter < max_iter:
+		Fit.perform()
+		niter += 1
+		if last is not None and abs(last - Fit.statistic) < Fit.criticalDelta:
+			break
+		last = Fit.statistic
+	Fit.nIterations = max_iter
+	return niter
+
+def read_record(path, mname):
+	"""
+	Reads the stored fit record of a model, or returns None if there is none.
+	"""
+	try:
+		with open(f"{path}/{mname}_fit.json", "r") as file:
+			return json.load(file)
+	except (OSError, ValueError):
+		return None
+
+def epoch_seeds(prev_path, mname):
+	"""
+	Returns the free parameter values of a model fitted to the previous epoch, or an empty dict.
+	"""
+	rec = read_record(prev_path, mname) if prev_path else None
+	if rec is None:
+		return {}
+	comp = MODEL_DEFS[mname]["component"]
+	return {f"{comp}.{p}": v["value"] for p, v in rec["parameters"].items() if v["error"] is not None}
+
+def model_seeds(path, mname):
+	"""
+	Returns the parameter values of a model seeded from the fit of its warm start model
+	(see WARM_START) of the same observation, or an empty dict.
+	"""
+	wstart = WARM_START.get(mname)
+	rec = read_record(path, wstart["from"]) if wstart else None
+	if rec is None:
+		return {}
+	return {key: rec["parameters"][p]["value"] for key, p in wstart["params"].items()}
+
+def fit_record(m1, s1, mname):
+	"""
+	Collects the fit results directly from the PyXspec objects.
+	Args:
+		m1 (Model): The fitted model.
+		s1 (Spectrum): The fitted spectrum, holding the result of the last flux calculation.
+		mname (str): Name of the model, its component (see models.yaml) holds the recorded parameters.
+	Returns:
+		Dict: Parameters with sigma, test statistics and flux, in the layout of read_log.read_xspec_log().
+	"""
+	comp = getattr(m1, MODEL_DEFS[mname]["component"])
+	params = {}
+	for pname in comp.parameterNames:
+		par = getattr(comp, pname)
+		params[pname] = {"value": par.values[0], "error": None if par.frozen else par.sigma}
+
+	flux = s1.flux
+	return {"parameters": params,
+		"test_statistics": {"Chi-Squared": Fit.statistic, "DOF": Fit.dof},
+		"flux": {"Flux": flux[0], "Flux_Err_Min": flux[1], "Flux_Err_Max": flux[2]},
+		"covariance": fit_covariance(m1)}
+
+def fit_covariance(m1):
+	"""
+	Returns the covariance matrix of the last fit with the names ("component.parameter")
+	of the free parameters it refers to, in parameter index order.
+	"""
+	free = []
+	for cname in m1.componentNames:
+		comp = getattr(m1, cname)
+		for pname in comp.parameterNames:
+			par = getattr(comp, pname)
+			if not par.frozen and not getattr(par, "link", ""):
+				free.append(f"{cname}.{pname}")
+
+	# Fit.covariance holds the lower triangle, row by row
+	packed = list(Fit.covariance)
+	n = len(free)
+	if len(packed) != n * (n + 1) // 2:
+		return None
+	matrix = np.zeros((n, n))
+	matrix[np.tril_indices(n)] = packed
+	matrix = matrix + np.tril(matrix, -1).T
+	return {"parameters": free, "matrix": matrix.tolist()}
+
+def flux_from_covariance(record, mname):
+	"""
+	Replaces the flux range of a record by the one drawn from its fit covariance.
+	The relative range is applied to the Xspec flux, so the value stays the one of Xspec.
+	"""
+	if record["covariance"] is None:
+		raise ValueError(f"No fit covariance for the {mname} flux range.")
+	band = tuple(float(v) for v in FLUX_BAND.split())
+	flux, low, high = record_flux_range(record, mname, band)
+	scale = record["flux"]["Flux"] / flux
+	record["flux"]["Flux_Err_Min"] = low * scale
+	record["flux"]["Flux_Err_Max"] = high * scale
+	return
+
+def fit_model(s1, path, mname, out_format="csv", seeds=None, seed_from=None, metrics=None, writer=None, flux_errors="xspec", lazy_plots=False, count_iterations=False, save_state=False):
+	"""
+	Fits one model to the loaded spectrum and saves its log, plot, spectrum and ratio files
+	together with a structured record of the fit results ({mname}_fit.json).
+	The spectrum and ratio arrays are written as .csv or .npy depending on out_format.
+	Args:
+		seeds (dict): Initial parameter values overriding the defaults (warm start).
+		seed_from (str): Where the seeds come from, stored in the record.
+		metrics (Metrics): Records the time of each step, or None.
+		writer (BackgroundWriter): Writes the spectrum and ratio arrays in the background, or None.
+		flux_errors (str): "xspec" for the calcFlux error estimate, "covariance" to draw it from the fit covariance.
+		lazy_plots (bool): Skip the PostScript plot, only the plot arrays are saved.
+		count_iterations (bool): Count the fit iterations (warm start runs and --count-iterations), see perform_fit().
+		save_state (bool): Save the best-fit state ({mname}_model.xcm) for conf_intervals.py.
+	Returns:
+		int: Number of fit iterations, or None if not counted.
+	"""
 	logFile = Xset.openLog(f"{path}/{mname}_xspec.log")
 	logFile = Xset.log
 
-	# Loading data
-	s1 = Spectrum(pha)
-	AllData.ignore("bad")
-	s1.ignore("**-0.4,10.0-**")
-
-	# Define model and its parameters
-	nh_val = 0.0131
-	if mname == "logpar":
-		m1 = Model("tbabs*logpar")
-		m1.TBabs.nH = nh_val
-		m1.TBabs.nH.frozen = True
-		m1.logpar.alpha = 1.0
-		m1.logpar.beta = 1.0
-	elif mname == "powerlaw":
-		m1 = Model("tbabs*powerlaw")
-		m1.TBabs.nH = nh_val
-		m1.TBabs.nH.frozen = True
-		m1.powerlaw.PhoIndex = 1.0
-	elif mname == "bknpower":
-		m1 = Model("tbabs*bknpower")
-		m1.TBabs.nH = nh_val
-		m1.TBabs.nH.frozen = True
-		m1.bknpower.PhoIndx1 = 1.0
-		m1.bknpower.PhoIndx2 = 1.0
-	else:
-		raise ValueError("Unknown model. Check.")
+	m1 = set_model(mname, seeds)
 
-	Fit.nIterations = 100
-	Fit.statMethod = "chi"
-	Fit.perform()
-	Fit.show()
+	with stage(metrics, "fit", path, mname):
+		niter = perform_fit(count=count_iterations)
+		Fit.show()
 
-	AllModels.calcFlux("0.4 10.0 err")
+	with stage(metrics, "flux", path, mname):
+		AllModels.calcFlux(f"{FLUX_BAND} err" if flux_errors == "xspec" else FLUX_BAND)
 
-	# Plotting
-	Plot.device = f"{path}/{mname}_plot.ps"
-	Plot.xAxis = "keV"
-	Plot.xLog = True
-	Plot.yLog = True
-	Plot("eeufspec", "ratio")
+	record = fit_record(m1, s1, mname)
+	if flux_errors == "covariance":
+		with stage(metrics, "flux_draws", path, mname):
+			flux_from_covariance(record, mname)
+	record["iterations"] = niter
+	record["seed"] = seed_from
+	cold = report_iterations(read_record(path, mname), record, mname)
+	if cold is not None:
+		record["cold_iterations"] = cold
+	with open(f"{path}/{mname}_fit.json", "w") as file:
+		json.dump(record, file)
+
+	# Plotting, left to plot_view.py in lazy mode
+	if not lazy_plots:
+		with stage(metrics, "plot_ps", path, mname):
+			Plot.device = f"{path}/{mname}_plot.ps"
+			Plot.xAxis = "keV"
+			Plot.xLog = True
+			Plot.yLog = True
+			Plot("eeufspec", "ratio")
+	elif os.path.exists(f"{path}/{mname}_plot.ps"):
+		# A plot of an earlier fit would not match the new arrays
+		os.remove(f"{path}/{mname}_plot.ps")
 
 	# Saving the spectrum and ratio plot data
-	Plot.device = "/null"
-	Plot("eeufspec")
-	xVals = Plot.x()
-	yVals = Plot.y()
-	modVals = Plot.model()
-	yErrs = Plot.yErr()
-	dataM = np.column_stack((xVals, yVals, yErrs, modVals))
-	np.savetxt(f"{path}/{mname}_spec.csv", dataM, delimiter=",", header="xVals,yVals,yErrs,modVals", comments="")
-	Plot("ratio")
-	xVals = Plot.x()
-	yVals = Plot.y()
-	yErrs = Plot.yErr()
-	dataR = np.column_stack((xVals, yVals, yErrs))
-	np.savetxt(f"{path}/{mname}_ratio.csv", dataR, delimiter=",", header="xVals,yVals,yErrs", comments="")
-
-	# Xset.save(f"{path}/{mname}_model.xcm", info='m')
-	AllData.clear()
+	with stage(metrics, "plot_data", path, mname):
+		Plot.device = "/null"
+		Plot("eeufspec")
+		xVals = Plot.x()
+		yVals = Plot.y()
+		modVals = Plot.model()
+		yErrs = Plot.yErr()
+		Plot("ratio")
+		rxVals = Plot.x()
+		ryVals = Plot.y()
+		ryErrs = Plot.yErr()
+	with stage(metrics, "write", path, mname):
+		if writer is not None:
+			writer.submit(path, write_plot_data, path, mname, "spec", [xVals, yVals, yErrs, modVals], fmt=out_format)
+			writer.submit(path, write_plot_data, path, mname, "ratio", [rxVals, ryVals, ryErrs], fmt=out_format)
+		else:
+			write_plot_data(path, mname, "spec", [xVals, yVals, yErrs, modVals], fmt=out_format)
+			write_plot_data(path, mname, "ratio", [rxVals, ryVals, ryErrs], fmt=out_format)
+
+	# Best-fit state (data and model) for the confidence intervals of conf_intervals.py
+	remove_state(path, mname)
+	if save_state:
+		Xset.save(f"{path}/{mname}_model.xcm", info='a')
 	Xset.closeLog()
 
+	return niter
+
+def remove_state(path, mname):
+	"""
+	Removes the saved best-fit state of a model, which no longer matches its fit record.
+	"""
+	if os.path.exists(f"{path}/{mname}_model.xcm"):
+		os.remove(f"{path}/{mname}_model.xcm")
+	return
+
+def report_iterations(old, new, mname):
+	"""
+	Prints the iterations of a warm-started fit and how many it saved compared
+	with the counted cold fit of the same model: the stored record when it is a cold
+	fit (--count-iterations), otherwise the reference carried by the stored warm fit.
+	Returns:
+		int: Iterations of the cold fit to keep as the reference, or None.
+	"""
+	if new["seed"] is None:
+		return None
+	old = old or {}
+	cold = old.get("iterations") if old.get("seed") is None else old.get("cold_iterations")
+	msg = f"> Warm start of {mname} from {new['seed']}: {new['iterations']} iterations"
+	if cold is not None:
+		msg += f", {cold - new['iterations']} saved compared with the cold fit ({cold})"
+	print(msg)
+	return cold
+
+def fit_settings(mname, log_chatter=LOG_CHATTER, out_format="csv", warm_start="none", seeds=None, flux_errors="xspec", lazy_plots=False, count_iterations=False, save_state=False):
+	"""
+	Returns the settings that determine the fit outputs of a model, used in the cache key.
+	"""
+	settings = {"model": mname, "definition": MODEL_DEFS[mname], "ignore": IGNORE_BAND,
+		"flux": FLUX_BAND, "nIterations": N_ITERATIONS, "statMethod": STAT_METHOD, "logChatter": log_chatter,
+		"format": out_format, "warmStart": warm_start, "seeds": seeds}
+	if flux_errors != "xspec":
+		# Only added when set, so the entries of earlier runs keep their keys
+		settings["fluxErrors"] = flux_errors
+	if lazy_plots:
+		settings["lazyPlots"] = True
+	if count_iterations and warm_start == "none":
+		# Counted fits run one iteration at a time; warm start runs always count
+		settings["countIterations"] = True
+	if save_state:
+		settings["saveState"] = True
+	return settings
+
+def model_outputs(path, mname):
+	"""
+	Returns the output files written by fit_model() for a model.
+	"""
+	names = [f"{mname}_xspec.log", f"{mname}_plot.ps", f"{mname}_fit.json", f"{mname}_model.xcm"]
+	names += [f"{mname}_{kind}.{fmt}" for kind in ("spec", "ratio") for fmt in FORMATS]
+	return [os.path.join(path, n) for n in names if os.path.exists(os.path.join(path, n))]
+
+def store_outputs(cache, key, path, mname, force=False):
+	"""
+	Stores the outputs of a fitted model in the cache.
+	"""
+	cache.store(key, model_outputs(path, mname), replace=force)
+	return
+
+def run_xspec(pha, path, models=MODELS, cache=None, force=False, log_chatter=LOG_CHATTER, out_format="csv",
+		warm_start="none", prev_path=None, on_fit=None, metrics=None, writer=None, flux_errors="xspec", lazy_plots=False, count_iterations=False,
+		save_state=False):
+	"""
+	Runs one fitting session for an observation: the spectrum is loaded once and
+	every model in the list is fitted to it in turn. Models whose inputs and
+	settings are unchanged since a cached run are restored instead of fitted.
+	With a warm start the powerlaw is fitted first and seeds bknpower and logpar;
+	in "epoch" mode each model is seeded from its stored fit of the previous epoch
+	when there is one.
+	Args:
+		pha (str): Path to the source spectrum.
+		path (str): Observation directory where the outputs are saved.
+		models (list): Names of the models to fit, see MODEL_DEFS.
+		cache (ResultCache): Result cache, or None to always fit.
+		force (bool): Fit even on a cache hit and refresh the cache entry.
+		log_chatter (int): Chatter level of the Xspec log files.
+		out_format (str): Format of the spectrum and ratio arrays, "csv" or "npy".
+		warm_start (str): "none", "model" or "epoch", see WARM_START_MODES.
+		prev_path (str): Observation directory of the previous epoch, used in "epoch" mode.
+		on_fit (callable): Called with the model name before each fit.
+		metrics (Metrics): Records the time of each stage, or None.
+		writer (BackgroundWriter): Writes the arrays and stores the cache entries in the background, or None.
+		flux_errors (str): Source of the flux range, see FLUX_ERRORS.
+		lazy_plots (bool): Skip the PostScript plots, see fit_model().
+		count_iterations (bool): Count the iterations of cold fits too, the reference of later warm starts.
+		save_state (bool): Save the best-fit states for conf_intervals.py, see fit_model().
+	"""
+	eseeds = {}
+	if warm_start != "none":
+		# The models other models are warm started from are fitted first
+		sources = [mname for mname in models if any(w["from"] == mname for w in WARM_START.values())]
+		models = sources + [mname for mname in models if mname not in sources]
+	if warm_start == "epoch":
+		eseeds = {mname: epoch_seeds(prev_path, mname) for mname in models}
+
+	keys = {}
+	if cache is not None:
+		inputs = pha_inputs(pha)
+		keys = {mname: cache.make_key("run_xspec", inputs, fit_settings(mname, log_chatter, out_format, warm_start, eseeds.get(mname), flux_errors, lazy_plots, count_iterations, save_state))
+			for mname in models}
+		if not force:
+			with stage(metrics, "cache", path):
+				cached = [mname for mname in models if cache.restore(keys[mname], path)]
+			if cached:
+				print(f"> Restored from cache: {', '.join(cached)}")
+			if not save_state:
+				for mname in cached:
+					remove_state(path, mname)
+			models = [mname for mname in models if mname not in cached]
+	if not models:
+		return
+
+	ch = Xset.chatter
+	Xset.chatter = 0
+	lch = Xset.logChatter
+	Xset.logChatter = log_chatter
+
+	Fit.nIterations = N_ITERATIONS
+	Fit.statMethod = STAT_METHOD
+
+	with stage(metrics, "load", path):
+		s1 = load_spectrum(pha)
+	try:
+		for mname in models:
+			seeds, seed_from = eseeds.get(mname), "epoch"
+			if not seeds and warm_start != "none":
+				seeds, seed_from = model_seeds(path, mname), WARM_START.get(mname, {}).get("from")
+			if on_fit is not None:
+				on_fit(mname)
+			with stage(metrics, "model", path, mname):
+				fit_model(s1, path, mname, out_format, seeds, seed_from if seeds else None, metrics, writer, flux_errors, lazy_plots,
+					count_iterations=count_iterations or warm_start != "none", save_state=save_state)
+			if cache is not None and writer is not None:
+				# Queued after the writes of the model, so its outputs are complete when stored
+				writer.submit(path, store_outputs, cache, keys[mname], path, mname, force)
+			elif cache is not None:
+				with stage(metrics, "cache", path, mname):
+					store_outputs(cache, keys[mname], path, mname, force)
+	finally:
+		AllModels.clear()
+		AllData.clear()
+
+def slice_rows(slice_name, mname, record):
+	"""
+	Converts the fit record of one slice into rows of the slice table, in the layout of
+	the catalog: parameters, then Chi2, DOF and Flux (with its range in Lower and Upper).
+	"""
+	rows = [[slice_name, mname, pname, v["value"], v["error"], None, None] for pname, v in record["parameters"].items()]
+	stats = record["test_statistics"]
+	rows.append([slice_name, mname, "Chi2", stats["Chi-Squared"], None, None, None])
+	rows.append([slice_name, mname, "DOF", stats["DOF"], None, None, None])
+	flux = record["flux"]
+	rows.append([slice_name, mname, "Flux", flux["Flux"], None, flux["Flux_Err_Min"], flux["Flux_Err_Max"]])
+	return rows
+
+def run_slices(slice_dir, path, models=MODELS, pattern=SLICE_PATTERN, flux_errors="xspec", metrics=None, cd_path=None, journal=None):
+	"""
+	Fits the time-sliced spectra of one observation in a single Xspec session.
+	No log, plot or array files are written per slice: the results of all slices go to
+	one table (SLICE_TABLE) in the observation directory, appended slice by slice.
+	Each model starts from its fit of the previous slice, as neighbouring slices are alike.
+	Args:
+		slice_dir (str): Directory with the sliced spectra, relative to the observation directory.
+		path (str): Observation directory.
+		pattern (str): File name pattern of the sliced spectra.
+		journal (FailureJournal): Records the failed slices, or None.
+	Returns:
+		tuple: Number of slices fitted and number failed.
+	"""
+	slice_dir = os.path.join(path, slice_dir)
+	slices = sorted(glob.glob(os.path.join(slice_dir, pattern)))
+	if not slices:
+		raise FileNotFoundError(f"No sliced spectra {pattern} in: {slice_dir}")
+	# The slices share the response and background files named relative to their directory
+	os.chdir(slice_dir)
+
+	Xset.chatter = 0
+	Xset.logChatter = 0
+	Fit.nIterations = N_ITERATIONS
+	Fit.statMethod = STAT_METHOD
+
+	seeds = {}
+	nfailed = 0
+	with open(os.path.join(path, SLICE_TABLE), "w", newline="") as file:
+		writer = csv.writer(file)
+		writer.writerow(SLICE_COLUMNS)
+		for pha in slices:
+			sname = os.path.splitext(os.path.basename(pha))[0]
+			mname = None
+			try:
+				with stage(metrics, "load", path, sname):
+					s1 = load_spectrum(pha)
+				rows = []
+				for mname in models:
+					with stage(metrics, "slice", path, f"{sname}:{mname}"):
+						m1 = set_model(mname, seeds.get(mname))
+						perform_fit()
+						AllModels.calcFlux(f"{FLUX_BAND} err" if flux_errors == "xspec" else FLUX_BAND)
+						record = fit_record(m1, s1, mname)
+						if flux_errors == "covariance":
+							flux_from_covariance(record, mname)
+					rows += slice_rows(sname, mname, record)
+					comp = MODEL_DEFS[mname]["component"]
+					seeds[mname] = {f"{comp}.{p}": v["value"] for p, v in record["parameters"].items() if v["error"] is not None}
+				writer.writerows(rows)
+				file.flush()
+			except Exception as e:
+				nfailed += 1
+				# A failed slice must not seed the next one
+				seeds = {}
+				log_error(f">>> {pha}:: {str(e)}\n{traceback.format_exc()}\n\n", cd_path or path)
+				record_failure(journal, path, e, model=mname, message=f"{sname}: {e}")
+				print(f"> Error: {sname}: {e}")
+			finally:
+				AllModels.clear()
+				AllData.clear()
+
+	return len(slices) - nfailed, nfailed
+
+def enter_obs(fpath, names=None):
+	"""
+	Changes into an observation directory and finds its source spectrum.
+	Args:
+		fpath (str): Path to the observation directory.
+		names (frozenset): File names of the directory from the observation index, None to glob.
+	Returns:
+		str: Path to the source spectrum.
+	"""
+	src_file = find_spectrum(fpath, names)
+	# Xspec resolves the response and background files relative to the working directory
+	os.chdir(fpath)
+	return src_file
+
+def find_spectrum(fpath, names=None):
+	"""
+	Returns the source spectrum of an observation directory, raising FileNotFoundError if there is none.
+	"""
+	if not os.path.exists(fpath):
+		raise FileNotFoundError(f"Path does not exist: {fpath}")
+
+	if names is not None:
+		src_file = next(iter(role_files(fpath, names, "spectrum")), None)
+	else:
+		src_file = check_file(fpath, "spec1.pha")
+	if src_file is None:
+		raise FileNotFoundError(f"Spectrum file not found in: {fpath}")
+	return src_file
+
+def process_obs(fpath, cd_path, prev_path=None, names=None, journal=None, **kwargs):
+	"""
+	Runs the Xspec analysis of all models for one observation.
+	Args:
+		fpath (str): Path to the observation directory.
+		cd_path (str): Directory where the failure log is written.
+		prev_path (str): Observation directory of the previous epoch.
+		names (frozenset): File names of the directory from the observation index, None to glob.
+		journal (FailureJournal): Records the failure with the model being fitted, or None.
+		**kwargs: Options passed on to run_xspec() (models, cache, force, ...).
+	Returns:
+		bool: True if the observation was analysed successfully, False otherwise.
+	"""
+	print(f"\n>>> Running Xspec analysis for Obs: {fpath}")
+
+	fitting = {"model": None}
+	on_fit = kwargs.pop("on_fit", None)
+
+	def start_fit(mname):
+		fitting["model"] = mname
+		if on_fit is not None:
+			on_fit(mname)
+
+	try:
+		src_file = enter_obs(fpath, names)
+
+		metrics = kwargs.get("metrics")
+		with stage(metrics, "observation", fpath), profiling(metrics, fpath):
+			run_xspec(pha=src_file, path=fpath, prev_path=prev_path, on_fit=start_fit, **kwargs)
+
+	except Exception as e:
+		tb = traceback.format_exc()
+		error_msg = f">>> {fpath}:: {str(e)}\n{tb}\n\n"
+		log_error(error_msg, cd_path)
+		record_failure(journal, fpath, e, model=fitting["model"])
+		print(f"> Error: {e}")
+		print(f"> Error: {tb}")
+		print(f"> Error logged for {fpath}. Moving to next path.")
+		return False
+
+	return True
+
+def prefetch_obs(fpath, names=None, cache=None):
+	"""
+	Resolves the inputs of an observation and reads them once, so they are in the page
+	cache (and hashed for the result cache) when the observation is fitted.
+	"""
+	inputs = pha_inputs(find_spectrum(fpath, names))
+	if cache is not None:
+		cache.warm(inputs)
+		return
+	for fname in inputs:
+		with open(fname, "rb") as file:
+			while file.read(1 << 20):
+				pass
+	return
+
+def run_pipelined(file_paths, cd_path, listings=None, depth=PIPELINE_DEPTH, prev_paths=None, **kwargs):
+	"""
+	Runs the observations in order while a background thread prefetches the inputs of
+	the next ones and another writes the spectrum and ratio arrays (and cache entries)
+	of the previous ones. The queues of both threads are bounded by depth observations.
+	Keyword arguments are passed on to process_obs(); a timeout is not supported, as
+	run_supervised() would fork while the threads run.
+	Args:
+		prev_paths (list): Previous epoch of each observation, by default the previous one in the list.
+	"""
+	if kwargs.get("timeout") is not None:
+		raise ValueError("The pipelined mode does not support a timeout.")
+	listings = listings or [None] * len(file_paths)
+	prev_paths = prev_paths or [None] + file_paths[:-1]
+	nmodels = len(kwargs.get("models", MODELS))
+
+	def write_failed(fpath, e, tb):
+		log_error(f">>> {fpath}:: [WRITE] {str(e)}\n{tb}\n\n", cd_path)
+		record_failure(kwargs.get("journal"), fpath, e)
+		print(f"> Error: writing the outputs of {fpath} failed: {e}")
+
+	writer = BackgroundWriter(maxsize=depth * nmodels * 3, on_error=write_failed)
+	items = list(zip(file_paths, prev_paths, listings))
+	try:
+		for fpath, prev_path, names in prefetch(items, lambda item: prefetch_obs(item[0], item[2], kwargs.get("cache")), depth):
+			analyse_obs(fpath, cd_path, prev_path, names=names, writer=writer, **kwargs)
+	finally:
+		writer.close()
+	return
+
+def _supervised_child(conn, fpath, cd_path, prev_path, kwargs):
+	"""
+	Runs process_obs() in the supervised child and reports each fit start to the parent.
+	"""
+	ok = process_obs(fpath, cd_path, prev_path, on_fit=lambda mname: conn.send(("start", mname)), **kwargs)
+	conn.send(("done", ok))
+	conn.close()
+	return
+
+def run_supervised(fpath, cd_path, prev_path=None, timeout=None, journal=None, **kwargs):
+	"""
+	Runs process_obs() in a forked child under a wall-clock budget of timeout seconds
+	per fit (the spectrum loading counts towards the first fit). A child that runs over
+	its budget is killed and the fit is logged as a TIMEOUT failure, a child that dies is
+	logged as a CRASH. The remaining models of the observation are then fitted in a new child.
+	The child is forked with os.fork() because pool workers may not start multiprocessing children.
+	Returns:
+		bool: True if all models were fitted successfully, False otherwise.
+	"""
+	remaining = list(kwargs.pop("models", MODELS))
+	# The writer thread does not exist in the forked child, it writes its outputs itself
+	kwargs.pop("writer", None)
+	success = True
+
+	while remaining:
+		rconn, wconn = multiprocessing.Pipe(duplex=False)
+		sys.stdout.flush()
+		pid = os.fork()
+		if pid == 0:
+			rconn.close()
+			code = 1
+			try:
+				_supervised_child(wconn, fpath, cd_path, prev_path, {**kwargs, "models": remaining, "journal": journal})
+				code = 0
+			finally:
+				sys.stdout.flush()
+				os._exit(code)
+		wconn.close()
+
+		current, started, done = None, [], False
+		deadline = time.monotonic() + timeout
+		while not done:
+			if not rconn.poll(max(0.0, deadline - time.monotonic())):
+				os.kill(pid, signal.SIGKILL)
+				log_error(f">>> {fpath}:: [TIMEOUT] {current or 'data loading'} exceeded {timeout} s, fit killed\n\n", cd_path)
+				record_failure(journal, fpath, model=current, error="Timeout", message=f"exceeded {timeout} s", retryable=True)
+				print(f"> Error: {current or 'data loading'} of {fpath} exceeded {timeout} s. Fit killed.")
+				break
+			try:
+				msg, val = rconn.recv()
+			except EOFError:
+				log_error(f">>> {fpath}:: [CRASH] the fit process died during {current or 'data loading'}\n\n", cd_path)
+				record_failure(journal, fpath, model=current, error="Crash", message="the fit process died", retryable=True)
+				print(f"> Error: fit process of {fpath} died during {current or 'data loading'}.")
+				break
+			if msg == "start":
+				current = val
+				started.append(val)
+				deadline = time.monotonic() + timeout
+			else:
+				done = True
+				success = success and val
+		rconn.close()
+		os.waitpid(pid, 0)
+
+		if done:
+			break
+		success = False
+		if current is None:
+			# The spectrum could not be loaded, there is no point in retrying the other models
+			break
+		remaining = [mname for mname in remaining if mname not in started]
+
+	return success
+
+def analyse_obs(fpath, cd_path, prev_path=None, timeout=None, journal=None, **kwargs):
+	"""
+	Runs one observation, supervised when a per-fit timeout is given.
+	A success resolves an earlier failure of the observation in the journal.
+	"""
+	if timeout:
+		ok = run_supervised(fpath, cd_path, prev_path, timeout, journal=journal, **kwargs)
+	else:
+		ok = process_obs(fpath, cd_path, prev_path, journal=journal, **kwargs)
+	if ok:
+		resolve_failure(journal, fpath)
+	return ok
+
+def process_pair(pair, **kwargs):
+	"""
+	Pool task: runs analyse_obs() for an (observation, previous epoch, indexed file names) tuple.
+	"""
+	return analyse_obs(pair[0], prev_path=pair[1], names=pair[2], **kwargs)
+
+def init_worker(run_id):
+	"""
+	Pool initializer: gives each worker process its own failure log.
+	"""
+	global ERROR_LOG
+	ERROR_LOG = f"failed_obs.{run_id}.{os.getpid()}.txt"
+	return
+
+def run_parallel(file_paths, cd_path, workers, listings=None, prev_paths=None, **kwargs):
+	"""
+	Runs the observations on a pool of worker processes sharing one observation queue.
+	Every worker is a freshly spawned interpreter and therefore owns its own Xspec session.
+	Keyword arguments are passed on to process_obs().
+	Args:
+		listings (list): Indexed file names of each observation, or None to glob.
+		prev_paths (list): Previous epoch of each observation, by default the previous one in the list.
+	Returns:
+		list: Paths of the observations that failed.
+	"""
+	run_id = os.getpid()
+	ctx = multiprocessing.get_context("spawn")
+	task = functools.partial(process_pair, cd_path=cd_path, **kwargs)
+	pairs = zip(file_paths, prev_paths or [None] + file_paths[:-1], listings or [None] * len(file_paths))
+	failed = []
+	try:
+		with ctx.Pool(processes=workers, initializer=init_worker, initargs=(run_id,)) as pool:
+			for fpath, ok in zip(file_paths, pool.imap(task, pairs, chunksize=1)):
+				if not ok:
+					failed.append(fpath)
+	finally:
+		merge_error_logs(cd_path, run_id)
+
+	return failed
+
+def run_queue(qdir, cd_path, stale_after=STALE_AFTER, listings=None, **kwargs):
+	"""
+	Fits the observations of a shared work queue until it is empty.
+	Keyword arguments are passed on to process_obs(); a timeout is not supported, as
+	run_supervised() would fork while the heartbeat thread runs.
+	Args:
+		listings (dict): Indexed file names by observation path; observations not in it are globbed.
+	Returns:
+		tuple: Number of observations run by this process and number failed.
+	"""
+	if kwargs.get("timeout") is not None:
+		raise ValueError("The work queue does not support a timeout.")
+	queue = WorkQueue(qdir, stale_after=stale_after)
+	listings = listings or {}
+	return queue.run(lambda task: analyse_obs(task["path"], cd_path, task.get("prev_path"), names=listings.get(task["path"]), **kwargs))
+
+def run_queue_parallel(qdir, cd_path, workers, **kwargs):
+	"""
+	Runs run_queue() on a pool of worker processes, each claiming observations on its own.
+	Returns:
+		tuple: Number of observations run on this node and number failed.
+	"""
+	run_id = os.getpid()
+	ctx = multiprocessing.get_context("spawn")
+	task = functools.partial(run_queue, cd_path=cd_path, **kwargs)
+	try:
+		with ctx.Pool(processes=workers, initializer=init_worker, initargs=(run_id,)) as pool:
+			counts = pool.map(task, [qdir] * workers, chunksize=1)
+	finally:
+		merge_error_logs(cd_path, run_id)
+
+	return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
 if __name__ == "__main__":
-	ip_path = sys.argv[1]
+	parser = argparse.ArgumentParser(description="Run the Xspec analysis for the observations listed in a text file.")
+	parser.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	parser.add_argument("--models", nargs="+", default=MODELS, choices=list(MODEL_DEFS), help="Models to fit, in order (default: %(default)s)")
+	parser.add_argument("--log-chatter", type=int, default=LOG_CHATTER, help="Chatter level of the Xspec log files, 0 disables them (default: %(default)s)")
+	parser.add_argument("--output-format", choices=FORMATS, default="csv", help="Format of the spectrum and ratio arrays (default: %(default)s)")
+	parser.add_argument("--warm-start", choices=WARM_START_MODES, default="none",
+		help="Seed bknpower and logpar from the powerlaw fit (model), and each model from the previous epoch in the list (epoch)")
+	parser.add_argument("--count-iterations", action="store_true",
+		help="Count the fit iterations without a warm start too, the reference of the iterations saved by later warm starts")
+	parser.add_argument("--save-state", action="store_true", help="Save the best-fit state of every model ({model}_model.xcm) for conf_intervals.py")
+	parser.add_argument("--flux-errors", choices=FLUX_ERRORS, default="xspec",
+		help="Flux range from calcFlux err (xspec) or drawn from the fit covariance (covariance, faster, no Error range in the log)")
+	parser.add_argument("--lazy-plots", action="store_true", help="Do not write the PostScript plots, render them on demand with plot_view.py")
+	parser.add_argument("--timeout", type=float, default=None, help="Wall-clock budget in seconds per fit; slower fits are killed and logged as TIMEOUT")
+	parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own Xspec session (default: 1)")
+	parser.add_argument("--slices", type=str, default=None,
+		help=f"Directory of time-sliced spectra inside each observation; fit every slice and write one table ({SLICE_TABLE})")
+	parser.add_argument("--slice-pattern", type=str, default=SLICE_PATTERN, help="File name pattern of the sliced spectra (default: %(default)s)")
+	parser.add_argument("--pipeline", action="store_true", help="Single process: prefetch the next observations and write the outputs of the previous one in background threads")
+	parser.add_argument("--queue", type=str, default=None, help="Shared work queue directory; created from the obslist by the first process, then observations are claimed from it")
+	parser.add_argument("--stale-after", type=float, default=STALE_AFTER, help="Seconds without heartbeat before a queue claim is reclaimed (default: %(default)s)")
+	add_cache_args(parser)
+	add_metrics_args(parser)
+	add_index_args(parser)
+	add_journal_args(parser)
+	args = parser.parse_args()
+	if args.pipeline and args.timeout is not None:
+		# The supervised children would be forked while the prefetch and writer threads run
+		parser.error("--timeout cannot be combined with --pipeline")
+	if args.slices:
+		# The slices of an observation are fitted in one session, in this process
+		unsupported = [flag for flag, used in [("--workers", args.workers > 1), ("--cache", args.cache or args.cache_dir),
+			("--timeout", args.timeout is not None), ("--index", args.index), ("--pipeline", args.pipeline), ("--queue", args.queue)] if used]
+		if unsupported:
+			parser.error(f"--slices cannot be combined with {', '.join(unsupported)}")
+	if args.pipeline and args.workers > 1:
+		parser.error("--pipeline runs in a single process and cannot be combined with --workers")
+	if args.queue and args.timeout is not None:
+		# Likewise for the heartbeat thread of the claimed observation
+		parser.error("--timeout cannot be combined with --queue")
+	cache = cache_from_args(args)
+	metrics = metrics_from_args(args, "run_xspec")
+	journal = journal_from_args(args, "slices" if args.slices else "fit")
+
+	ip_path = args.ip_path
 	cd_path = os.getcwd()
 
 	with open(ip_path, 'r') as file:
-		file_paths = [line.strip() for line in file if line.strip()]
-
-	for fpath in file_paths:
-		print(f"\n>>> Running Xspec analysis for Obs: {fpath}")
-		
-		os.chdir(fpath)
-		
-		try:
-			if not os.path.exists(fpath):
-				raise FileNotFoundError(f"Path does not exist: {fpath}")
-
-			src_file = check_file(fpath, "spec1.pha")
-
-			model1 = run_xspec(pha=src_file, path=fpath, mname="logpar")
-			model2 = run_xspec(pha=src_file, path=fpath, mname="powerlaw") 
-			model3 = run_xspec(pha=src_file, path=fpath, mname="bknpower")
-
-		except Exception as e:
-			tb = traceback.format_exc()
-			error_msg = f">>> {fpath}:: {str(e)}\n{tb}\n\n"
-			log_error(error_msg, cd_path)
-			print(f"> Error: {e}")
-			print(f"> Error: {tb}")
-			print(f"> Error logged for {fpath}. Moving to next path.")
-			continue
\ No newline at end of file
+		file_paths = [os.path.abspath(line.strip()) for line in file if line.strip()]
+	# The previous epoch of an observation stays the previous one of the whole list
+	previous = dict(zip(file_paths, [None] + file_paths[:-1]))
+	file_paths = retry_from_args(args, journal, file_paths)
+	prev_paths = [previous[fpath] for fpath in file_paths]
+	index = index_from_args(args, file_paths)
+	listings = [index.names(fpath) for fpath in file_paths] if index else [None] * len(file_paths)
+	options = dict(models=args.models, cache=cache, force=args.force, log_chatter=args.log_chatter, out_format=args.output_format, warm_start=args.warm_start, timeout=args.timeout, metrics=metrics, flux_errors=args.flux_errors, lazy_plots=args.lazy_plots, count_iterations=args.count_iterations, save_state=args.save_state, journal=journal)
+
+	if args.slices:
+		for fpath in file_paths:
+			print(f"\n>>> Fitting the slices of Obs: {fpath}")
+			try:
+				with stage(metrics, "observation", fpath):
+					nok, nfailed = run_slices(args.slices, fpath, args.models, args.slice_pattern, args.flux_errors, metrics, cd_path, journal)
+				print(f">>> {nok} slices fitted, {nfailed} failed: {os.path.join(fpath, SLICE_TABLE)}")
+				if not nfailed:
+					resolve_failure(journal, fpath)
+			except Exception as e:
+				log_error(f">>> {fpath}:: {str(e)}\n{traceback.format_exc()}\n\n", cd_path)
+				record_failure(journal, fpath, e)
+				print(f"> Error: {e}")
+				print(f"> Error logged for {fpath}. Moving to next path.")
+	elif args.queue:
+		tasks = [{"path": fpath, "prev_path": prev_path} for fpath, prev_path in zip(file_paths, prev_paths)]
+		if WorkQueue(args.queue).populate(tasks):
+			print(f">>> Created work queue {args.queue} with {len(tasks)} observations")
+		qlistings = dict(zip(file_paths, listings)) if index else None
+		if args.workers > 1:
+			nrun, nfailed = run_queue_parallel(args.queue, cd_path, args.workers, stale_after=args.stale_after, listings=qlistings, **options)
+		else:
+			nrun, nfailed = run_queue(args.queue, cd_path, stale_after=args.stale_after, listings=qlistings, **options)
+		print(f"\n>>> Queue {args.queue} empty: {nrun} observations run here, {nfailed} failed.")
+	elif args.workers > 1:
+		failed = run_parallel(file_paths, cd_path, args.workers, listings, prev_paths, **options)
+		print(f"\n>>> Finished {len(file_paths)} observations with {args.workers} workers, {len(failed)} failed.")
+	elif args.pipeline:
+		run_pipelined(file_paths, cd_path, listings, prev_paths=prev_paths, **options)
+	else:
+		for fpath, prev_path, names in zip(file_paths, prev_paths, listings):
+			analyse_obs(fpath, cd_path, prev_path, names=names, **options)
+
+	if cache is not None:
+		cache.evict()
@@ -0,0 +1,239 @@
+"""
+Work queue of observations kept in a shared directory, for batch fitting on several nodes.
+
+Every observation is a small JSON task file that moves between four directories:
+
+	pending/  ->  claimed/  ->  done/ or failed/
+
+A worker claims a task by renaming it from pending/ into claimed/ under a name that
+carries its host and pid. Rename is atomic, so exactly one worker wins each task and
+no broker or lock server is needed. While fitting, the worker touches its claim file
+(heartbeat); a claim whose heartbeat is older than the stale limit belongs to a dead
+worker and is renamed back into pending/ by any other worker. Workers keep claiming
+until the queue is empty, so fast nodes take more observations than slow ones.
+Ages are measured against the clock of the file server, not of the nodes.
+
+command: `python work_queue.py status DIR` (also `init DIR obslist.txt`, `requeue DIR`, `reclaim DIR`)
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import contextlib
+
+STATES = ["pending", "claimed", "done", "failed"]
+STALE_AFTER = 600.0  # s without heartbeat before a claim is reclaimed
+HEARTBEAT = 30.0  # s between heartbeats
+POLL = 5.0  # s between checks for stale claims when nothing is pending
+
+
+class WorkQueue:
+	"""
+	Directory-backed work queue.
+	Args:
+		qdir (str): Queue directory on a filesystem shared by all workers.
+		stale_after (float): Seconds without heartbeat after which a claim is reclaimed.
+		heartbeat (float): Seconds between heartbeats of a running task.
+	"""
+	def __init__(self, qdir, stale_after=STALE_AFTER, heartbeat=HEARTBEAT):
+		self.qdir = os.path.abspath(qdir)
+		self.stale_after = stale_after
+		self.heartbeat = heartbeat
+		self.owner = f"{socket.gethostname()}.{os.getpid()}"
+		self._pending = []
+		os.makedirs(self.qdir, exist_ok=True)
+
+	def _dir(self, state):
+		return os.path.join(self.qdir, state)
+
+	def populate(self, tasks):
+		"""
+		Creates the queue from a list of task dicts, unless another worker already did.
+		The tasks are written to a private directory that is renamed to pending/ at once.
+		Returns:
+			bool: True if this call created the queue.
+		"""
+		if os.path.exists(self._dir("pending")):
+			return False
+		for state in STATES[1:]:
+			os.makedirs(self._dir(state), exist_ok=True)
+		tmp = os.path.join(self.qdir, f"tmp.{self.owner}")
+		os.makedirs(tmp, exist_ok=True)
+		for i, task in enumerate(tasks):
+			with open(os.path.join(tmp, f"{i:08d}.json"), "w") as file:
+				json.dump(task, file)
+		try:
+			os.rename(tmp, self._dir("pending"))
+		except OSError:
+			# Another worker created the queue first
+			for name in os.listdir(tmp):
+				os.remove(os.path.join(tmp, name))
+			os.rmdir(tmp)
+			return False
+		return True
+
+	def now(self):
+		"""
+		Returns the current time of the file server, from the mtime of a touched file.
+		"""
+		clock = os.path.join(self.qdir, ".clock")
+		with open(clock, "a"):
+			pass
+		os.utime(clock)
+		return os.stat(clock).st_mtime
+
+	def claim(self):
+		"""
+		Claims the next pending task.
+		Returns:
+			tuple: (claim file, task dict), or None if nothing is pending.
+		"""
+		while True:
+			if not self._pending:
+				self._pending = sorted(os.listdir(self._dir("pending")), reverse=True)
+				if not self._pending:
+					return None
+			name = self._pending.pop()
+			claim = os.path.join(self._dir("claimed"), f"{name}@{self.owner}")
+			try:
+				# Touched before the rename, so the claim never shows up with the old mtime
+				# of the pending task and is not taken for a stale one by reclaim_stale()
+				os.utime(os.path.join(self._dir("pending"), name))
+				os.rename(os.path.join(self._dir("pending"), name), claim)
+			except FileNotFoundError:
+				# Claimed by another worker in the meantime
+				continue
+			with open(claim, "r") as file:
+				return claim, json.load(file)
+
+	@contextlib.contextmanager
+	def heartbeat_of(self, claim):
+		"""
+		Touches the claim file every heartbeat seconds while the enclosed block runs.
+		"""
+		stop = threading.Event()
+
+		def beat():
+			while not stop.wait(self.heartbeat):
+				try:
+					os.utime(claim)
+				except FileNotFoundError:
+					# The claim was reclaimed, the task now belongs to another worker
+					return
+
+		thread = threading.Thread(target=beat, daemon=True)
+		thread.start()
+		try:
+			yield
+		finally:
+			stop.set()
+			thread.join()
+
+	def finish(self, claim, ok):
+		"""
+		Moves a claimed task to done/ or failed/.
+		Returns:
+			bool: False if the claim had been reclaimed by another worker.
+		"""
+		name = os.path.basename(claim).split("@")[0]
+		try:
+			os.rename(claim, os.path.join(self._dir("done" if ok else "failed"), name))
+		except FileNotFoundError:
+			return False
+		return True
+
+	def reclaim_stale(self):
+		"""
+		Returns the claims without a recent heartbeat to pending/.
+		Returns:
+			int: Number of reclaimed tasks.
+		"""
+		limit = self.now() - self.stale_after
+		count = 0
+		for cname in os.listdir(self._dir("claimed")):
+			claim = os.path.join(self._dir("claimed"), cname)
+			try:
+				if os.stat(claim).st_mtime >= limit:
+					continue
+				os.rename(claim, os.path.join(self._dir("pending"), cname.split("@")[0]))
+			except FileNotFoundError:
+				continue
+			print(f"> Reclaimed stale task {cname}")
+			count += 1
+		return count
+
+	def requeue(self, state="failed"):
+		"""
+		Moves all tasks of a state back to pending/.
+		Returns:
+			int: Number of requeued tasks.
+		"""
+		names = os.listdir(self._dir(state))
+		for name in names:
+			os.rename(os.path.join(self._dir(state), name), os.path.join(self._dir("pending"), name.split("@")[0]))
+		return len(names)
+
+	def counts(self):
+		"""
+		Returns the number of tasks in each state.
+		"""
+		return {state: len(os.listdir(self._dir(state))) if os.path.isdir(self._dir(state)) else 0 for state in STATES}
+
+	def run(self, handler, poll=POLL):
+		"""
+		Claims and runs tasks until none is pending or claimed by any worker.
+		When nothing is pending but other workers still hold claims, the worker
+		waits and reclaims those that go stale.
+		Args:
+			handler (callable): Called with each task dict, returns True on success.
+		Returns:
+			tuple: Number of tasks run and number failed.
+		"""
+		nrun = nfailed = 0
+		while True:
+			item = self.claim()
+			if item is None:
+				if self.reclaim_stale():
+					continue
+				if not os.listdir(self._dir("claimed")):
+					break
+				time.sleep(poll)
+				continue
+			claim, task = item
+			ok = False
+			with self.heartbeat_of(claim):
+				try:
+					ok = handler(task)
+				finally:
+					if not self.finish(claim, ok):
+						print(f"> Warning: Task {os.path.basename(claim)} was reclaimed while running.")
+			nrun += 1
+			nfailed += not ok
+		return nrun, nfailed
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Inspect or manage a work queue directory.")
+	parser.add_argument("command", choices=["status", "init", "requeue", "reclaim"], help="status, init (from an obslist), requeue (failed tasks), reclaim (stale claims)")
+	parser.add_argument("qdir", type=str, help="Queue directory")
+	parser.add_argument("ip_path", type=str, nargs="?", help="Text file with the paths of the observations (init)")
+	parser.add_argument("--stale-after", type=float, default=STALE_AFTER, help="Seconds without heartbeat before a claim is stale (default: %(default)s)")
+	args = parser.parse_args()
+
+	queue = WorkQueue(args.qdir, stale_after=args.stale_after)
+	if args.command == "init":
+		if not args.ip_path:
+			parser.error("init needs the obslist file")
+		with open(args.ip_path, 'r') as file:
+			file_paths = [os.path.abspath(line.strip()) for line in file if line.strip()]
+		tasks = [{"path": fpath, "prev_path": prev} for fpath, prev in zip(file_paths, [None] + file_paths[:-1])]
+		if not queue.populate(tasks):
+			print(f"> Error: Queue {args.qdir} already exists.")
+	elif args.command == "requeue":
+		print(f">>> Requeued {queue.requeue('failed')} failed tasks.")
+	elif args.command == "reclaim":
+		print(f">>> Reclaimed {queue.reclaim_stale()} stale tasks.")
+	print(queue.counts())
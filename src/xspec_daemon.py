@@ -0,0 +1,282 @@
+"""
+Long-lived Xspec fitting service on a Unix socket.
+
+The daemon starts a pool of worker processes once; each imports PyXspec and keeps its
+Xspec session for the lifetime of the daemon, so short jobs do not pay the startup
+cost. Clients send one JSON object per line and receive one JSON object per line:
+
+	{"op": "fit", "id": 1, "path": "/data/6100110000", "models": ["powerlaw"]}
+	-> {"id": 1, "path": "/data/6100110000", "ok": true, "results": {"powerlaw": {...fit record...}}, ...}
+	{"op": "ping"} -> {"ok": true, "workers": 4, "pending": 0}
+	{"op": "shutdown"} -> {"ok": true}
+
+Fit jobs may also set prev_path, log_chatter, out_format, warm_start, flux_errors, lazy_plots, save_state and force.
+Every connection is served by its own thread and the jobs of all clients share the
+worker pool, so several clients can submit at the same time. The answers of a
+connection arrive in the order the fits finish, matched by their id.
+
+command: `python xspec_daemon.py serve /tmp/xspec.sock --workers 4`
+         `python xspec_daemon.py submit /tmp/xspec.sock obslist.txt --models powerlaw logpar`
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import functools
+import threading
+import traceback
+import socketserver
+import multiprocessing
+from result_cache import add_cache_args, cache_from_args
+
+JOB_OPTIONS = ["models", "prev_path", "log_chatter", "out_format", "warm_start", "flux_errors", "lazy_plots", "save_state", "force"]
+
+# Set in each worker process by init_worker()
+_worker = {}
+
+
+def init_worker(cache, cd_path):
+	"""
+	Pool initializer: imports PyXspec once per worker and gives it its own failure log.
+	"""
+	import run_xspec
+	run_xspec.init_worker(f"daemon.{os.getppid()}")
+	_worker.update(run_xspec=run_xspec, cache=cache, cd_path=cd_path)
+	return
+
+def run_job(job):
+	"""
+	Fits the models of one observation in a worker.
+	Returns:
+		Dict: The answer to the client, with the fit record of each model on success.
+	"""
+	rx = _worker["run_xspec"]
+	fpath = os.path.abspath(job["path"])
+	options = {key: job[key] for key in JOB_OPTIONS if key in job}
+	models = options.setdefault("models", rx.MODELS)
+	t0 = time.perf_counter()
+	answer = {"id": job.get("id"), "path": fpath, "worker": os.getpid()}
+	try:
+		unknown = [mname for mname in models if mname not in rx.MODEL_DEFS]
+		if unknown:
+			raise ValueError(f"Unknown models: {', '.join(unknown)}")
+		src_file = rx.enter_obs(fpath)
+		rx.run_xspec(pha=src_file, path=fpath, cache=_worker["cache"], **options)
+		answer.update(ok=True, results={mname: rx.read_record(fpath, mname) for mname in models})
+	except Exception as e:
+		tb = traceback.format_exc()
+		rx.log_error(f">>> {fpath}:: {str(e)}\n{tb}\n\n", _worker["cd_path"])
+		answer.update(ok=False, error=str(e), traceback=tb)
+	answer["wall"] = round(time.perf_counter() - t0, 3)
+	return answer
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+	"""
+	Serves one client connection: reads requests until the client closes its side,
+	then waits for its pending fits before closing the connection.
+	"""
+	def handle(self):
+		lock = threading.Lock()
+		pending = []
+
+		def reply(msg):
+			with lock:
+				try:
+					self.wfile.write((json.dumps(msg) + "\n").encode())
+					self.wfile.flush()
+				except OSError:
+					# The client went away, the fit results stay on disk
+					pass
+
+		def failed(job, exc):
+			reply({"id": job.get("id"), "path": job.get("path"), "ok": False, "error": repr(exc)})
+
+		for line in self.rfile:
+			if not line.strip():
+				continue
+			try:
+				req = json.loads(line)
+			except ValueError:
+				reply({"ok": False, "error": "Invalid JSON request"})
+				continue
+			op = req.get("op", "fit")
+			if op == "fit":
+				if "path" not in req:
+					reply({"id": req.get("id"), "ok": False, "error": "Fit request without path"})
+					continue
+				self.server.track(1)
+				pending.append(self.server.pool.apply_async(run_job, (req,),
+					callback=functools.partial(self.server.done, reply),
+					error_callback=functools.partial(self.server.done, functools.partial(failed, req))))
+			elif op == "ping":
+				reply({"ok": True, "workers": self.server.workers, "pending": self.server.pending})
+			elif op == "shutdown":
+				reply({"ok": True})
+				threading.Thread(target=self.server.shutdown).start()
+				break
+			else:
+				reply({"id": req.get("id"), "ok": False, "error": f"Unknown op: {op}"})
+
+		for res in pending:
+			res.wait()
+		return
+
+
+class XspecDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	"""
+	Unix socket server in front of a pool of initialized Xspec workers.
+	"""
+	daemon_threads = True
+
+	def __init__(self, sock_path, workers, cache=None, cd_path=None):
+		self.workers = workers
+		self.pending = 0
+		self._lock = threading.Lock()
+		ctx = multiprocessing.get_context("spawn")
+		self.pool = ctx.Pool(processes=workers, initializer=init_worker, initargs=(cache, cd_path or os.getcwd()))
+		super().__init__(sock_path, JobHandler)
+
+	def track(self, n):
+		with self._lock:
+			self.pending += n
+
+	def done(self, reply, answer):
+		self.track(-1)
+		reply(answer)
+
+	def server_close(self):
+		super().server_close()
+		self.pool.close()
+		self.pool.join()
+
+
+def serve(sock_path, workers=1, cache=None):
+	"""
+	Runs the daemon until a shutdown request, SIGTERM or SIGINT.
+	"""
+	if os.path.exists(sock_path):
+		try:
+			ping(sock_path)
+			print(f"> Error: A daemon is already listening on {sock_path}")
+			return
+		except OSError:
+			# Stale socket of a daemon that did not shut down cleanly
+			os.remove(sock_path)
+
+	cd_path = os.getcwd()
+	server = XspecDaemon(sock_path, workers, cache, cd_path)
+	signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+	print(f">>> Xspec daemon listening on {sock_path} with {workers} workers")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(sock_path)
+		run_id = f"daemon.{os.getpid()}"
+		if any(name.startswith(f"failed_obs.{run_id}.") for name in os.listdir(cd_path)):
+			import run_xspec
+			run_xspec.merge_error_logs(cd_path, run_id)
+		print(">>> Xspec daemon stopped")
+	return
+
+def request(sock_path, messages, on_answer=None):
+	"""
+	Sends requests to the daemon and collects the answers.
+	Args:
+		sock_path (str): Socket of the daemon.
+		messages (list): Request dicts.
+		on_answer (callable): Called with each answer as it arrives.
+	Returns:
+		list: The answers, in the order they arrived.
+	"""
+	answers = []
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.connect(sock_path)
+		with sock.makefile("rwb") as stream:
+			for msg in messages:
+				stream.write((json.dumps(msg) + "\n").encode())
+			stream.flush()
+			sock.shutdown(socket.SHUT_WR)
+			for line in stream:
+				answer = json.loads(line)
+				answers.append(answer)
+				if on_answer is not None:
+					on_answer(answer)
+	return answers
+
+def ping(sock_path):
+	"""
+	Returns the status of the daemon, raises OSError if none is listening.
+	"""
+	return request(sock_path, [{"op": "ping"}])[0]
+
+def submit(sock_path, file_paths, on_answer=None, **options):
+	"""
+	Submits a fit job for every observation, the previous one in the list being its previous epoch.
+	Returns:
+		list: The answers of the daemon.
+	"""
+	jobs = []
+	for i, fpath in enumerate(file_paths):
+		job = {"op": "fit", "id": i, "path": os.path.abspath(fpath), **options}
+		if i > 0:
+			job["prev_path"] = os.path.abspath(file_paths[i - 1])
+		jobs.append(job)
+	return request(sock_path, jobs, on_answer)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Persistent Xspec fitting daemon and its client.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	p_serve = sub.add_parser("serve", help="Start the daemon")
+	p_serve.add_argument("socket", type=str, help="Path of the Unix socket")
+	p_serve.add_argument("--workers", type=int, default=1, help="Number of Xspec worker processes (default: 1)")
+	add_cache_args(p_serve)
+	p_submit = sub.add_parser("submit", help="Fit the observations listed in a text file")
+	p_submit.add_argument("socket", type=str, help="Path of the Unix socket")
+	p_submit.add_argument("ip_path", type=str, help="Text file with the paths of the observations")
+	p_submit.add_argument("--models", nargs="+", default=None, help="Models to fit, in order (default: all)")
+	p_submit.add_argument("--log-chatter", type=int, default=None, help="Chatter level of the Xspec log files")
+	p_submit.add_argument("--output-format", choices=["csv", "npy"], default=None, help="Format of the spectrum and ratio arrays")
+	p_submit.add_argument("--warm-start", choices=["none", "model", "epoch"], default=None, help="Warm start mode, see run_xspec.py")
+	p_submit.add_argument("--flux-errors", choices=["xspec", "covariance"], default=None, help="Source of the flux range, see run_xspec.py")
+	p_submit.add_argument("--lazy-plots", action="store_true", help="Do not write the PostScript plots")
+	p_submit.add_argument("--save-state", action="store_true", help="Save the best-fit states for conf_intervals.py")
+	p_submit.add_argument("--force", action="store_true", help="Fit even on a cache hit")
+	p_status = sub.add_parser("status", help="Show the status of the daemon")
+	p_status.add_argument("socket", type=str, help="Path of the Unix socket")
+	p_stop = sub.add_parser("stop", help="Stop the daemon after the running fits")
+	p_stop.add_argument("socket", type=str, help="Path of the Unix socket")
+	args = parser.parse_args()
+
+	if args.command == "serve":
+		serve(os.path.abspath(args.socket), args.workers, cache_from_args(args))
+	elif args.command == "status":
+		print(ping(args.socket))
+	elif args.command == "stop":
+		print(request(args.socket, [{"op": "shutdown"}])[0])
+	else:
+		with open(args.ip_path, 'r') as file:
+			file_paths = [line.strip() for line in file if line.strip()]
+		options = {"models": args.models, "log_chatter": args.log_chatter, "out_format": args.output_format,
+			"warm_start": args.warm_start, "flux_errors": args.flux_errors, "lazy_plots": args.lazy_plots or None,
+			"save_state": args.save_state or None, "force": args.force or None}
+		options = {key: val for key, val in options.items() if val is not None}
+
+		def show(answer):
+			if answer["ok"]:
+				print(f">>> {answer['path']}: fitted {', '.join(answer['results'])} in {answer['wall']} s")
+			else:
+				print(f"> Error: {answer.get('path')}:: {answer['error']}")
+
+		answers = submit(args.socket, file_paths, on_answer=show, **options)
+		failed = [a for a in answers if not a["ok"]]
+		print(f"\n>>> Finished {len(answers)} observations, {len(failed)} failed.")
+		sys.exit(1 if failed else 0)
@@ -36,14 +36,20 @@ class XspecAnalysis:
 		Define the model and set its parameters.
 		"""
 		model = Model(self.model)
+		# All values in one setPars call, a delta of -1 freezes the parameter
+		values = {}
 		for comp, comp_params in self.params.items():
-			print(comp, comp_params)
+			for pname, pdef in comp_params.items():
+				index = getattr(getattr(model, comp), pname).index
+				values[index] = f"{pdef['value']},-1" if pdef["frozen"] else pdef["value"]
+		model.setPars(values)
+		return model
 
 
 	def run_xspec(self):
 		self._setup_logging()
 		self._load_data()
-		# self._load_model()
+		self._load_model()
 
 
 		AllData.clear()